@@ -19,70 +19,173 @@ class:        the name of a python class which will be instantiated once
               and have methods called as events occur.
 method:       (class, method) tuple
 process:      ??
+
+Events may also have these optional properties:
+
+debounce:     wait until no event has arrived for this many seconds and
+              call the handler once for the entire burst
+coalesce:     call the handler at most this many seconds after the first
+              event in a burst
+max_children: the number of copies of a command which may run at once
+              (default 1; crankd --max-children limits the total)
+preload:      import a Python handler at startup rather than when its first
+              event arrives
+threaded:     run a function or method handler on a worker thread so it
+              can't delay other events; calls for the same event key still
+              run one at a time, in order (crankd --threaded makes this the
+              default)
+main_thread:  always run a function or method handler on the main thread,
+              e.g. because it uses Cocoa objects
+worker_group: run a function or method handler in a separate process shared
+              by every handler with the same group name, so it can use
+              another CPU core and a crash only restarts that process;
+              handlers receive plain Python values rather than Cocoa objects
+timeout:      kill a command which runs for longer than this many seconds
+rate_limit:   a dictionary with rate (calls per second), burst and policy
+              (drop, defer or latest) limiting how often the handler runs
+batch:        call a SystemConfiguration handler once for each change
+              notification with every key it matches (as keys) and their
+              regexp groups (as captures) instead of once per key
+only_if_changed: skip a SystemConfiguration handler when a key was rewritten
+              with the value it already had
+match:        a dictionary of conditions on the event's key, regexp captures,
+              user_info, path and other fields which must all hold for the
+              handler to be called, tested inside crankd so commands aren't
+              started just to exit (see PyMacAdmin.crankd.predicates)
+resolve_ttl:  the number of seconds an NSNetService handler remembers a
+              resolved service (default 3600); announcements of a
+              remembered service are ignored
+
+SystemConfiguration handlers receive the previous and current value of the
+key as old_value and new_value (old_values and new_values for batches); the
+values are fetched once per change notification so handlers don't need to
+call SCDynamicStoreCopyValue themselves.
+
+CLLocation entries may set min_distance (metres), min_interval (seconds) and
+accuracy (metres): CoreLocation is asked for updates no more often or
+precisely than that and handlers only receive updates which pass them. An
+entry with regions, a dictionary of region names and their latitude,
+longitude and radius in metres, is a geofence: its handlers are only called
+when the location enters or leaves a region, with the region's name as region
+and "enter" or "exit" as transition.
+
+NSNetService handlers are called once for each burst of announcements, after
+the browser reports that nothing more is coming and the new services have
+resolved, with the resolved services as services, the services which went
+away as removed and the last resolved service as service_info.
+
+Timers:
+
+The Timers section runs handlers on a schedule: each entry is named by its
+key and has either an interval in seconds or a cron-style schedule
+("30 2 * * 1-5", in local time) and optionally a jitter, the maximum number of
+seconds to delay each run at random. Handlers receive the time the run was
+scheduled for and the number of runs missed while the machine was asleep;
+missed runs are skipped rather than made up. All timers share one runloop
+timer which is only set for the next deadline.
+
+Metrics:
+
+Each handler's call count, errors, latency histogram, coalesced events and
+shell command exit statuses are kept in memory. Send crankd SIGUSR1 to write
+them to the log or use --metrics-socket to serve them in the Prometheus text
+format, e.g. "nc -U /var/run/crankd.metrics".
+
+Queues:
+
+Events wait in a bounded queue for each source until the runloop dispatches
+them. The optional Queues section sets max_size (default 1000) and the
+overflow policy for each section: drop-oldest (the default for notifications),
+drop-newest, coalesce (the default for SystemConfiguration and FSEvents: only
+the latest event for each key is kept and a dropped event becomes a "rescan"
+event for its root) or block. A rate_limit, as for events, limits how many of
+a section's events are dispatched per second. Queue depths, drops and
+throttled events are included in the metrics.
+
+Resuming:
+
+crankd saves the ID of the last filesystem event it dispatched next to its
+configuration file (adding ".fsevents" to the name) at most every 5 seconds
+and replays the changes it missed when it starts again.
+FSEvents handlers receive the event_id of each change; a watched path whose
+history isn't available, because its volume's event database was replaced or
+the event IDs wrapped around, receives one event with recursive and rescan
+set instead. Use --no-resume to ignore changes made while crankd wasn't running.
+
+Profiling:
+
+crankd --profile[=DIR] profiles every handler and writes a pstats file for
+each one to DIR when it receives SIGUSR2 and when it exits, e.g.
+"python -m pstats DIR/handler.pstats". --profile-mode=sample takes a sample
+of each running handler's stack every --sample-interval seconds instead of
+using cProfile, which is cheap enough to leave running in production.
+
+Reloading:
+
+Changes to the configuration file, or SIGHUP, are applied without restarting:
+only the events which were added, removed or changed are updated and handler
+objects keep their state. crankd restarts if its own code, a handler module
+or the list of imports changes.
 """
 
-from Cocoa import \
-    CFAbsoluteTimeGetCurrent, \
-    CFRunLoopAddSource, \
-    CFRunLoopAddTimer, \
-    CFRunLoopTimerCreate, \
+# Only Foundation and FSEvents, which we use to watch our own files, are
+# always needed: AppKit, SystemConfiguration and CoreLocation are imported by
+# the event sources which use them so configurations which don't use those
+# sections never load them.
+from Foundation import \
     NSNetServiceBrowser, \
     NSObject, \
     NSRunLoop, \
-    NSWorkspace, \
     kCFRunLoopCommonModes, \
+    CFRunLoopAddSource, \
     NSDistributedNotificationCenter
 
-from SystemConfiguration import \
-    SCDynamicStoreCopyKeyList, \
-    SCDynamicStoreCreate, \
-    SCDynamicStoreCreateRunLoopSource, \
-    SCDynamicStoreSetNotificationKeys
-
 from FSEvents import \
     FSEventStreamCreate, \
     FSEventStreamStart, \
+    FSEventStreamStop, \
+    FSEventStreamInvalidate, \
+    FSEventStreamRelease, \
     FSEventStreamScheduleWithRunLoop, \
     kFSEventStreamEventIdSinceNow, \
     kCFRunLoopDefaultMode, \
     kFSEventStreamEventFlagMustScanSubDirs, \
     kFSEventStreamEventFlagUserDropped, \
-    kFSEventStreamEventFlagKernelDropped
-
-try:
-    from CoreLocation import CLLocationManager, kCLLocationAccuracyBest
-except ImportError, e:
-    pass
+    kFSEventStreamEventFlagKernelDropped, \
+    kFSEventStreamEventFlagHistoryDone, \
+    kFSEventStreamEventFlagEventIdsWrapped
 
 import os
 import os.path
 import logging
 import logging.handlers
 import sys
-import re
-from subprocess import call
 from optparse import OptionParser
-from plistlib import readPlist, writePlist
-from PyObjCTools import AppHelper
 from functools import partial
 import signal
-from datetime import datetime
+
+from PyMacAdmin.crankd import actions
+from PyMacAdmin.crankd.checkpoint import Checkpoint, CHECKPOINT_SUFFIX
+from PyMacAdmin.crankd.cocoa import CocoaEventLoop
+from PyMacAdmin.crankd.config import load_config, read_config, configure_sources, reload_sources
+from PyMacAdmin.crankd.events import Dispatcher, EventSource
+from PyMacAdmin.crankd.executor import CommandExecutor
+from PyMacAdmin.crankd.logqueue import QueueHandler, log_list
+from PyMacAdmin.crankd.metrics import METRICS, MetricsServer
+from PyMacAdmin.crankd.profiler import Profiler, SamplingProfiler
+from PyMacAdmin.crankd.replay import EventRecorder, replay
+from PyMacAdmin.crankd.restartwatch import RestartWatch
+from PyMacAdmin.crankd.sources import SystemConfigurationSource, FileSystemSource, NetServiceSource, LocationSource
+from PyMacAdmin.crankd.processes import WorkerGroups
+from PyMacAdmin.crankd.timers import TimerSource
+from PyMacAdmin.crankd.workers import WorkerPool
 
 
 VERSION          = '$Revision: #4 $'
 
-HANDLER_OBJECTS      = dict()     # Events which have a "class" handler use an instantiated object; we want to load only one copy
-EXPLICIT_SC_HANDLERS = dict()     # Callbacks indexed by explicit SystemConfiguration keys
-REGEXP_SC_HANDLERS   = dict()     # Callbacks indexed by regexp SystemConfiguration keys
-FS_WATCHED_FILES     = dict()     # Callbacks indexed by filesystem path
-MDNS_BROWSERS        = dict()
-CL_HANDLERS          = []
-DISTRIBUTED_IDS      = dict()
-RELAUNCH_IDS         = dict()
+DEFAULT_PROFILE_DIR = '/tmp/crankd-profile'
 
-class BaseHandler(object):
-    # pylint: disable-msg=C0111,R0903
-    pass
+DISPATCHER       = Dispatcher()   # Routes events from every EventSource to their handlers
 
 
 class NSNotificationHandler(NSObject):
@@ -131,8 +234,8 @@ class MDNSBrowser(NSObject):
     def init(self):
         self = super(MDNSBrowser, self).init()
         if self is None: return None
-        self.services = set()
-        self.callable = None
+        self.services = set()   # Services being resolved, which must be kept alive until they finish
+        self.source   = None
         return self
     
     
@@ -143,14 +246,18 @@ class MDNSBrowser(NSObject):
         b.searchForServicesOfType_inDomain_(type_, '')
     
     
-    def netServiceBrowser_didFindService_moreComing_(self, browser, service, morecoming):
+    def resolve(self, service):
         self.services.add(service)
         service.setDelegate_(self)
         service.resolveWithTimeout_(5)
     
     
+    def netServiceBrowser_didFindService_moreComing_(self, browser, service, morecoming):
+        self.source.service_found(self.type, service_key(service), service, bool(morecoming))
+    
+    
     def netServiceBrowser_didRemoveService_moreComing_(self, browser, service, morecoming):
-        pass    
+        self.source.service_removed(self.type, service_key(service), service_info(service, False), bool(morecoming))
     
     
     def netServiceDidResolveAddress_(self, service):
@@ -162,21 +269,30 @@ class MDNSBrowser(NSObject):
     
     
     def notify(self, service, resolved):
-        if self.callable:
-            self.callable(service_info={
-                'name': service.name(),
-                'type': service.type(),
-                'port': service.port(),
-                'hostName': service.hostName(),
-                'domain': service.domain(),
-                'addresses': service.addresses(),
-                'resolved': resolved,
-                'TXTRecordData': service.TXTRecordData(),
-            })
+        self.services.discard(service)
+        self.source.service_resolved(self.type, service_key(service), service_info(service, resolved))
         
     
 
 
+def service_key(service):
+    """Identifies an NSNetService across announcements, which use different objects"""
+    return (service.name(), service.type(), service.domain())
+
+
+def service_info(service, resolved):
+    return {
+        'name': service.name(),
+        'type': service.type(),
+        'port': service.port(),
+        'hostName': service.hostName(),
+        'domain': service.domain(),
+        'addresses': service.addresses(),
+        'resolved': resolved,
+        'TXTRecordData': service.TXTRecordData(),
+    }
+
+
 class LocationDelegate(NSObject):
     def init(self):
         self = super(LocationDelegate, self).init()
@@ -187,10 +303,13 @@ class LocationDelegate(NSObject):
         return self
     
     
-    def start_manager(self):
+    def start_manager(self, min_distance=None, accuracy=None):
+        from CoreLocation import CLLocationManager, kCLLocationAccuracyBest, kCLDistanceFilterNone
+        
         lm = self.manager = CLLocationManager.new()
         lm.setDelegate_(self)
-        lm.setDesiredAccuracy_(kCLLocationAccuracyBest)
+        lm.setDesiredAccuracy_(accuracy or kCLLocationAccuracyBest)
+        lm.setDistanceFilter_(min_distance or kCLDistanceFilterNone)
         lm.startUpdatingLocation()
     
     
@@ -205,7 +324,7 @@ class LocationDelegate(NSObject):
             return
         
         if self.callable:
-            self.callable(location_info={
+            self.callable({
                 'latitude': lat,
                 'longitude': lon,
                 'horizontalAccuracy': haccuracy,
@@ -218,129 +337,12 @@ class LocationDelegate(NSObject):
     
 
 
-def log_list(msg, items, level=logging.INFO):
-    """
-    Record a a list of values with a message
-    
-    This would ordinarily be a simple logging call but we want to keep the
-    length below the 1024-byte syslog() limitation and we'll format things
-    nicely by repeating our message with as many of the values as will fit.
-    
-    Individual items longer than the maximum length will be truncated.
-    """
-    
-    max_len    = 1024 - len(msg % "")
-    cur_len    = 0
-    cur_items  = list()
-    
-    while [ i[:max_len] for i in items]:
-        i = items.pop()
-        if cur_len + len(i) + 2 > max_len:
-            logging.info(msg % ", ".join(cur_items))
-            cur_len = 0
-            cur_items = list()
-        
-        cur_items.append(i)
-        cur_len += len(i) + 2
-    
-    logging.log(level, msg % ", ".join(cur_items))
-
-
-def get_callable_for_event(name, event_config, context=None):
-    """
-        Returns a callable object which can be used as a callback for any
-        event. The returned function has context information, logging, etc.
-        included so they do not need to be passed when the actual event
-        occurs.
-        
-        NOTE: This function does not process "class" handlers - by design they
-        are passed to the system libraries which expect a delegate object with
-        various event handling methods
-    """
-    
-    kwargs = {
-        'context':  context,
-        'key':      name,
-        'config':   event_config,
-    }
-    
-    if "command" in event_config:
-        f = partial(do_shell, event_config["command"], **kwargs)
-    elif "function" in event_config:
-        f = partial(get_callable_from_string(event_config["function"]), **kwargs)
-    elif "method" in event_config:
-        f = partial(getattr(get_handler_object(event_config['method'][0]), event_config['method'][1]), **kwargs)
-    elif "process" in event_config:
-        f = partial(do_relaunch, event_config, **kwargs)
-    else:
-        raise AttributeError("%s have a class, method, function or command" % name)
-    
-    return f
-
-
-def get_mod_func(callback):
-    """Convert a fully-qualified module.function name to (module, function) - stolen from Django"""
-    try:
-        dot = callback.rindex('.')
-    except ValueError:
-        return (callback, '')
-    return (callback[:dot], callback[dot+1:])
-
-
-def get_callable_from_string(f_name):
-    """Takes a string containing a function name (optionally module qualified) and returns a callable object"""
-    try:
-        mod_name, func_name = get_mod_func(f_name)
-        if mod_name == "" and func_name == "":
-            raise AttributeError("%s couldn't be converted to a module or function name" % f_name)
-        
-        module = __import__(mod_name)
-        
-        if func_name == "":
-            func_name = mod_name # The common case is an eponymous class
-        
-        return getattr(module, func_name)
-    
-    except (ImportError, AttributeError), exc:
-        raise RuntimeError("Unable to create a callable object for '%s': %s" % (f_name, exc))
-
-
-def get_handler_object(class_name):
-    """Return a single instance of the given class name, instantiating it if necessary"""
-    
-    if class_name not in HANDLER_OBJECTS:
-        h_obj = get_callable_from_string(class_name)()
-        if isinstance(h_obj, BaseHandler):
-            pass # TODO: Do we even need BaseHandler any more?
-        HANDLER_OBJECTS[class_name] = h_obj
-    
-    return HANDLER_OBJECTS[class_name]
-
-
-def handle_sc_event(store, changed_keys, info):
-    """Fire every event handler for one or more events"""
-    
-    for key in changed_keys:
-        found_handler = False
-        
-        if key in EXPLICIT_SC_HANDLERS:
-            EXPLICIT_SC_HANDLERS[key](key=key, info=info)
-            found_handler = True
-        else:
-            for re_key in REGEXP_SC_HANDLERS:
-                if re_key.match(key):
-                    REGEXP_SC_HANDLERS[re_key](key=key, info=info, re_obj=re_key)
-                    found_handler = True
-        
-        if not found_handler:
-            logging.error("dropped SC event; no handler for %s" % (key,))
-
-
 def list_events(option, opt_str, value, parser):
     """Displays the list of events which can be monitored on the current system"""
+    from SystemConfiguration import SCDynamicStoreCopyKeyList
     
     print 'On this system SystemConfiguration supports these events:'
-    for event in sorted(SCDynamicStoreCopyKeyList(get_sc_store(), '.*')):
+    for event in sorted(SCDynamicStoreCopyKeyList(get_sc_store(None), '.*')):
         print "\t", event
     
     print
@@ -384,14 +386,44 @@ def process_commandline():
     parser.add_option("-f", "--config", dest="config_file", help='Use an alternate config file instead of %default', default=preference_file)
     parser.add_option("-l", "--list-events", action="callback", callback=list_events, help="List the events which can be monitored")
     parser.add_option("-d", "--debug", action="count", default=False, help="Log detailed progress information")
-    (options, args) = parser.parse_args()
+    parser.add_option("--watch-stdlib", action="store_true", default=False, help="Restart when standard library modules change as well as crankd and handler modules")
+    parser.add_option("--max-children", type="int", default=4, help="Run at most this many shell commands at once (default: %default)")
+    parser.add_option("--threaded", action="store_true", default=False, help="Run Python function and method handlers on worker threads unless they set main_thread")
+    parser.add_option("--threads", type="int", default=4, help="Run at most this many threaded handlers at once (default: %default)")
+    parser.add_option("--no-resume", dest="resume", action="store_false", default=True, help="Don't replay the filesystem changes made while crankd wasn't running")
+    parser.add_option("--record", metavar="FILE", help="Append every event to FILE for later replay")
+    parser.add_option("--replay", metavar="FILE", help="Replay the events recorded in FILE against the configuration, report statistics and exit")
+    parser.add_option("--rate", type="float", default=1.0, help="Replay speed relative to the recording: 0 replays as fast as possible (default: %default)")
+    parser.add_option("--metrics-socket", metavar="PATH", help="Serve handler metrics in the Prometheus text format on a UNIX socket at PATH")
+    parser.add_option("--profile", metavar="DIR", help="Profile every handler, writing pstats files to DIR (default: %s) on SIGUSR2 and exit" % DEFAULT_PROFILE_DIR)
+    parser.add_option("--profile-mode", choices=("cprofile", "sample"), default="cprofile", help="cprofile measures every call; sample samples the stacks of running handlers with little overhead (default: %default)")
+    parser.add_option("--sample-interval", type="float", default=0.01, help="Seconds between stack samples in --profile-mode=sample (default: %default)")
+    
+    # --profile's directory is optional, which optparse can't express:
+    argv = [ "--profile=%s" % DEFAULT_PROFILE_DIR if arg == "--profile" else arg for arg in sys.argv[1:] ]
+    (options, args) = parser.parse_args(argv)
     
     if len(args):
         parser.error("Unknown command-line arguments: %s" % args)
     
+    if options.threads < 1:
+        parser.error("--threads must be at least 1")
+    
+    if options.sample_interval <= 0:
+        parser.error("--sample-interval must be positive")
+    
     options.support_path = support_path
     options.config_file = os.path.realpath(options.config_file)
     
+    if options.record:
+        options.record = os.path.realpath(options.record)
+    
+    if options.metrics_socket:
+        options.metrics_socket = os.path.realpath(options.metrics_socket)
+    
+    if options.profile:
+        options.profile = os.path.realpath(options.profile)
+    
     # This is somewhat messy but we want to alter the command-line to use full
     # file paths in case someone's code changes the current directory or the
     sys.argv = [ os.path.realpath(sys.argv[0]), ]
@@ -404,56 +436,33 @@ def process_commandline():
         sys.argv.append("--config")
         sys.argv.append(options.config_file)
     
-    return options
-
-
-def load_config(options):
-    """Load our configuration from plist or create a default file if none exists"""
-    if not os.path.exists(options.config_file):
-        logging.info("%s does not exist - initializing with an example configuration" % CRANKD_OPTIONS.config_file)
-        print >>sys.stderr, 'Creating %s with default options for you to customize' % options.config_file
-        print >>sys.stderr, '%s --list-events will list the events you can monitor on this system' % sys.argv[0]
-        example_config = {
-            'SystemConfiguration': {
-                'State:/Network/Global/IPv4': {
-                    'command': '/bin/echo "Global IPv4 config changed"'
-                },
-                'regexp:State:/Network/Interface/([^/]+)/Link': {
-                    'command': '/bin/echo "Network interface link state changed"'
-                },
-            },
-            'NSWorkspace': {
-                'NSWorkspaceDidMountNotification': {
-                    'command': '/bin/echo "A new volume was mounted!"'
-                },
-                'NSWorkspaceDidWakeNotification': {
-                    'command': '/bin/echo "The system woke from sleep!"'
-                },
-                'NSWorkspaceWillSleepNotification': {
-                    'command': '/bin/echo "The system is about to go to sleep!"'
-                }
-            },
-            'NSNetService': {
-                '_ssh._tcp.': {
-                    'command': '/bin/echo "new ssh server seen!"'
-                }
-            }
-        }
-        writePlist(example_config, options.config_file)
-        sys.exit(1)
+    if options.watch_stdlib:
+        sys.argv.append("--watch-stdlib")
     
-    logging.info("Loading configuration from %s" % CRANKD_OPTIONS.config_file)
+    sys.argv.append("--max-children=%d" % options.max_children)
     
-    plist = readPlist(options.config_file)
+    if options.threaded:
+        sys.argv.append("--threaded")
     
-    if "imports" in plist:
-        for module in plist['imports']:
-            try:
-                __import__(module)
-            except ImportError, exc:
-                print >> sys.stderr, "Unable to import %s: %s" % (module, exc)
-                sys.exit(1)
-    return plist
+    sys.argv.append("--threads=%d" % options.threads)
+    
+    if not options.resume:
+        sys.argv.append("--no-resume")
+    
+    if options.record:
+        sys.argv.append("--record")
+        sys.argv.append(options.record)
+    
+    if options.metrics_socket:
+        sys.argv.append("--metrics-socket")
+        sys.argv.append(options.metrics_socket)
+    
+    if options.profile:
+        sys.argv.append("--profile=%s" % options.profile)
+        sys.argv.append("--profile-mode=%s" % options.profile_mode)
+        sys.argv.append("--sample-interval=%s" % options.sample_interval)
+    
+    return options
 
 
 def configure_logging():
@@ -470,105 +479,179 @@ def configure_logging():
     syslog = logging.handlers.SysLogHandler('/var/run/syslog')
     syslog.setFormatter(logging.Formatter('%(name)s: %(message)s'))
     syslog.setLevel(logging.INFO)
-    logging.getLogger().addHandler(syslog)
+    
+    # syslog() can block when syslogd is busy so records are written by a
+    # separate thread, which also collapses repeats and rate-limits loggers:
+    queue_handler = QueueHandler([ syslog ])
+    queue_handler.setLevel(logging.INFO)
+    logging.getLogger().addHandler(queue_handler)
 
 
-def get_sc_store():
+def get_sc_store(callback):
     """Returns an SCDynamicStore instance"""
-    return SCDynamicStoreCreate(None, "crankd", handle_sc_event, None)
+    from SystemConfiguration import SCDynamicStoreCreate
+    return SCDynamicStoreCreate(None, "crankd", callback, None)
 
 
-def add_workspace_notification(event, event_config, center):
-    if "class" in event_config:
-        obj         = get_handler_object(event_config['class'])
-        objc_method = "on%s:" % event
-        py_method   = objc_method.replace(":", "_")
+def add_class_observer(center, event, event_config, description):
+    """
+    Registers a "class" handler object with a notification center, returning
+    the observer which must be retained for as long as events are wanted
+    """
+    name        = "%s: %s" % (description, event)
+    objc_method = "on%s:" % event
+    py_method   = objc_method.replace(":", "_")
+    
+    def get_method():
+        obj = actions.get_handler_object(event_config['class'])
+        if not callable(getattr(obj, py_method, None)):
+            raise RuntimeError("%s: handler class %s must define a %s method" % (name, event_config['class'], py_method))
+        return getattr(obj, py_method)
+    
+    # The delegate's method is called through a proxy so it can be loaded on
+    # demand and measured like every other handler:
+    method       = actions.lazy(get_method, event_config)
+    delegate     = lambda event=None, user_info=None: method(event)
+    if actions.PROFILER is not None:
+        delegate = actions.PROFILER.wrap(delegate, name)
+    instrumented = METRICS.instrument(delegate, name)
+    
+    def call_method(event=None, user_info=None):
+        try:
+            instrumented(event=event, user_info=user_info)
+        except Exception:
+            logging.exception("%s: handler failed" % name)
+    
+    handler          = NSNotificationHandler.new()
+    handler.callable = call_method
+    
+    center.addObserver_selector_name_object_(handler, "onNotification:", event, None)
+    
+    return handler
+
+
+class NSWorkspaceSource(EventSource):
+    """NSWorkspace notifications: see http://developer.apple.com/documentation/Cocoa/Conceptual/Workspace/Workspace.html"""
+    
+    def __init__(self, name="NSWorkspace"):
+        from AppKit import NSWorkspace
         
-        if not hasattr(obj, py_method) or not callable(getattr(obj, py_method)):
-            print  >> sys.stderr, "NSWorkspace Notification %s: handler class %s must define a %s method" % (event, event_config['class'], py_method)
-            sys.exit(1)
+        super(NSWorkspaceSource, self).__init__(name)
+        self.center          = NSWorkspace.sharedWorkspace().notificationCenter()
+        self.observers       = dict()
+        self.class_observers = dict()
+    
+    def context(self, key):
+        return "NSWorkspace Notification %s" % key
+    
+    def add_handler(self, event, event_config):
+        if "class" in event_config:
+            observer = self.class_observers[event] = add_class_observer(self.center, event, event_config, "NSWorkspace Notification")
+            return observer
         
-        notification_center.addObserver_selector_name_object_(obj, objc_method, event, None)
-    else:
-        handler          = NSNotificationHandler.new()
-        handler.name     = "NSWorkspace Notification %s" % event
-        handler.callable = get_callable_for_event(event, event_config, context=handler.name)
+        # Every handler for the same notification shares a single observer:
+        if event not in self.handlers:
+            handler          = NSNotificationHandler.new()
+            handler.name     = self.context(event)
+            handler.callable = partial(self.emit, event)
+            
+            assert(callable(handler.onNotification_))
+            
+            self.observers[event] = handler
+            self.center.addObserver_selector_name_object_(handler, "onNotification:", event, None)
         
-        assert(callable(handler.onNotification_))
+        handler = actions.get_callable_for_event(event, event_config, context=self.context(event))
+        self.subscribe(event, handler)
+        return handler
+    
+    def unsubscribe(self, event, handler):
+        if self.class_observers.get(event) is handler:
+            self.center.removeObserver_(self.class_observers.pop(event))
+            return
         
-        center.addObserver_selector_name_object_(handler, "onNotification:", event, None)
+        super(NSWorkspaceSource, self).unsubscribe(event, handler)
+        
+        if event not in self.handlers:
+            self.center.removeObserver_(self.observers.pop(event))
+    
+    def start(self, loop):
+        log_list("Listening for these NSWorkspace notifications: %s", self.keys())
 
 
-def add_workspace_notifications(nsw_config):
-    # See http://developer.apple.com/documentation/Cocoa/Conceptual/Workspace/Workspace.html
-    notification_center = NSWorkspace.sharedWorkspace().notificationCenter()
+class NSDistributedSource(EventSource):
+    """NSDistributedNotificationCenter notifications; "*" will receive every notification"""
     
-    for event in nsw_config:
-        event_config = nsw_config[event]
-        add_workspace_notification(event, event_config, notification_center)
+    def __init__(self, name="NSDistributed"):
+        super(NSDistributedSource, self).__init__(name)
+        self.center          = NSDistributedNotificationCenter.defaultCenter()
+        self.observers       = dict()
+        self.class_observers = dict()
+        self.distributed_ids = dict()
+        self.relaunch_ids    = dict()     # event -> NSWorkspace handler which monitors its process
     
-    log_list("Listening for these NSWorkspace notifications: %s", nsw_config.keys())
-
-
-def add_distributed_notification(event, event_config, dist_center):
-    if "class" in event_config:
-        obj         = get_handler_object(event_config['class'])
-        objc_method = "on%s:" % event
-        py_method   = objc_method.replace(":", "_")
+    def context(self, key):
+        return "NSDistributed %s" % key
+    
+    def add_handler(self, event, event_config):
+        if "class" in event_config:
+            observer = self.class_observers[event] = add_class_observer(self.center, event, event_config, "NSDistributedNotification")
+            return observer
         
-        if not hasattr(obj, py_method) or not callable(getattr(obj, py_method)):
-            print >> sys.stderr, \
-                "NSDistributedNotification %s: handler class %s must define a %s method" % (event, event_config['class'], py_method)
-            sys.exit(1)
-            
-        dist_center.addObserver_selector_name_object_(obj, objc_method, event, None)
-    else:
-        shouldrm = False
-        process_event = {}
-        if not event in DISTRIBUTED_IDS:
-            DISTRIBUTED_IDS[event] = event_config
-            handler = NSNotificationHandler.new()
-            handler.name = "NSDistributed %s" % event
-            
-            if "process" in event_config:
-                notification_center = NSWorkspace.sharedWorkspace().notificationCenter()
-                process_event["process"] = event_config["process"]
-                process_event["event"] = event
-                process_event["event_config"] = event_config
-                
-                logging.info("Adding Process Monitor: %s" % process_event["process"])
-                
-                if not event in RELAUNCH_IDS:
-                    add_workspace_notification("NSWorkspaceDidLaunchApplicationNotification", process_event, notification_center)
-                    RELAUNCH_IDS[event] = process_event
-                else:
-                    shouldrm = True
-            
-            handler.callable = get_callable_for_event(event, event_config, context=handler.name)
-            
-            assert(callable(handler.onNotification_))
-            
-            event_name = event
-            if event == '*':
-                event_name = None
+        if event in self.distributed_ids:
+            return
+        
+        self.distributed_ids[event] = event_config
+        
+        handler          = NSNotificationHandler.new()
+        handler.name     = self.context(event)
+        handler.callable = partial(self.emit, event)
+        
+        event_name = event
+        if event == '*':
+            event_name = None
+        
+        if "process" in event_config:
+            logging.info("Adding Process Monitor: %s" % event_config["process"])
             
-            if not shouldrm:
-                dist_center.addObserver_selector_name_object_(handler, "onNotification:", event_name, None)
+            if not event in self.relaunch_ids:
+                process_event = {
+                    "process":      event_config["process"],
+                    "event":        event,
+                    "event_config": event_config,
+                }
+                self.relaunch_ids[event] = get_workspace_source().add_handler("NSWorkspaceDidLaunchApplicationNotification", process_event)
             else:
-                del DISTRIBUTED_IDS[event]
-                dist_center.removeObserver_name_object_(handler, "onNotification", event_name, None)
-
-
-def add_distributed_notifications(nsd_config):
-    dist_center = NSDistributedNotificationCenter.defaultCenter()
-    for event in nsd_config:
-        event_config = nsd_config[event]
-        add_distributed_notification(event, event_config, dist_center)
+                del self.distributed_ids[event]
+                self.center.removeObserver_name_object_(handler, "onNotification", event_name, None)
+                return
+        
+        assert(callable(handler.onNotification_))
+        
+        callback = actions.get_callable_for_event(event, event_config, context=handler.name)
+        self.subscribe(event, callback)
+        self.observers[event] = handler
+        self.center.addObserver_selector_name_object_(handler, "onNotification:", event_name, None)
+        return callback
+    
+    def unsubscribe(self, event, handler):
+        if self.class_observers.get(event) is handler:
+            self.center.removeObserver_(self.class_observers.pop(event))
+            return
+        
+        super(NSDistributedSource, self).unsubscribe(event, handler)
+        
+        if event not in self.handlers:
+            self.center.removeObserver_(self.observers.pop(event))
+            del self.distributed_ids[event]
+        
+        if event in self.relaunch_ids:
+            get_workspace_source().unsubscribe("NSWorkspaceDidLaunchApplicationNotification", self.relaunch_ids.pop(event))
     
-    log_list("Listening for these NSDistributedNotifications: %s", nsd_config.keys())
+    def start(self, loop):
+        log_list("Listening for these NSDistributedNotifications: %s", self.keys())
 
 
-def add_sc_notifications(sc_config):
+class CocoaSCSource(SystemConfigurationSource):
     """
     This uses the SystemConfiguration framework to get a SCDynamicStore session
     and register for certain events. See the Apple SystemConfiguration
@@ -583,124 +666,282 @@ def add_sc_notifications(sc_config):
     <https://svn.red-bean.com/pyobjc/trunk/pyobjc/pyobjc-framework-SystemConfiguration/Examples/CallbackDemo/>
     """
     
-    keys = sc_config.keys()
-    
-    regexp_sc_keys = []
-    try:
-        for key in keys:
-            handler = get_callable_for_event(key, sc_config[key], context="SystemConfiguration: %s" % key)
-            
-            if key.startswith("regexp:"):
-                # strip "regexp:"
-                re_key = key[7:]
-                REGEXP_SC_HANDLERS[re.compile(re_key)] = handler
-                regexp_sc_keys.append(re_key)
-            else:
-                EXPLICIT_SC_HANDLERS[key] = handler
-            
-    except AttributeError, exc:
-        print  >> sys.stderr, "Error configuring SystemConfiguration events: %s" % exc
-        sys.exit(1)
+    def start(self, loop):
+        from SystemConfiguration import SCDynamicStoreCreateRunLoopSource
+        
+        self.store = get_sc_store(self.handle_sc_event)
+        self.refresh(loop)
+        
+        # Get a CFRunLoopSource for our store session and add it to the application's runloop:
+        CFRunLoopAddSource(
+            NSRunLoop.currentRunLoop().getCFRunLoop(),
+            SCDynamicStoreCreateRunLoopSource(None, self.store, 0),
+            kCFRunLoopCommonModes
+        )
+        
+        log_list("Listening for these SystemConfiguration events: %s", self.keys())
     
-    store = get_sc_store()
-    SCDynamicStoreSetNotificationKeys(store, EXPLICIT_SC_HANDLERS.keys(), regexp_sc_keys)
+    def refresh(self, loop):
+        from SystemConfiguration import SCDynamicStoreSetNotificationKeys
+        SCDynamicStoreSetNotificationKeys(self.store, *self.notification_keys())
+        self.load_values()
     
-    # Get a CFRunLoopSource for our store session and add it to the application's runloop:
-    CFRunLoopAddSource(
-        NSRunLoop.currentRunLoop().getCFRunLoop(),
-        SCDynamicStoreCreateRunLoopSource(None, store, 0),
-        kCFRunLoopCommonModes
-    )
+    def copy_values(self, keys, patterns=()):
+        """Fetches every value in one round trip to configd"""
+        from SystemConfiguration import SCDynamicStoreCopyMultiple
+        values = SCDynamicStoreCopyMultiple(self.store, keys, patterns or None)
+        return dict(values) if values else dict()
     
-    log_list("Listening for these SystemConfiguration events: %s", keys)
+    def handle_sc_event(self, store, changed_keys, info):
+        """Fire every event handler for one or more events"""
+        self.emit_changes(list(changed_keys), info=info)
 
 
-def add_mdns_notifications(mdns_config):
-    for type_ in mdns_config:
+class NSNetServiceSource(NetServiceSource):
+    """Bonjour service announcements, keyed by service type"""
+    
+    def __init__(self, name="NSNetService"):
+        super(NSNetServiceSource, self).__init__(name)
+        self.browsers  = dict()
+        self.searching = set()
+    
+    def add_handler(self, type_, event_config):
+        handler = super(NSNetServiceSource, self).add_handler(type_, event_config)
         browser = MDNSBrowser.new()
-        browser.callable = get_callable_for_event(type_, mdns_config[type_], context="NSNetServiceBrowser type: %s" % type_)
-        browser.search(type_)
-        MDNS_BROWSERS[type_] = browser
-
-
-def add_cl_notifications(cl_config):
-    for conf in cl_config:
-        manager = LocationDelegate.new()
-        manager.callable = get_callable_for_event(conf, cl_config[conf], context="CLCoreLocation")
-        manager.start_manager()
-        CL_HANDLERS.append(manager)
-
-
-def add_fs_notifications(fs_config):
-    for path in fs_config:
-        add_fs_notification(path, get_callable_for_event(path, fs_config[path], context="FSEvent: %s" % path))
-
-
-def add_fs_notification(f_path, callback):
-    """Adds an FSEvent notification for the specified path"""
-    path = os.path.realpath(os.path.expanduser(f_path))
-    if not os.path.exists(path):
-        raise AttributeError("Cannot add an FSEvent notification: %s does not exist!" % path)
+        browser.source = self
+        self.browsers[type_] = browser
+        return handler
     
-    if not os.path.isdir(path):
-        path = os.path.dirname(path)
+    def unsubscribe(self, type_, handler):
+        super(NSNetServiceSource, self).unsubscribe(type_, handler)
+        if type_ not in self.handlers:
+            browser = self.browsers.pop(type_)
+            if type_ in self.searching:
+                browser.browser.stop()
+                self.searching.remove(type_)
     
-    try:
-        FS_WATCHED_FILES[path].append(callback)
-    except KeyError:
-        FS_WATCHED_FILES[path] = [callback]
+    def resolve_service(self, type_, key, service):
+        self.browsers[type_].resolve(service)
+    
+    def start(self, loop):
+        for type_, browser in self.browsers.items():
+            if type_ not in self.searching:
+                browser.search(type_)
+                self.searching.add(type_)
+    
+    refresh = start
 
 
-def start_fs_events():
-    stream_ref = FSEventStreamCreate(
-        None,                               # Use the default CFAllocator
-        fsevent_callback,
-        None,                               # We don't need a FSEventStreamContext
-        FS_WATCHED_FILES.keys(),
-        kFSEventStreamEventIdSinceNow,      # We only want events which happen in the future
-        1.0,                                # Process events within 1 second
-        0                                   # We don't need any special flags for our stream
-    )
+class CLLocationSource(LocationSource):
+    """CoreLocation updates"""
     
-    if not stream_ref:
-        raise RuntimeError("FSEventStreamCreate() failed!")
+    def __init__(self, name="CLLocation"):
+        super(CLLocationSource, self).__init__(name)
+        self.managers = dict()
+        self.updating = set()
     
-    FSEventStreamScheduleWithRunLoop(stream_ref, NSRunLoop.currentRunLoop().getCFRunLoop(), kCFRunLoopDefaultMode)
+    def add_handler(self, conf, event_config):
+        handler = super(CLLocationSource, self).add_handler(conf, event_config)
+        manager = LocationDelegate.new()
+        manager.callable = partial(self.location_updated, conf)
+        self.managers[conf] = manager
+        return handler
+    
+    def unsubscribe(self, conf, handler):
+        super(CLLocationSource, self).unsubscribe(conf, handler)
+        if conf not in self.handlers:
+            manager = self.managers.pop(conf)
+            if conf in self.updating:
+                manager.manager.stopUpdatingLocation()
+                self.updating.remove(conf)
     
-    if not FSEventStreamStart(stream_ref):
-        raise RuntimeError("Unable to start FSEvent stream!")
+    def start(self, loop):
+        for conf, manager in self.managers.items():
+            if conf not in self.updating:
+                thresholds = self.thresholds.get(conf, {})
+                manager.start_manager(thresholds.get('min_distance'), thresholds.get('accuracy'))
+                self.updating.add(conf)
     
-    logging.debug("FSEventStream started for %d paths: %s" % (len(FS_WATCHED_FILES), ", ".join(FS_WATCHED_FILES)))
+    refresh = start
 
 
-def fsevent_callback(stream_ref, full_path, event_count, paths, masks, ids):
-    """Process an FSEvent (consult the Cocoa docs) and call each of our handlers which monitors that path or a parent"""
-    for i in range(event_count):
-        path = os.path.dirname(paths[i])
+class CocoaFSEventsSource(FileSystemSource):
+    """
+    Filesystem changes reported by an FSEventStream
+    
+    If checkpoint is set the stream resumes from the last event dispatched
+    before crankd restarted (or the stream was replaced) and handlers receive
+    the FSEvents ID of each event as event_id. Roots whose history can't be
+    replayed get a single rescan event instead.
+    """
+    
+    def __init__(self, name=None):
+        super(CocoaFSEventsSource, self).__init__(name)
+        self.checkpoint = None
+        self.stream_ref = None
+    
+    def history_ids(self, paths):
+        """Returns the FSEvents database UUID for the volume containing each path"""
+        from Foundation import CFUUIDCreateString
+        from FSEvents import FSEventsCopyUUIDForDevice
         
-        if masks[i] & kFSEventStreamEventFlagMustScanSubDirs:
-            recursive = True
+        ids = dict()
+        for path in paths:
+            try:
+                uuid = FSEventsCopyUUIDForDevice(os.stat(path).st_dev)
+            except OSError:
+                uuid = None
+            ids[path] = CFUUIDCreateString(None, uuid) if uuid else None
+        return ids
+    
+    def start(self, loop):
+        from FSEvents import FSEventsGetCurrentEventId
         
-        if masks[i] & kFSEventStreamEventFlagUserDropped:
-            logging.error("We were too slow processing FSEvents and some events were dropped")
-            recursive = True
+        since_when = kFSEventStreamEventIdSinceNow      # Only events which happen in the future
+        rescan     = list()
         
-        if masks[i] & kFSEventStreamEventFlagKernelDropped:
-            logging.error("The kernel was too slow processing FSEvents and some events were dropped!")
-            recursive = True
-        else:
-            recursive = False
+        if self.checkpoint is not None:
+            if self.record_dispatched not in self.dispatcher.event_hooks:
+                self.dispatcher.event_hooks.append(self.record_dispatched)
+            self.checkpoint.pending = self.lowest_queued_id
+            
+            current_id = FSEventsGetCurrentEventId()
+            roots      = self.history_ids(self.paths())
+            event_id, rescan = self.checkpoint.resume(roots)
+            
+            if event_id is None:
+                event_id = current_id
+            elif event_id > current_id:
+                # The saved ID is from before the IDs wrapped around:
+                rescan   = [ path for path in self.paths() if path in self.checkpoint.roots ]
+                event_id = current_id
+            else:
+                logging.info("Resuming FSEvents after event %d" % event_id)
+                since_when = event_id
+            
+            self.checkpoint.reset(event_id, roots)
+        
+        stream_ref = FSEventStreamCreate(
+            None,                               # Use the default CFAllocator
+            self.fsevent_callback,
+            None,                               # We don't need a FSEventStreamContext
+            self.paths(),
+            since_when,
+            1.0,                                # Process events within 1 second
+            0                                   # We don't need any special flags for our stream
+        )
+        
+        if not stream_ref:
+            raise RuntimeError("FSEventStreamCreate() failed!")
+        
+        FSEventStreamScheduleWithRunLoop(stream_ref, NSRunLoop.currentRunLoop().getCFRunLoop(), kCFRunLoopDefaultMode)
+        
+        if not FSEventStreamStart(stream_ref):
+            raise RuntimeError("Unable to start FSEvent stream!")
         
-        for i in [k for k in FS_WATCHED_FILES if path.startswith(k)]:
-            logging.debug("FSEvent: %s: processing %d callback(s) for path %s" % (i, len(FS_WATCHED_FILES[i]), path))
-            for j in FS_WATCHED_FILES[i]:
-                j(i, path=path, recursive=recursive)
+        self.stream_ref   = stream_ref
+        self.stream_paths = set(self.paths())
+        
+        logging.debug("FSEventStream started for %d paths: %s" % (len(self.watches), ", ".join(self.paths())))
+        
+        self.rescan_roots(rescan, "their event history is not available")
+    
+    def rescan_roots(self, roots, reason):
+        """Sends one recursive rescan event for each root"""
+        for root in roots:
+            logging.warning("FSEvents: rescanning %s: %s" % (root, reason))
+            self.emit(root, path=root, recursive=True, rescan=True)
+    
+    def record_dispatched(self, event):
+        """
+        Dispatcher event hook: advances the checkpoint as our events are dispatched
+
+        Events only name a directory, so changes in the checkpoint's own
+        directory are ignored: saving the checkpoint would otherwise report
+        a change which schedules the next save, forever. They are replayed
+        after a restart unless a later event has moved the checkpoint on.
+        """
+        if event.source != self.name or 'event_id' not in event.payload:
+            return
+        if event.key == os.path.dirname(os.path.realpath(self.checkpoint.file_name)):
+            return
+        self.checkpoint.update(event.payload['event_id'])
+    
+    def lowest_queued_id(self):
+        """Returns the lowest event ID waiting in our queue, or None"""
+        queue = self.queue
+        if queue is None:
+            return None
+        ids = [ e.payload['event_id'] for e in queue.rescans.values() + list(queue.events) if 'event_id' in e.payload ]
+        return min(ids) if ids else None
+    
+    def stop(self):
+        FSEventStreamStop(self.stream_ref)
+        FSEventStreamInvalidate(self.stream_ref)
+        FSEventStreamRelease(self.stream_ref)
+        self.stream_ref = None
+    
+    def refresh(self, loop):
+        """Streams cannot be changed once they have been created so we replace ours if the watched paths changed"""
+        if set(self.paths()) != self.stream_paths:
+            self.stop()
+            self.start(loop)
+    
+    def fsevent_callback(self, stream_ref, full_path, event_count, paths, masks, ids):
+        """Process an FSEvent (consult the Cocoa docs) and call each of our handlers which monitors that path or a parent"""
+        for i in range(event_count):
+            if masks[i] & kFSEventStreamEventFlagHistoryDone:
+                logging.debug("FSEvents: finished replaying events up to %d" % ids[i])
+                continue
+            
+            if masks[i] & kFSEventStreamEventFlagEventIdsWrapped:
+                # Every saved ID is now meaningless:
+                if self.checkpoint is not None:
+                    self.checkpoint.reset(ids[i])
+                self.rescan_roots(self.paths(), "FSEvents event IDs wrapped around")
+                continue
+            
+            path      = os.path.dirname(paths[i])
+            recursive = False
+            
+            if masks[i] & kFSEventStreamEventFlagMustScanSubDirs:
+                recursive = True
+            
+            if masks[i] & kFSEventStreamEventFlagUserDropped:
+                self.os_dropped += 1
+                queue = self.queue
+                logging.error("We were too slow processing FSEvents and some events were dropped (%d queued, high-water mark %d)" % (
+                    len(queue) if queue is not None else 0, queue.high_water if queue is not None else 0
+                ))
+                recursive = True
             
+            if masks[i] & kFSEventStreamEventFlagKernelDropped:
+                self.os_dropped += 1
+                logging.error("The kernel was too slow processing FSEvents and some events were dropped!")
+                recursive = True
+            
+            self.emit(path, path=path, recursive=recursive, event_id=ids[i])
+
+
+def get_workspace_source():
+    """Returns the NSWorkspace source, which process monitors need even if there is no NSWorkspace section"""
+    if "NSWorkspace" not in DISPATCHER.sources:
+        source = DISPATCHER.add_source(NSWorkspaceSource())
+        if DISPATCHER.loop is not None:
+            source.start(DISPATCHER.loop)
+    return DISPATCHER.sources["NSWorkspace"]
 
 
-def timer_callback(*args):
-    """Handles the timer events which we use simply to have the runloop run regularly. Currently this logs a timestamp for debugging purposes"""
-    logging.debug("timer callback at %s" % datetime.now())
+# Event sources for each configuration section:
+EVENT_SOURCES = {
+    'NSDistributed':       NSDistributedSource,
+    'NSWorkspace':         NSWorkspaceSource,
+    'SystemConfiguration': CocoaSCSource,
+    'FSEvents':            CocoaFSEventsSource,
+    'NSNetService':        NSNetServiceSource,
+    'CLLocation':          CLLocationSource,
+    'Timers':              TimerSource,
+}
 
 
 def main():
@@ -708,74 +949,96 @@ def main():
     
     global CRANKD_OPTIONS, CRANKD_CONFIG
     
+    loop = actions.EVENT_LOOP = CocoaEventLoop()
+    
     CRANKD_OPTIONS = process_commandline()
-    CRANKD_CONFIG  = load_config(CRANKD_OPTIONS)
+    CRANKD_CONFIG  = load_config(CRANKD_OPTIONS.config_file)
     
-    if "NSDistributed" in CRANKD_CONFIG:
-        add_distributed_notifications(CRANKD_CONFIG["NSDistributed"])
+    actions.THREADED_DEFAULT = CRANKD_OPTIONS.threaded
     
-    if "NSWorkspace" in CRANKD_CONFIG:
-        add_workspace_notifications(CRANKD_CONFIG['NSWorkspace'])
+    if CRANKD_OPTIONS.replay:
+        for line in replay(CRANKD_CONFIG, CRANKD_OPTIONS.replay, rate=CRANKD_OPTIONS.rate, max_children=CRANKD_OPTIONS.max_children, max_workers=CRANKD_OPTIONS.threads):
+            print line
+        sys.exit(0)
     
-    if "SystemConfiguration" in CRANKD_CONFIG:
-        add_sc_notifications(CRANKD_CONFIG['SystemConfiguration'])
+    if CRANKD_OPTIONS.record:
+        DISPATCHER.event_hooks.append(EventRecorder(CRANKD_OPTIONS.record))
     
-    if "FSEvents" in CRANKD_CONFIG:
-        add_fs_notifications(CRANKD_CONFIG['FSEvents'])
+    if CRANKD_OPTIONS.profile:
+        if CRANKD_OPTIONS.profile_mode == "sample":
+            actions.PROFILER = SamplingProfiler(CRANKD_OPTIONS.profile, CRANKD_OPTIONS.sample_interval)
+        else:
+            actions.PROFILER = Profiler(CRANKD_OPTIONS.profile)
+        logging.info("Profiling handlers (%s); send SIGUSR2 to write the profiles to %s" % (CRANKD_OPTIONS.profile_mode, CRANKD_OPTIONS.profile))
     
-    if "NSNetService" in CRANKD_CONFIG:
-        add_mdns_notifications(CRANKD_CONFIG['NSNetService'])
+    actions.COMMAND_EXECUTOR = CommandExecutor(loop.call_later, max_children=CRANKD_OPTIONS.max_children)
+    actions.WORKER_POOL      = WorkerPool(CRANKD_OPTIONS.threads)
+    actions.WORKER_GROUPS    = WorkerGroups(loop)
+    actions.ACTIONS.append(('process', lambda event_config: partial(do_relaunch, event_config)))
     
-    if "CLLocation" in CRANKD_CONFIG:
-        add_cl_notifications(CRANKD_CONFIG['CLLocation'])
+    METRICS.dispatcher = DISPATCHER
+    METRICS.executor   = actions.COMMAND_EXECUTOR
+    METRICS.workers    = actions.WORKER_POOL
+    METRICS.groups     = actions.WORKER_GROUPS
+    actions.COMMAND_EXECUTOR.exit_hooks.append(METRICS.record_exit)
+    actions.WORKER_GROUPS.drop_hooks.append(METRICS.record_drop)
     
-    # We reuse our FSEvents code to watch for changes to our files and
-    # restart if any of our libraries have been updated:
-    add_conditional_restart(CRANKD_OPTIONS.config_file, "Configuration file %s changed" % CRANKD_OPTIONS.config_file)
-    for m in filter(lambda i: i and hasattr(i, '__file__'), sys.modules.values()):
-        if m.__name__ == "__main__":
-            msg = "%s was updated" % m.__file__
-        else:
-            msg = "Module %s was updated" % m.__name__
-        
-        add_conditional_restart(m.__file__, msg)
+    if CRANKD_OPTIONS.metrics_socket:
+        MetricsServer(METRICS, CRANKD_OPTIONS.metrics_socket, loop)
     
-    signal.signal(signal.SIGHUP, partial(restart, "SIGHUP received"))
+    # We always use FSEvents to watch for changes to our files:
+    fs_source = DISPATCHER.add_source(CocoaFSEventsSource())
+    if CRANKD_OPTIONS.resume:
+        fs_source.checkpoint = Checkpoint(CRANKD_OPTIONS.config_file + CHECKPOINT_SUFFIX, loop.call_later)
     
-    start_fs_events()
+    try:
+        configure_sources(DISPATCHER, CRANKD_CONFIG, EVENT_SOURCES)
+    except (AttributeError, RuntimeError), exc:
+        print >> sys.stderr, "Error configuring events: %s" % exc
+        sys.exit(1)
     
-    # NOTE: This timer is basically a kludge around the fact that we can't reliably get
-    #       signals or Control-C inside a runloop. This wakes us up often enough to
-    #       appear tolerably responsive:
-    CFRunLoopAddTimer(
-        NSRunLoop.currentRunLoop().getCFRunLoop(),
-        CFRunLoopTimerCreate(None, CFAbsoluteTimeGetCurrent(), 2.0, 0, 0, timer_callback, None),
-        kCFRunLoopCommonModes
-    )
+    # We reuse our FSEvents code to watch for changes to our files and
+    # restart if our configuration, crankd or a handler module has been
+    # updated. The standard library only changes with the OS:
+    restart_watch = RestartWatch(restart, exclude=[] if CRANKD_OPTIONS.watch_stdlib else None)
+    restart_watch.add(CRANKD_OPTIONS.config_file, "Configuration file %s changed" % CRANKD_OPTIONS.config_file, reload_config)
+    restart_watch.add_modules(filter(None, sys.modules.values()))
+    restart_watch.subscribe(DISPATCHER.sources["FSEvents"])
+    
+    # Handler modules are imported when they are first used and should be
+    # watched from then on. Threaded handlers are imported on a worker thread
+    # but the FSEvents stream belongs to the runloop:
+    def watch_new_modules():
+        fs_source = DISPATCHER.sources["FSEvents"]
+        if restart_watch.add_modules(filter(None, sys.modules.values())) and restart_watch.subscribe(fs_source):
+            fs_source.refresh(loop)
+    
+    loop.enable_wakeup()
+    actions.RESOLVE_HOOKS.append(lambda handler: loop.call_soon_threadsafe(watch_new_modules))
+    
+    # Signals wake the runloop immediately so there's no need to poll:
+    loop.add_signal_handler(signal.SIGCHLD, lambda signum: actions.COMMAND_EXECUTOR.reap())
+    loop.add_signal_handler(signal.SIGHUP, partial(reload_config, "SIGHUP received"))
+    loop.add_signal_handler(signal.SIGINT, lambda signum: loop.stop())
+    loop.add_signal_handler(signal.SIGTERM, lambda signum: loop.stop())
+    loop.add_signal_handler(signal.SIGUSR1, lambda signum: METRICS.log())
+    if actions.PROFILER is not None:
+        loop.add_signal_handler(signal.SIGUSR2, lambda signum: dump_profiles())
+    
+    DISPATCHER.start(loop)
     
     try:
-        AppHelper.runConsoleEventLoop(installInterrupt=True)
+        loop.run()
     except KeyboardInterrupt:
         logging.info("KeyboardInterrupt received, exiting")
     
+    actions.WORKER_POOL.shutdown(timeout=5.0)
+    actions.WORKER_GROUPS.shutdown(timeout=5.0)
+    flush_checkpoint()
+    dump_profiles()
     sys.exit(0)
 
 
-def create_env_name(name):
-    """
-    Converts input names into more traditional shell environment name style
-    
-    >>> create_env_name("NSApplicationBundleIdentifier")
-    'NSAPPLICATION_BUNDLE_IDENTIFIER'
-    >>> create_env_name("NSApplicationBundleIdentifier-1234$foobar!")
-    'NSAPPLICATION_BUNDLE_IDENTIFIER_1234_FOOBAR'
-    """
-    new_name = re.sub(r'''(?<=[a-z])([A-Z])''', '_\\1', name)
-    new_name = re.sub(r'\W+', '_', new_name)
-    new_name = re.sub(r'_{2,}', '_', new_name)
-    return new_name.upper().strip("_")
-
-
 # distnot patch: handles the reloading of the event in question, this will be called on *every*
 #        ApplicationLaunch event but only reloads events if it has a 'process' config option
 def do_relaunch(command, context=None, **kwargs):
@@ -788,63 +1051,59 @@ def do_relaunch(command, context=None, **kwargs):
         if 'NSApplicationName' in kwargs['user_info']:
             if kwargs['user_info']['NSApplicationName'] == event_config["process"]:
                 logging.info("%s: reloading handler %s" % (context, event))
-                dist_center = NSDistributedNotificationCenter.defaultCenter()
-                add_distributed_notification(event, event_config, dist_center)
+                DISPATCHER.sources["NSDistributed"].add_handler(event, event_config)
 
 
-def do_shell(command, context=None, **kwargs):
-    """Executes a shell command with logging"""
-    logging.info("%s: executing %s" % (context, command))
+def reload_config(reason, *args, **kwargs):
+    """Applies changes to the configuration file, restarting only if they can't be applied in place"""
+    global CRANKD_CONFIG
     
-    child_env = {'CRANKD_CONTEXT': context}
+    logging.info("Reloading configuration: %s" % reason)
     
-    # We'll pull a subset of the available information in for shell scripts.
-    # Anyone who needs more will probably want to write a Python handler
-    # instead so they can reuse things like our logger & config info and avoid
-    # ordeals like associative arrays in Bash
-    for k in [ 'info', 'key' ]:
-        if k in kwargs and kwargs[k]:
-            child_env['CRANKD_%s' % k.upper()] = str(kwargs[k])
+    try:
+        config = read_config(CRANKD_OPTIONS.config_file)
+    except Exception, exc:
+        logging.error("Unable to read %s; keeping the current configuration: %s" % (CRANKD_OPTIONS.config_file, exc))
+        return
     
-    if 'user_info' in kwargs:
-        for k, v in kwargs['user_info'].items():
-            child_env[create_env_name(k)] = str(v)
+    if config.get("imports") != CRANKD_CONFIG.get("imports"):
+        restart("%s: the list of imports changed" % reason)
     
     try:
-        rc = call(command, shell=True, env=child_env)
-        if rc == 0:
-            logging.debug("`%s` returned %d" % (command, rc))
-        elif rc < 0:
-            logging.error("`%s` was terminated by signal %d" % (command, -rc))
-        else:
-            logging.error("`%s` returned %d" % (command, rc))
-    except OSError, exc:
-        logging.error("Got an exception when executing %s:" % (command, exc))
+        reload_sources(DISPATCHER, config, EVENT_SOURCES)
+    except (AttributeError, RuntimeError, KeyError), exc:
+        restart("%s: unable to reload the configuration: %s" % (reason, exc))
+    
+    CRANKD_CONFIG = config
 
 
-def add_conditional_restart(file_name, reason):
-    """
-    FSEvents monitors directories, not files. This function uses stat to
-    restart only if the file's mtime has changed
-    """
-    file_name = os.path.realpath(file_name)
-    while not os.path.exists(file_name):
-        file_name = os.path.dirname(file_name)
-    orig_stat = os.stat(file_name).st_mtime
-    
-    def cond_restart(*args, **kwargs):
-        try:
-            if os.stat(file_name).st_mtime != orig_stat:
-                restart(reason)
-        except (OSError, IOError, RuntimeError), exc:
-            restart("Exception while checking %s: %s" % (file_name, exc))
-    
-    add_fs_notification(file_name, cond_restart)
+def flush_checkpoint():
+    """Saves the FSEvents position so the events after it are replayed when we start again"""
+    fs_source = DISPATCHER.sources.get("FSEvents")
+    if fs_source is not None and fs_source.checkpoint is not None:
+        fs_source.checkpoint.flush()
+
+
+def dump_profiles():
+    """Writes the handler profiles, if --profile is in use"""
+    if actions.PROFILER is None:
+        return
+    try:
+        actions.PROFILER.dump()
+    except (IOError, OSError), exc:
+        logging.error("Unable to write profiles to %s: %s" % (actions.PROFILER.directory, exc))
 
 
 def restart(reason, *args, **kwargs):
     """Perform a complete restart of the current process using exec()"""
     logging.info("Restarting: %s" % reason)
+    if actions.WORKER_POOL is not None:
+        actions.WORKER_POOL.shutdown(timeout=5.0)
+    if actions.WORKER_GROUPS is not None:
+        actions.WORKER_GROUPS.shutdown(timeout=5.0)
+    flush_checkpoint()
+    dump_profiles()
+    logging.shutdown()      # Writes any queued log messages
     os.execv(sys.argv[0], sys.argv)
 
 if __name__ == '__main__':
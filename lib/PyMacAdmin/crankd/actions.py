@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Creates the callables which crankd runs when an event occurs
+
+Each event configuration names one action:
+
+command:      a shell command
+function:     the name of a python function
+method:       (class, method) tuple; the class will be instantiated once
+
+Python handlers are imported (and classes instantiated) when their first
+event arrives so modules which are never needed are never loaded. Set
+preload to true in an event's configuration to resolve its handler at
+startup instead, which also reports a bad name before any event is missed.
+
+function and method handlers run on the event loop unless threaded is true,
+in which case they run on WORKER_POOL (see PyMacAdmin.crankd.workers);
+main_thread keeps a handler on the event loop when THREADED_DEFAULT is set.
+Handlers which set worker_group run in that group's process, managed by
+WORKER_GROUPS (see PyMacAdmin.crankd.processes).
+
+A handler with a match dictionary is only called for events which satisfy
+its conditions (see PyMacAdmin.crankd.predicates).
+
+Platform code may append additional actions to ACTIONS.
+"""
+
+import logging
+import re
+import sys
+import threading
+from functools import partial
+
+from .coalesce import Debouncer, get_debounce_settings
+from .metrics import METRICS
+from .predicates import MatchingHandler, Predicate
+from .ratelimit import RateLimiter, get_rate_limit_settings
+from .workers import ThreadedHandler
+
+EVENT_LOOP       = None     # The EventLoop used for timers
+COMMAND_EXECUTOR = None     # Runs "command" handlers without blocking the event loop
+WORKER_POOL      = None     # Runs threaded Python handlers
+WORKER_GROUPS    = None     # Runs Python handlers which set worker_group in separate processes
+THREADED_DEFAULT = False    # Run Python handlers on WORKER_POOL unless they set main_thread
+PROFILER         = None     # Profiles every handler when set (see PyMacAdmin.crankd.profiler)
+THREADED_ACTIONS = ( 'function', 'method' )
+HANDLER_OBJECTS  = dict()   # Events which have a "class" handler use an instantiated object; we want to load only one copy
+RESOLVE_HOOKS    = list()   # Called with each LazyHandler once it has loaded its handler, possibly on a worker thread
+RESOLVE_LOCK     = threading.RLock()
+
+
+def get_callable_for_event(name, event_config, context=None):
+    """
+        Returns a callable object which can be used as a callback for any
+        event. The returned function has context information, logging, etc.
+        included so they do not need to be passed when the actual event
+        occurs.
+
+        NOTE: This function does not process "class" handlers - by design they
+        are passed to the system libraries which expect a delegate object with
+        various event handling methods
+    """
+
+    kwargs = {
+        'context':  context,
+        'key':      name,
+        'config':   event_config,
+    }
+
+    for action, factory in ACTIONS:
+        if action in event_config:
+            break
+    else:
+        raise AttributeError("%s have a class, method, function or command" % name)
+
+    if action in THREADED_ACTIONS and event_config.get('worker_group'):
+        f = WORKER_GROUPS.handler(event_config['worker_group'], name, event_config, context)
+    else:
+        f = partial(factory(event_config), **kwargs)
+
+    if PROFILER is not None:
+        f = PROFILER.wrap(f, context or name)
+
+    f = METRICS.instrument(f, context or name)
+
+    if action in THREADED_ACTIONS and is_threaded(event_config):
+        f = ThreadedHandler(f, WORKER_POOL, context or name)
+
+    if 'rate_limit' in event_config:
+        f = RateLimiter(f, EVENT_LOOP.call_later, clock=EVENT_LOOP.time, name=context or name, **get_rate_limit_settings(name, event_config['rate_limit']))
+        METRICS.handler(context or name).limiters.append(f)
+
+    debounce, coalesce = get_debounce_settings(name, event_config)
+    if debounce is not None or coalesce is not None:
+        f = Debouncer(f, EVENT_LOOP.call_later, debounce=debounce, coalesce=coalesce, name=context or name)
+        METRICS.handler(context or name).debouncers.append(f)
+
+    # Events which don't match are discarded before any other work is done:
+    if 'match' in event_config:
+        f = MatchingHandler(f, Predicate(name, event_config['match']), name, METRICS.handler(context or name))
+
+    return f
+
+
+def is_threaded(event_config):
+    """Returns True if a Python handler should run on the worker pool"""
+    if event_config.get('main_thread') or event_config.get('worker_group'):
+        return False
+    return bool(event_config.get('threaded', THREADED_DEFAULT))
+
+
+class LazyHandler(object):
+    """Calls resolve() to find the real handler the first time it is called"""
+
+    def __init__(self, resolve):
+        self.resolve = resolve
+        self.target  = None
+
+    def __call__(self, *args, **kwargs):
+        if self.target is None:
+            # Threaded handlers may be called for the first time on two
+            # threads at once and must not import or instantiate twice:
+            with RESOLVE_LOCK:
+                if self.target is None:
+                    self.target = self.resolve()
+                    for hook in RESOLVE_HOOKS:
+                        hook(self)
+        return self.target(*args, **kwargs)
+
+
+def lazy(resolve, event_config):
+    """Returns resolve() if the event should be preloaded, otherwise a LazyHandler"""
+    if event_config.get('preload'):
+        return resolve()
+    return LazyHandler(resolve)
+
+
+def get_mod_func(callback):
+    """Convert a fully-qualified module.function name to (module, function) - stolen from Django"""
+    try:
+        dot = callback.rindex('.')
+    except ValueError:
+        return (callback, '')
+    return (callback[:dot], callback[dot+1:])
+
+
+def get_callable_from_string(f_name):
+    """Takes a string containing a function name (optionally module qualified) and returns a callable object"""
+    try:
+        mod_name, func_name = get_mod_func(f_name)
+        if mod_name == "" and func_name == "":
+            raise AttributeError("%s couldn't be converted to a module or function name" % f_name)
+
+        # __import__ returns the top-level package for dotted names:
+        __import__(mod_name)
+        module = sys.modules[mod_name]
+
+        if func_name == "":
+            func_name = mod_name # The common case is an eponymous class
+
+        return getattr(module, func_name)
+
+    except (ImportError, AttributeError), exc:
+        raise RuntimeError("Unable to create a callable object for '%s': %s" % (f_name, exc))
+
+
+def get_handler_object(class_name):
+    """Return a single instance of the given class name, instantiating it if necessary"""
+
+    if class_name not in HANDLER_OBJECTS:
+        HANDLER_OBJECTS[class_name] = get_callable_from_string(class_name)()
+
+    return HANDLER_OBJECTS[class_name]
+
+
+def get_method(class_name, method_name):
+    """Returns the named method of the shared instance of class_name"""
+    try:
+        return getattr(get_handler_object(class_name), method_name)
+    except AttributeError, exc:
+        raise RuntimeError("Unable to find method %s of %s: %s" % (method_name, class_name, exc))
+
+
+def create_env_name(name):
+    """
+    Converts input names into more traditional shell environment name style
+
+    >>> create_env_name("NSApplicationBundleIdentifier")
+    'NSAPPLICATION_BUNDLE_IDENTIFIER'
+    >>> create_env_name("NSApplicationBundleIdentifier-1234$foobar!")
+    'NSAPPLICATION_BUNDLE_IDENTIFIER_1234_FOOBAR'
+    """
+    new_name = re.sub(r'''(?<=[a-z])([A-Z])''', '_\\1', name)
+    new_name = re.sub(r'\W+', '_', new_name)
+    new_name = re.sub(r'_{2,}', '_', new_name)
+    return new_name.upper().strip("_")
+
+
+def do_shell(command, *args, **kwargs):
+    """Queues a shell command for asynchronous execution with logging"""
+    # FSEvents handlers also receive the watched path as an argument, which
+    # commands don't need:
+    context   = kwargs.get('context')
+    child_env = {'CRANKD_CONTEXT': context}
+
+    # We'll pull a subset of the available information in for shell scripts.
+    # Anyone who needs more will probably want to write a Python handler
+    # instead so they can reuse things like our logger & config info and avoid
+    # ordeals like associative arrays in Bash
+    for k in [ 'info', 'key', 'path', 'event_count', 'rescan' ]:
+        if k in kwargs and kwargs[k]:
+            child_env['CRANKD_%s' % k.upper()] = str(kwargs[k])
+
+    # Coalesced events list every key or path, one per line:
+    for k in [ 'keys', 'paths' ]:
+        if k in kwargs and kwargs[k]:
+            child_env['CRANKD_%s' % k.upper()] = "\n".join(map(str, kwargs[k]))
+
+    if 'user_info' in kwargs and kwargs['user_info']:
+        for k, v in kwargs['user_info'].items():
+            child_env[create_env_name(k)] = str(v)
+
+    event_config = kwargs.get('config') or {}
+
+    COMMAND_EXECUTOR.submit(
+        command,
+        env=child_env,
+        context=context,
+        limit=event_config.get('max_children', 1),
+        timeout=event_config.get('timeout')
+    )
+
+
+# (configuration key, factory) pairs in order of precedence: each factory
+# receives the event configuration and returns the callable to use
+ACTIONS = [
+    ('command',  lambda event_config: partial(do_shell, event_config['command'])),
+    ('function', lambda event_config: lazy(partial(get_callable_from_string, event_config['function']), event_config)),
+    ('method',   lambda event_config: lazy(partial(get_method, *event_config['method']), event_config)),
+]
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Persists the position of an event stream so crankd can resume after a restart
+
+FSEvents numbers every event and can replay the events since a given ID, so
+a restart need not lose the changes made while crankd was exec()ing or
+force handlers to rescan everything to be safe. A Checkpoint records the
+latest event ID which has been dispatched along with an identifier for the
+event history of each watched root (the FSEvents database UUID of its
+volume); if a volume's history has been replaced the saved ID means nothing
+there and the root has to be rescanned instead.
+
+Dispatching events is far more frequent than it is useful to write to disk,
+so updates are written at most once every interval seconds, and only if the
+position has moved. flush() writes immediately and should be called before
+restarting.
+
+Events can be dispatched out of order - a coalescing queue delivers a key's
+latest event from the place of its first - so the saved position is the
+highest ID dispatched but never beyond the lowest ID still waiting: if
+pending is set it must return the lowest event ID which has been reported but
+not yet dispatched, or None. A restart may therefore replay a few events which
+were already dispatched but never skips one which wasn't.
+"""
+
+import json
+import logging
+import os
+
+CHECKPOINT_SUFFIX  = ".fsevents"
+CHECKPOINT_VERSION = 1
+
+
+class Checkpoint(object):
+    """
+    The saved position of one event stream
+
+    call_later(delay, callback) must schedule callback on the event loop and
+    return an object with a cancel() method.
+    """
+
+    def __init__(self, file_name, call_later, interval=5.0):
+        self.file_name  = file_name
+        self.call_later = call_later
+        self.interval   = interval
+        self.timer      = None
+        self.pending    = None
+        self.written    = None
+        self.writes     = 0
+
+        saved           = self.load()
+        self.event_id   = saved.get('event_id')
+        self.roots      = saved.get('roots', {})     # watched path -> history identifier
+        self.written    = (self.event_id, dict(self.roots)) if saved else None
+
+    def load(self):
+        """Returns the saved checkpoint or an empty dict if there is no usable checkpoint"""
+        try:
+            with open(self.file_name) as f:
+                saved = json.load(f)
+            if saved.get('version') == CHECKPOINT_VERSION and isinstance(saved.get('event_id'), (int, long)):
+                return saved
+            logging.warning("Ignoring the checkpoint in %s: it has an unknown format" % self.file_name)
+        except IOError:
+            pass
+        except (ValueError, AttributeError), exc:
+            logging.warning("Ignoring the checkpoint in %s: %s" % (self.file_name, exc))
+        return dict()
+
+    def resume(self, roots):
+        """
+        Returns (event ID, roots to rescan) for a stream watching roots, a
+        { path: history identifier } dict. The ID is None if the stream can't
+        resume; roots which weren't watched before don't need a rescan.
+        """
+        if self.event_id is None:
+            return None, []
+        rescan = [ path for path, history in sorted(roots.items()) if path in self.roots and self.roots[path] != history ]
+        return self.event_id, rescan
+
+    def position(self):
+        """Returns the ID up to which every event has been dispatched"""
+        event_id = self.event_id
+        if event_id is not None and self.pending is not None:
+            pending = self.pending()
+            if pending is not None and pending <= event_id:
+                event_id = pending - 1
+        return event_id
+
+    def update(self, event_id):
+        """Records that event_id has been dispatched"""
+        if self.event_id is not None and event_id <= self.event_id:
+            return
+        self.event_id = event_id
+        self.schedule()
+
+    def reset(self, event_id, roots=None):
+        """Replaces the saved position, e.g. when a stream starts afresh or its IDs wrap around"""
+        self.event_id = event_id
+        if roots is not None:
+            self.roots = dict(roots)
+        self.schedule()
+
+    def schedule(self):
+        if self.timer is None:
+            self.timer = self.call_later(self.interval, self.write)
+
+    def write(self):
+        """Writes the checkpoint; called by the timer"""
+        self.timer = None
+        event_id   = self.position()
+        if event_id is None or (event_id, self.roots) == self.written:
+            return
+
+        try:
+            # Write to a temporary file so a partial checkpoint is never read:
+            with open(self.file_name + ".tmp", 'w') as f:
+                json.dump({ 'version': CHECKPOINT_VERSION, 'event_id': event_id, 'roots': self.roots }, f)
+            os.rename(self.file_name + ".tmp", self.file_name)
+        except (IOError, OSError), exc:
+            logging.error("Unable to save the event checkpoint to %s: %s" % (self.file_name, exc))
+            return
+
+        self.written = (event_id, dict(self.roots))
+        self.writes += 1
+
+    def flush(self):
+        """Writes any pending update immediately"""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.write()
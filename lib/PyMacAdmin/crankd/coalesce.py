@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Debouncing and coalescing of bursty events
+
+Many events arrive in bursts - a single Wi-Fi roam changes the global IPv4,
+DNS and proxy keys along with several interface keys within a few
+milliseconds. An event configuration may contain these optional settings to
+collapse such a burst into a single handler invocation:
+
+debounce:     call the handler once no event has arrived for this many seconds
+coalesce:     call the handler no later than this many seconds after the first
+              event in a burst, even if events are still arriving. If debounce
+              is not set, every burst is simply collected for this long.
+
+The handler is called with the arguments of the last event plus:
+
+keys:         every distinct key reported during the burst, in arrival order
+paths:        every distinct path reported during the burst, in arrival order
+event_count:  the number of raw events absorbed by this invocation
+
+"recursive" is true if it was set for any event in the burst.
+"""
+
+import logging
+import time
+
+
+def get_debounce_settings(name, event_config):
+    """Returns a validated (debounce, coalesce) tuple from an event config; either may be None"""
+    settings = list()
+    for k in ('debounce', 'coalesce'):
+        v = event_config.get(k)
+        if v is not None:
+            try:
+                v = float(v)
+            except (TypeError, ValueError):
+                raise AttributeError("%s: %s must be a number of seconds, not %r" % (name, k, v))
+            if v < 0:
+                raise AttributeError("%s: %s must not be negative" % (name, k))
+        settings.append(v)
+    return tuple(settings)
+
+
+class Debouncer(object):
+    """
+    Wraps a callable so bursts of calls result in a single delayed call
+
+    call_later(delay, callback) must schedule callback to be called on the
+    event loop after delay seconds and return an object with a cancel() method.
+    """
+
+    def __init__(self, callback, call_later, debounce=None, coalesce=None, name=None, clock=time.time):
+        if debounce is None and coalesce is None:
+            raise ValueError("Debouncer requires a debounce or coalesce period")
+
+        self.callback    = callback
+        self.call_later  = call_later
+        self.debounce    = debounce
+        self.coalesce    = coalesce
+        self.name        = name
+        self.clock       = clock
+
+        self.timer       = None
+
+        # Counters:
+        self.events      = 0
+        self.invocations = 0
+        self.absorbed    = 0     # Raw events absorbed by the most recent invocation
+        self.failures    = 0     # Invocations which raised an exception
+
+        self.reset()
+
+    def reset(self):
+        """Discards the state for the current burst"""
+        self.pending     = 0
+        self.args        = ()
+        self.kwargs      = {}
+        self.keys        = list()
+        self.paths       = list()
+        self.seen        = set()    # (kwarg name, value) pairs already in keys or paths
+        self.recursive   = False
+        self.first_event = None
+        self.deadline    = None
+
+    def __call__(self, *args, **kwargs):
+        now = self.clock()
+
+        self.events  += 1
+        self.pending += 1
+        self.args     = args
+        self.kwargs   = kwargs
+
+        for name, values in (('key', self.keys), ('path', self.paths)):
+            v = kwargs.get(name)
+            if v is not None and (name, v) not in self.seen:
+                self.seen.add((name, v))
+                values.append(v)
+
+        if kwargs.get('recursive'):
+            self.recursive = True
+
+        if self.first_event is None:
+            self.first_event = now
+
+        if self.debounce is not None:
+            deadline = now + self.debounce
+        else:
+            deadline = self.first_event + self.coalesce
+
+        if self.coalesce is not None:
+            deadline = min(deadline, self.first_event + self.coalesce)
+
+        self.deadline = deadline
+
+        # Rather than rescheduling for every event in a burst, an existing
+        # timer will check the deadline when it fires and reschedule itself:
+        if self.timer is None:
+            self.timer = self.call_later(max(0, deadline - now), self.fire)
+
+    def fire(self):
+        """Called by the timer: invokes the callback if the deadline has passed"""
+        self.timer = None
+
+        if not self.pending:
+            return
+
+        remaining = self.deadline - self.clock()
+        if remaining > 0.001:
+            self.timer = self.call_later(remaining, self.fire)
+            return
+
+        self.flush()
+
+    def flush(self):
+        """Immediately invokes the callback for any pending events"""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        if not self.pending:
+            return
+
+        args   = self.args
+        kwargs = dict(self.kwargs)
+
+        if self.keys:
+            kwargs['keys'] = self.keys
+        if self.paths:
+            kwargs['paths'] = self.paths
+        if 'recursive' in kwargs:
+            kwargs['recursive'] = self.recursive
+        kwargs['event_count'] = self.pending
+
+        self.invocations += 1
+        self.absorbed     = self.pending
+
+        logging.debug("%s: coalesced %d event(s) into one call (%d events, %d calls total)" % (
+            self.name, self.absorbed, self.events, self.invocations
+        ))
+
+        self.reset()
+
+        # We're called from a timer, where an exception would stop the event loop:
+        try:
+            self.callback(*args, **kwargs)
+        except Exception:
+            self.failures += 1
+            logging.exception("%s: debounced call failed" % self.name)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Cocoa event loop backend for crankd
+
+Timers and file descriptors are added to the current CFRunLoop so they are
+processed along with the SystemConfiguration, FSEvents and NSNotification
+sources which the Mac frameworks schedule there.
+
+Only Foundation is needed: AppKit is loaded later if an event source
+requires it.
+"""
+
+import logging
+
+from Foundation import \
+    CFAbsoluteTimeGetCurrent, \
+    CFFileDescriptorCreate, \
+    CFFileDescriptorCreateRunLoopSource, \
+    CFFileDescriptorEnableCallBacks, \
+    CFFileDescriptorInvalidate, \
+    CFRunLoopAddSource, \
+    CFRunLoopAddTimer, \
+    CFRunLoopRun, \
+    CFRunLoopStop, \
+    CFRunLoopTimerCreate, \
+    CFRunLoopTimerInvalidate, \
+    NSRunLoop, \
+    kCFFileDescriptorReadCallBack, \
+    kCFFileDescriptorWriteCallBack, \
+    kCFRunLoopCommonModes
+
+from .loop import EventLoop
+
+
+class RunLoopTimer(object):
+    """A one-shot CFRunLoopTimer which calls callback after delay seconds"""
+
+    def __init__(self, delay, callback):
+        self.callback = callback
+        self.timer    = CFRunLoopTimerCreate(None, CFAbsoluteTimeGetCurrent() + delay, 0, 0, 0, self.fire, None)
+        CFRunLoopAddTimer(NSRunLoop.currentRunLoop().getCFRunLoop(), self.timer, kCFRunLoopCommonModes)
+
+    def fire(self, timer, info):
+        # An exception must not escape into the CFRunLoop:
+        try:
+            self.callback()
+        except Exception:
+            logging.exception("Timer callback %r failed" % self.callback)
+
+    def cancel(self):
+        CFRunLoopTimerInvalidate(self.timer)
+
+
+class RunLoopReader(object):
+    """Calls callback from the runloop whenever a file descriptor is readable"""
+
+    callback_type = kCFFileDescriptorReadCallBack
+
+    def __init__(self, fd, callback):
+        self.callback  = callback
+        self.cancelled = False
+        self.fd_ref    = CFFileDescriptorCreate(None, fd, False, self.fire, None)
+        CFFileDescriptorEnableCallBacks(self.fd_ref, self.callback_type)
+        CFRunLoopAddSource(
+            NSRunLoop.currentRunLoop().getCFRunLoop(),
+            CFFileDescriptorCreateRunLoopSource(None, self.fd_ref, 0),
+            kCFRunLoopCommonModes
+        )
+
+    def fire(self, fd_ref, callback_types, info):
+        try:
+            self.callback()
+        except Exception:
+            logging.exception("Descriptor callback %r failed" % self.callback)
+        # CFFileDescriptor callbacks are one-shot and must be re-enabled:
+        if not self.cancelled:
+            CFFileDescriptorEnableCallBacks(self.fd_ref, self.callback_type)
+
+    def cancel(self):
+        self.cancelled = True
+        CFFileDescriptorInvalidate(self.fd_ref)
+
+
+class RunLoopWriter(RunLoopReader):
+    """Calls callback from the runloop whenever a file descriptor is writable"""
+
+    callback_type = kCFFileDescriptorWriteCallBack
+
+
+class CocoaEventLoop(EventLoop):
+    """Runs crankd using the current thread's CFRunLoop"""
+
+    def call_later(self, delay, callback):
+        return RunLoopTimer(delay, callback)
+
+    def add_reader(self, fd, callback):
+        return RunLoopReader(fd, callback)
+
+    def add_writer(self, fd, callback):
+        return RunLoopWriter(fd, callback)
+
+    def run(self):
+        # Signals are delivered through our wakeup pipe, which also keeps the
+        # runloop from returning for lack of sources, so a plain CFRunLoopRun
+        # is all we need:
+        self.run_loop = NSRunLoop.currentRunLoop().getCFRunLoop()
+        CFRunLoopRun()
+
+    def stop(self):
+        CFRunLoopStop(self.run_loop)
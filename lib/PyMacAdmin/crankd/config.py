@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Loads the crankd configuration and creates the event sources it describes
+
+The configuration file is divided into sections for each class of events.
+Each section is a dictionary using the event condition as the key and the
+event configuration (see PyMacAdmin.crankd.actions) as the value.
+
+A running configuration can be replaced with reload_sources(), which only
+touches the entries which were added, removed or changed. The optional Queues
+section sets the size and overflow policy of each source's event queue (see
+PyMacAdmin.crankd.queues).
+
+Parsing and validating the XML plist is the slowest part of starting crankd
+so the validated configuration is compiled into a cache file next to the
+configuration file (see CACHE_SUFFIX). The cache is keyed by the file's
+mtime, size and SHA-1 and by a hash of the code which validates it, so
+upgrading crankd never reuses a configuration checked by older rules. The
+cache uses marshal, which is not safe against malicious data, so a cache is
+only read if it belongs to the owner of the configuration file and nobody
+else can write to it.
+"""
+
+import hashlib
+import logging
+import marshal
+import os
+import re
+import stat
+import sys
+from plistlib import readPlistFromString, writePlist
+
+from . import actions, coalesce, predicates, queues, ratelimit, sources, timers
+from .coalesce import get_debounce_settings
+from .predicates import Predicate
+from .queues import get_queue_settings
+from .ratelimit import get_rate_limit_settings
+from .sources import get_location_settings, get_resolve_ttl
+from .timers import get_timer_schedule
+
+# Event sections in the order they are configured:
+SECTIONS = ( 'NSDistributed', 'NSWorkspace', 'SystemConfiguration', 'FSEvents', 'NSNetService', 'CLLocation', 'Timers' )
+
+# Every event must have one of these keys:
+ACTION_KEYS = ( 'command', 'function', 'class', 'method', 'process' )
+
+CACHE_SUFFIX  = ".cache"
+CACHE_VERSION = 2               # The layout of the cache file
+
+# The modules whose code decides whether a configuration is valid:
+VALIDATOR_MODULES = ( sys.modules[__name__], actions, coalesce, predicates, queues, ratelimit, sources, timers )
+VALIDATOR_HASH    = None
+
+EXAMPLE_CONFIG = {
+    'SystemConfiguration': {
+        'State:/Network/Global/IPv4': {
+            'command': '/bin/echo "Global IPv4 config changed"'
+        },
+        'regexp:State:/Network/Interface/([^/]+)/Link': {
+            'command': '/bin/echo "Network interface link state changed"'
+        },
+    },
+    'NSWorkspace': {
+        'NSWorkspaceDidMountNotification': {
+            'command': '/bin/echo "A new volume was mounted!"'
+        },
+        'NSWorkspaceDidWakeNotification': {
+            'command': '/bin/echo "The system woke from sleep!"'
+        },
+        'NSWorkspaceWillSleepNotification': {
+            'command': '/bin/echo "The system is about to go to sleep!"'
+        }
+    },
+    'NSNetService': {
+        '_ssh._tcp.': {
+            'command': '/bin/echo "new ssh server seen!"'
+        }
+    }
+}
+
+
+def normalize(value):
+    """Converts plistlib containers to plain dicts and lists"""
+    if isinstance(value, dict):
+        return dict((k, normalize(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [ normalize(v) for v in value ]
+    return value
+
+
+def compile_config(plist):
+    """
+    Validates a configuration and returns it using plain dicts and lists;
+    raises AttributeError if the configuration is invalid
+    """
+    config = normalize(plist)
+
+    for section in SECTIONS:
+        if not isinstance(config.get(section, {}), dict):
+            raise AttributeError("%s must be a dictionary of events" % section)
+
+        for key, event_config in config.get(section, {}).items():
+            name = "%s %s" % (section, key)
+
+            if not isinstance(event_config, dict) or not any(k in event_config for k in ACTION_KEYS):
+                raise AttributeError("%s must have a %s" % (name, ", ".join(ACTION_KEYS)))
+
+            get_debounce_settings(name, event_config)
+
+            if 'rate_limit' in event_config:
+                get_rate_limit_settings(name, event_config['rate_limit'])
+
+            if event_config.get('threaded') and event_config.get('main_thread'):
+                raise AttributeError("%s: threaded and main_thread cannot both be set" % name)
+
+            if 'worker_group' in event_config:
+                if not isinstance(event_config['worker_group'], basestring) or not event_config['worker_group']:
+                    raise AttributeError("%s: worker_group must be the name of a group" % name)
+                if not any(k in event_config for k in actions.THREADED_ACTIONS):
+                    raise AttributeError("%s: only function and method handlers can use a worker_group" % name)
+                if event_config.get('threaded') or event_config.get('main_thread'):
+                    raise AttributeError("%s: worker_group cannot be combined with threaded or main_thread" % name)
+
+            for k in ('batch', 'only_if_changed'):
+                if event_config.get(k) and section != 'SystemConfiguration':
+                    raise AttributeError("%s: %s is only supported for SystemConfiguration events" % (name, k))
+
+            if 'resolve_ttl' in event_config:
+                if section != 'NSNetService':
+                    raise AttributeError("%s: resolve_ttl is only supported for NSNetService events" % name)
+                get_resolve_ttl(name, event_config)
+
+            if 'match' in event_config:
+                if 'class' in event_config:
+                    raise AttributeError("%s: match is not supported for class handlers" % name)
+                Predicate(name, event_config['match'])
+
+            if section == 'CLLocation':
+                get_location_settings(name, event_config)
+
+            if section == 'Timers':
+                get_timer_schedule(name, event_config)
+
+            if 'method' in event_config and len(event_config['method']) != 2:
+                raise AttributeError("%s: method must be a (class, method) pair" % name)
+
+    if not isinstance(config.get('Queues', {}), dict):
+        raise AttributeError("Queues must be a dictionary of event sections")
+
+    for section, settings in config.get('Queues', {}).items():
+        get_queue_settings(section, settings)
+
+    for key in config.get('SystemConfiguration', {}):
+        if key.startswith("regexp:"):
+            try:
+                re.compile(key[len("regexp:"):])
+            except re.error, exc:
+                raise AttributeError("SystemConfiguration %s is not a valid regular expression: %s" % (key, exc))
+
+    return config
+
+
+def validator_hash():
+    """Returns a hash of the code in VALIDATOR_MODULES, which is part of each cache's signature"""
+    global VALIDATOR_HASH
+
+    if VALIDATOR_HASH is None:
+        digest = hashlib.sha1()
+        for module in VALIDATOR_MODULES:
+            # Hash the source rather than the .pyc, which isn't always rewritten:
+            file_name = re.sub(r'\.py[co]$', '.py', module.__file__)
+            try:
+                with open(file_name, 'rb') as f:
+                    digest.update(f.read())
+            except IOError:
+                digest.update(module.__name__)
+        VALIDATOR_HASH = digest.hexdigest()
+
+    return VALIDATOR_HASH
+
+
+def read_config(config_file):
+    """
+    Returns the validated configuration in config_file, using the cache when
+    it matches the file and updating it when it does not
+    """
+    with open(config_file, 'rb') as f:
+        data = f.read()
+        st   = os.fstat(f.fileno())
+
+    signature  = [ CACHE_VERSION, validator_hash(), st.st_mtime, st.st_size, hashlib.sha1(data).hexdigest() ]
+    cache_file = config_file + CACHE_SUFFIX
+
+    try:
+        with open(cache_file, 'rb') as f:
+            cache_st = os.fstat(f.fileno())
+            # marshal can crash the interpreter on crafted data, so only trust
+            # a cache which only we or the configuration's owner could write:
+            if cache_st.st_uid not in (st.st_uid, os.getuid()) or cache_st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+                logging.warning("Ignoring %s: it could have been written by someone other than the owner of %s" % (cache_file, config_file))
+                raise ValueError(cache_file)
+            cached = marshal.load(f)
+        if cached['signature'] == signature:
+            logging.debug("Using the compiled configuration in %s" % cache_file)
+            return cached['compiled']
+    except (IOError, EOFError, ValueError, TypeError, KeyError):
+        pass
+
+    config = compile_config(readPlistFromString(data))
+
+    try:
+        # Write to a temporary file so a partial cache is never read:
+        with open(cache_file + ".tmp", 'wb') as f:
+            os.fchmod(f.fileno(), 0644)
+            marshal.dump({ 'signature': signature, 'compiled': config }, f)
+        os.rename(cache_file + ".tmp", cache_file)
+    except (IOError, OSError, ValueError), exc:
+        # ValueError: the configuration contains dates or data, which marshal can't store
+        logging.debug("Unable to cache the configuration in %s: %s" % (cache_file, exc))
+
+    return config
+
+
+def load_config(config_file):
+    """Load our configuration from plist or create a default file if none exists"""
+    if not os.path.exists(config_file):
+        logging.info("%s does not exist - initializing with an example configuration" % config_file)
+        print >>sys.stderr, 'Creating %s with default options for you to customize' % config_file
+        print >>sys.stderr, '%s --list-events will list the events you can monitor on this system' % sys.argv[0]
+        writePlist(EXAMPLE_CONFIG, config_file)
+        sys.exit(1)
+
+    logging.info("Loading configuration from %s" % config_file)
+
+    try:
+        plist = read_config(config_file)
+    except AttributeError, exc:
+        print >> sys.stderr, "Invalid configuration in %s: %s" % (config_file, exc)
+        sys.exit(1)
+
+    if "imports" in plist:
+        for module in plist['imports']:
+            try:
+                __import__(module)
+            except ImportError, exc:
+                print >> sys.stderr, "Unable to import %s: %s" % (module, exc)
+                sys.exit(1)
+    return plist
+
+
+def configure_sources(dispatcher, config, source_classes):
+    """
+    Creates an event source for each configured section and adds a handler
+    for each of its events. source_classes maps section names to EventSource
+    classes; sources which already exist in the dispatcher are reused.
+    """
+    for section in SECTIONS:
+        if section not in config:
+            continue
+
+        if section not in dispatcher.sources:
+            if section not in source_classes:
+                logging.error("Ignoring %s events: they are not supported on this platform" % section)
+                continue
+            dispatcher.add_source(source_classes[section](section))
+
+        source = dispatcher.sources[section]
+        for key, event_config in config[section].items():
+            source.configured[key] = (event_config, source.add_handler(key, event_config))
+
+    configure_queues(dispatcher, config)
+    return dispatcher
+
+
+def configure_queues(dispatcher, config):
+    """Applies the Queues section to every source, including those without a section of their own"""
+    queues = config.get('Queues', {})
+    for name, source in dispatcher.sources.items():
+        source.configure_queue(get_queue_settings(name, queues.get(name, {})))
+
+
+def reload_sources(dispatcher, config, source_classes):
+    """
+    Updates the sources configured by configure_sources() to match a new
+    configuration. Handlers for entries whose configuration is unchanged are
+    kept, along with any state they hold; running sources are refreshed once
+    all of their handlers have been updated. Returns a list of (section,
+    added, removed) tuples for each section which changed.
+    """
+    changes = list()
+
+    for section in SECTIONS:
+        new_section = config.get(section, {})
+        new_source  = section not in dispatcher.sources
+
+        if new_source:
+            if not new_section:
+                continue
+            if section not in source_classes:
+                logging.error("Ignoring %s events: they are not supported on this platform" % section)
+                continue
+            dispatcher.add_source(source_classes[section](section))
+
+        source     = dispatcher.sources[section]
+        configured = source.configured
+        removed    = [ k for k in configured if configured[k][0] != new_section.get(k) ]
+        added      = [ k for k in new_section if k not in configured or configured[k][0] != new_section[k] ]
+
+        if not added and not removed:
+            continue
+
+        for key in removed:
+            source.remove_handler(key)
+
+        for key in added:
+            source.configured[key] = (new_section[key], source.add_handler(key, new_section[key]))
+
+        if dispatcher.loop is not None:
+            if new_source:
+                source.start(dispatcher.loop)
+            else:
+                source.refresh(dispatcher.loop)
+
+        changed = set(added) & set(removed)
+        logging.info("Reloaded %s: %d added, %d changed, %d removed" % (
+            section, len(added) - len(changed), len(changed), len(removed) - len(changed)
+        ))
+        changes.append((section, added, removed))
+
+    configure_queues(dispatcher, config)
+    return changes
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Backend-independent event plumbing for crankd
+
+Each section of the crankd configuration is served by an EventSource. The
+source subscribes to the operating system (or generates synthetic events for
+testing) and emits Event objects; the Dispatcher asks the originating source
+which handlers are interested in the event and calls them. Once the
+dispatcher has started, events pass through a bounded EventQueue (see
+PyMacAdmin.crankd.queues) on their way to the dispatcher. Nothing here depends
+on Cocoa so the same dispatch path can run on any platform.
+"""
+
+import logging
+import time
+
+from . import actions
+from .queues import EventQueue
+from .ratelimit import RateLimiter
+
+
+class Event(object):
+    """
+    A single normalized event
+
+    source:     the name of the EventSource (i.e. configuration section)
+    key:        the key used to find handlers: a notification name, a
+                SystemConfiguration key, a filesystem path, etc.
+    payload:    keyword arguments passed to each handler
+    timestamp:  when the event was received
+    """
+    __slots__ = ('source', 'key', 'payload', 'timestamp')
+
+    def __init__(self, source, key, payload=None, timestamp=None):
+        self.source    = source
+        self.key       = key
+        self.payload   = payload if payload is not None else {}
+        self.timestamp = timestamp if timestamp is not None else time.time()
+
+    def __repr__(self):
+        return "Event(%r, %r, %r)" % (self.source, self.key, self.payload)
+
+
+class EventSource(object):
+    """
+    Base class for event sources
+
+    The default implementation routes events to handlers registered for
+    exactly the same key, which is what notification-style sources need.
+    Subclasses provide start() and stop() to manage their OS subscriptions,
+    and may override subscribe(), unsubscribe() and resolve() for other
+    routing schemes. Sources which can change their OS subscriptions while
+    running implement refresh(), which is called after a configuration reload
+    has added or removed handlers.
+
+    overflow is the default policy for the source's queue; sources which
+    support the coalesce policy override rescan_event() to describe what to
+    rescan when an event is lost. os_dropped counts events which the operating
+    system reported it had dropped before they reached us. limiter is the
+    source's RateLimiter, if the Queues section sets a rate_limit.
+    """
+    name     = None
+    overflow = 'drop-oldest'
+
+    def __init__(self, name=None):
+        if name is not None:
+            self.name = name
+        self.handlers   = dict()      # key -> [handler]
+        self.configured = dict()      # configuration key -> (event config, handler)
+        self.dispatcher = None
+        self.queue      = None        # Created by the first event after the dispatcher starts
+        self.settings   = dict()      # EventQueue settings from the Queues configuration section
+        self.rate_limit = None        # RateLimiter settings from the Queues configuration section
+        self.limiter    = None
+        self.os_dropped = 0
+
+    def context(self, key):
+        """Returns the context string passed to handlers for key"""
+        return "%s: %s" % (self.name, key)
+
+    def add_handler(self, key, event_config):
+        """Creates a handler for an entry in this source's configuration section"""
+        if "class" in event_config:
+            # Delegate objects are registered directly with the OS by
+            # platform-specific sources:
+            logging.warning("%s: %s does not support class handlers" % (self.context(key), self.__class__.__name__))
+            return None
+
+        handler = actions.get_callable_for_event(key, event_config, context=self.context(key))
+        self.subscribe(key, handler)
+        return handler
+
+    def remove_handler(self, key):
+        """Removes the handler created for a configuration entry, delivering any events it has held back"""
+        event_config, handler = self.configured.pop(key)
+        if handler is None:
+            return
+
+        self.unsubscribe(key, handler)
+
+        if hasattr(handler, 'flush'):
+            handler.flush()
+
+    def subscribe(self, key, handler):
+        """Routes events for key to handler"""
+        self.handlers.setdefault(key, list()).append(handler)
+
+    def unsubscribe(self, key, handler):
+        """Stops routing events for key to handler"""
+        handlers = self.handlers[key]
+        handlers.remove(handler)
+        if not handlers:
+            del self.handlers[key]
+
+    def keys(self):
+        """Returns the keys which have handlers"""
+        return self.handlers.keys()
+
+    def resolve(self, event):
+        """Returns a list of (handler, args, kwargs) for each handler which should receive event"""
+        return [ (h, (), {}) for h in self.handlers.get(event.key, ()) ]
+
+    def emit(self, event_key, **payload):
+        """Queues an event for the dispatcher; payload may include its own "key" argument for handlers"""
+        event = Event(self.name, event_key, payload)
+
+        if self.queue is None:
+            if self.dispatcher.loop is None:
+                # There's no event loop to drain a queue yet:
+                self.dispatcher.dispatch(event)
+                return
+            self.queue = self.create_queue(self.dispatcher.loop)
+
+        self.queue.put(event)
+
+    def create_queue(self, loop):
+        """Returns the EventQueue which holds events until the loop dispatches them"""
+        settings = dict(self.settings)
+        settings.setdefault('overflow', self.overflow)
+        return EventQueue(self.name, self.dispatcher.dispatch, loop.call_later, rescan=self.rescan_event, **settings)
+
+    def configure_queue(self, settings):
+        """Applies validated settings from the Queues configuration section"""
+        settings   = dict(settings)
+        rate_limit = settings.pop('rate_limit', None)
+
+        if rate_limit != self.rate_limit:
+            if self.limiter is not None:
+                self.limiter.flush()
+            self.rate_limit = rate_limit
+            self.limiter    = None
+            if rate_limit is not None:
+                self.limiter = RateLimiter(
+                    self.dispatcher.deliver, actions.EVENT_LOOP.call_later, clock=actions.EVENT_LOOP.time, name=self.name,
+                    key=lambda args, kwargs: args[0].key, **rate_limit
+                )
+
+        self.settings = settings
+        if self.queue is not None:
+            settings = dict(settings)
+            settings.setdefault('overflow', self.overflow)
+            self.queue.configure(**settings)
+
+    def rescan_event(self, event):
+        """Returns the event delivered in place of an event dropped from a coalescing queue"""
+        return Event(self.name, event.key, dict(event.payload, rescan=True), event.timestamp)
+
+    def start(self, loop):
+        """Starts delivering events; called once the dispatcher is ready"""
+        pass
+
+    def refresh(self, loop):
+        """Updates OS subscriptions to match the current handlers after start()"""
+        pass
+
+    def stop(self):
+        """Stops delivering events"""
+        pass
+
+
+class Dispatcher(object):
+    """
+    Delivers events from every source to the interested handlers
+
+    event_hooks are called with each event before it is dispatched and
+    handler_hooks are called with (event, handler, elapsed seconds, exception
+    or None) after each handler returns. Handlers are only timed when there is
+    at least one handler hook.
+    """
+
+    def __init__(self):
+        self.sources       = dict()     # name -> EventSource
+        self.loop          = None       # Set once the sources have been started
+        self.event_hooks   = list()
+        self.handler_hooks = list()
+        self.dispatched    = 0
+        self.unhandled     = 0
+        self.failures      = 0
+
+    def add_source(self, source):
+        """Registers source so its events can be dispatched"""
+        if source.name in self.sources:
+            raise KeyError("An event source named %s already exists" % source.name)
+        source.dispatcher = self
+        self.sources[source.name] = source
+        return source
+
+    def start(self, loop):
+        """Starts every source"""
+        self.loop = loop
+        for source in self.sources.values():
+            source.start(loop)
+
+    def stop(self):
+        """Stops every source"""
+        for source in self.sources.values():
+            source.stop()
+
+    def dispatch(self, event):
+        """Delivers event, subject to its source's rate limit"""
+        limiter = self.sources[event.source].limiter
+        if limiter is not None:
+            limiter(event)
+        else:
+            self.deliver(event)
+
+    def deliver(self, event):
+        """Calls every handler for event, logging any exception"""
+        self.dispatched += 1
+
+        for hook in self.event_hooks:
+            hook(event)
+
+        handlers = self.sources[event.source].resolve(event)
+
+        if not handlers:
+            self.unhandled += 1
+            logging.error("dropped %s event; no handler for %s" % (event.source, event.key))
+            return
+
+        for handler, args, kwargs in handlers:
+            if kwargs:
+                kwargs = dict(event.payload, **kwargs)
+            else:
+                kwargs = event.payload
+
+            if not self.handler_hooks:
+                try:
+                    handler(*args, **kwargs)
+                except Exception:
+                    self.failures += 1
+                    logging.exception("%s: handler for %s failed" % (event.source, event.key))
+                continue
+
+            error = None
+            start = time.time()
+            try:
+                handler(*args, **kwargs)
+            except Exception, error:
+                self.failures += 1
+                logging.exception("%s: handler for %s failed" % (event.source, event.key))
+            elapsed = time.time() - start
+
+            for hook in self.handler_hooks:
+                hook(event, handler, elapsed, error)
+
+
+def handler_name(handler):
+    """Returns a descriptive name for a handler created by get_callable_for_event or subscribe()"""
+    name = getattr(handler, 'name', None)
+    if name:
+        return name
+
+    keywords = getattr(handler, 'keywords', None)
+    if keywords and keywords.get('context'):
+        return keywords['context']
+
+    func = getattr(handler, 'func', handler)
+    return "%s.%s" % (getattr(func, '__module__', None) or '?', getattr(func, '__name__', None) or repr(func))
+
+
+def normalize(value):
+    """Converts an event payload value into something which can be stored as JSON"""
+    if value is None or isinstance(value, (bool, int, long, float, unicode)):
+        return value
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    if callable(getattr(value, 'userInfo', None)) and callable(getattr(value, 'name', None)):
+        return normalize(value.name())      # NSNotification
+    if hasattr(value, 'items'):
+        return dict((unicode(k), normalize(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)) or hasattr(value, 'objectEnumerator'):
+        return [ normalize(v) for v in value ]
+    return unicode(value)
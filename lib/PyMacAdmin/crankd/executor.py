@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Runs shell commands for crankd without blocking the event loop
+
+Commands are started with subprocess.Popen and reaped later, when the event
+loop notices SIGCHLD, so a slow script no longer delays every other event.
+The number of running children is limited both globally and per handler;
+commands which can't be started immediately wait in a FIFO queue.
+"""
+
+import logging
+import os
+import signal
+import time
+from collections import deque
+from subprocess import Popen
+
+
+class Child(object):
+    """A command which has been submitted to a CommandExecutor"""
+
+    def __init__(self, command, env, context, handler, limit, timeout):
+        self.command   = command
+        self.env       = env
+        self.context   = context
+        self.handler   = handler
+        self.limit     = limit
+        self.timeout   = timeout
+        self.process   = None
+        self.started   = None
+        self.timer     = None
+        self.killed    = False
+
+    @property
+    def pid(self):
+        return self.process.pid if self.process else None
+
+
+class CommandExecutor(object):
+    """
+    Launches shell commands asynchronously
+
+    call_later(delay, callback) must schedule callback on the event loop and
+    return an object with a cancel() method; it is used to enforce timeouts.
+    reap() must be called whenever a child may have exited, typically from a
+    SIGCHLD handler. exit_hooks are called with (child, exit status) for each
+    child which exits.
+    """
+
+    def __init__(self, call_later, max_children=4, kill_grace=5.0):
+        self.call_later   = call_later
+        self.max_children = max_children
+        self.kill_grace   = kill_grace
+        self.running      = dict()     # pid -> Child
+        self.pending      = deque()
+        self.per_handler  = dict()     # handler -> number of running children
+        self.exit_hooks   = list()
+
+    def submit(self, command, env=None, context=None, handler=None, limit=None, timeout=None):
+        """
+        Runs command as soon as the global and per-handler limits allow it
+
+        handler identifies the configuration entry for per-handler limits and
+        defaults to context; limit is the maximum number of concurrent
+        children for that handler (None for no per-handler limit) and timeout
+        is the number of seconds after which the child will be killed.
+        """
+        child = Child(command, env, context, handler or context, limit, timeout)
+
+        if self.can_start(child):
+            self.start(child)
+        else:
+            logging.debug("%s: queued %s (%d running, %d queued)" % (context, command, len(self.running), len(self.pending) + 1))
+            self.pending.append(child)
+
+        return child
+
+    def can_start(self, child):
+        """Returns True if child can be started without exceeding either limit"""
+        if len(self.running) >= self.max_children:
+            return False
+        if child.limit is not None and self.per_handler.get(child.handler, 0) >= child.limit:
+            return False
+        return True
+
+    def start(self, child):
+        """Launches child's command in a new process group"""
+        logging.info("%s: executing %s" % (child.context, child.command))
+
+        try:
+            child.process = Popen(child.command, shell=True, env=child.env, close_fds=True, preexec_fn=os.setsid)
+        except OSError, exc:
+            logging.error("Got an exception when executing %s: %s" % (child.command, exc))
+            return
+
+        child.started = time.time()
+        self.running[child.pid] = child
+        self.per_handler[child.handler] = self.per_handler.get(child.handler, 0) + 1
+
+        if child.timeout:
+            child.timer = self.call_later(child.timeout, lambda: self.expire(child))
+
+    def expire(self, child):
+        """Terminates a child which has exceeded its timeout, escalating to SIGKILL after kill_grace seconds"""
+        child.timer = None
+
+        if child.pid not in self.running:
+            return
+
+        if not child.killed:
+            logging.error("`%s` exceeded its %ss timeout: sending SIGTERM" % (child.command, child.timeout))
+            child.killed = True
+            self.kill(child, signal.SIGTERM)
+            child.timer = self.call_later(self.kill_grace, lambda: self.expire(child))
+        else:
+            logging.error("`%s` ignored SIGTERM: sending SIGKILL" % child.command)
+            self.kill(child, signal.SIGKILL)
+
+    def kill(self, child, sig):
+        """Sends sig to child's entire process group"""
+        try:
+            os.killpg(child.pid, sig)
+        except OSError, exc:
+            logging.debug("Unable to send signal %d to %d: %s" % (sig, child.pid, exc))
+
+    def reap(self):
+        """Collects the exit status of finished children and starts any queued commands"""
+        for pid, child in self.running.items():
+            rc = child.process.poll()
+            if rc is None:
+                continue
+
+            del self.running[pid]
+            self.per_handler[child.handler] -= 1
+            if not self.per_handler[child.handler]:
+                del self.per_handler[child.handler]
+
+            if child.timer is not None:
+                child.timer.cancel()
+                child.timer = None
+
+            self.log_exit(child, rc)
+
+            for hook in self.exit_hooks:
+                hook(child, rc)
+
+        self.start_pending()
+
+    def start_pending(self):
+        """Starts queued commands in order, skipping those whose handler is at its limit"""
+        if not self.pending or len(self.running) >= self.max_children:
+            return
+
+        waiting = deque()
+        while self.pending and len(self.running) < self.max_children:
+            child = self.pending.popleft()
+            if self.can_start(child):
+                self.start(child)
+            else:
+                waiting.append(child)
+
+        waiting.extend(self.pending)
+        self.pending = waiting
+
+    def log_exit(self, child, rc):
+        """Logs the exit status of a child"""
+        elapsed = time.time() - child.started
+
+        if rc == 0:
+            logging.debug("`%s` returned %d after %0.3fs" % (child.command, rc, elapsed))
+        elif rc < 0:
+            logging.error("`%s` was terminated by signal %d after %0.3fs" % (child.command, -rc, elapsed))
+        else:
+            logging.error("`%s` returned %d after %0.3fs" % (child.command, rc, elapsed))
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Finds the geofence regions which contain a location
+
+CLLocation entries may list circular regions (a centre and a radius in
+metres) and only want to hear about entering and leaving them. Measuring the
+distance to every region on each location update gets expensive with
+hundreds of regions, so the RegionIndex divides the globe into a grid of
+cells of cell_size degrees and lists each region in every cell its bounding
+box overlaps: a location is looked up in a single cell and only the regions
+listed there are measured.
+"""
+
+import math
+
+EARTH_RADIUS      = 6371008.8                           # Mean radius, in metres
+METERS_PER_DEGREE = EARTH_RADIUS * math.pi / 180        # Along a meridian
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """Returns the great-circle distance in metres between two points, using the haversine formula"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi      = phi2 - phi1
+    d_lambda   = math.radians(lon2 - lon1)
+
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+class Region(object):
+    """A circular region: radius metres around (latitude, longitude)"""
+
+    __slots__ = ('name', 'latitude', 'longitude', 'radius')
+
+    def __init__(self, name, latitude, longitude, radius):
+        self.name      = name
+        self.latitude  = latitude
+        self.longitude = longitude
+        self.radius    = radius
+
+    def __repr__(self):
+        return "Region(%r, %r, %r, %r)" % (self.name, self.latitude, self.longitude, self.radius)
+
+    def contains(self, latitude, longitude):
+        return distance(self.latitude, self.longitude, latitude, longitude) <= self.radius
+
+
+class RegionIndex(object):
+    """A uniform latitude/longitude grid of the regions which might contain each cell's points"""
+
+    def __init__(self, cell_size=0.05):
+        self.cell_size = cell_size
+        self.columns   = int(math.ceil(360.0 / cell_size))
+        self.cells     = dict()         # (row, column) -> [Region]
+        self.regions   = dict()         # name -> (Region, [cell])
+
+    def __len__(self):
+        return len(self.regions)
+
+    def __iter__(self):
+        return (region for region, cells in self.regions.values())
+
+    def row(self, latitude):
+        return int(math.floor((max(-90.0, min(90.0, latitude)) + 90.0) / self.cell_size))
+
+    def column(self, longitude):
+        return int(math.floor((longitude + 180.0) / self.cell_size)) % self.columns
+
+    def covered_cells(self, region):
+        """Returns every cell overlapped by region's bounding box"""
+        d_lat = region.radius / METERS_PER_DEGREE
+        north = region.latitude + d_lat
+        south = region.latitude - d_lat
+        rows  = range(self.row(south), self.row(north) + 1)
+
+        # A degree of longitude shrinks towards the poles; a region which
+        # reaches a pole, or is wider than half the globe, needs every column:
+        widest = max(abs(north), abs(south))
+        if widest >= 90.0:
+            columns = range(self.columns)
+        else:
+            d_lon = d_lat / math.cos(math.radians(widest))
+            if d_lon >= 180.0:
+                columns = range(self.columns)
+            else:
+                first   = int(math.floor((region.longitude - d_lon + 180.0) / self.cell_size))
+                last    = int(math.floor((region.longitude + d_lon + 180.0) / self.cell_size))
+                columns = sorted(set(c % self.columns for c in range(first, last + 1)))
+
+        return [ (r, c) for r in rows for c in columns ]
+
+    def add(self, region):
+        """Adds region, replacing any region with the same name"""
+        if region.name in self.regions:
+            self.remove(region.name)
+
+        cells = self.covered_cells(region)
+        for cell in cells:
+            self.cells.setdefault(cell, list()).append(region)
+        self.regions[region.name] = (region, cells)
+
+    def remove(self, name):
+        region, cells = self.regions.pop(name)
+        for cell in cells:
+            listed = self.cells[cell]
+            listed.remove(region)
+            if not listed:
+                del self.cells[cell]
+
+    def containing(self, latitude, longitude):
+        """Returns the names of the regions which contain the point"""
+        candidates = self.cells.get((self.row(latitude), self.column(longitude)), ())
+        return set(r.name for r in candidates if r.contains(latitude, longitude))
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Linux inotify backend for the FSEvents configuration section
+
+InotifySource serves the same configuration entries and calls handlers with
+the same path=/recursive= arguments as the FSEvents stream used on the Mac,
+so filesystem handlers can run on Linux build and test hosts:
+
+    - inotify only watches single directories, so every directory below a
+      watched path gets its own watch; directories which are created or
+      moved in later are watched as soon as they appear
+    - changes are reported for the directory which contains them and are
+      batched for latency seconds (1 by default, as FSEvents is), with each
+      directory reported once per batch
+    - a new directory, or an overflow of the kernel's event queue
+      (IN_Q_OVERFLOW), is reported with recursive=True since events below it
+      may have been missed
+    - a watched path which doesn't exist, or is moved or deleted, is checked
+      for every retry_interval seconds (and whenever a directory appears in
+      its watched parent) and reported with recursive=True once it is back
+
+Run "python -m PyMacAdmin.crankd.inotify [config file]" to serve the FSEvents
+section of a crankd configuration with a SelectEventLoop; other sections are
+reported as unsupported.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import signal
+import struct
+import sys
+from collections import OrderedDict
+
+from . import actions
+from .config import configure_sources, load_config
+from .events import Dispatcher
+from .executor import CommandExecutor
+from .loop import SelectEventLoop
+from .processes import WorkerGroups
+from .sources import FileSystemSource
+from .workers import WorkerPool
+
+# From <sys/inotify.h>:
+IN_MODIFY        = 0x00000002
+IN_ATTRIB        = 0x00000004
+IN_CLOSE_WRITE   = 0x00000008
+IN_MOVED_FROM    = 0x00000040
+IN_MOVED_TO      = 0x00000080
+IN_CREATE        = 0x00000100
+IN_DELETE        = 0x00000200
+IN_DELETE_SELF   = 0x00000400
+IN_MOVE_SELF     = 0x00000800
+IN_Q_OVERFLOW    = 0x00004000
+IN_IGNORED       = 0x00008000
+IN_ONLYDIR       = 0x01000000
+IN_DONT_FOLLOW   = 0x02000000
+IN_ISDIR         = 0x40000000
+IN_NONBLOCK      = os.O_NONBLOCK
+IN_CLOEXEC       = 0x00080000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE \
+    | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW
+
+EVENT_HEADER = struct.Struct("iIII")     # wd, mask, cookie, len
+
+_libc = None
+
+
+def libc():
+    """Loads the C library the first time it's needed"""
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(_libc, "inotify_init1"):
+            raise RuntimeError("This system does not support inotify")
+        _libc.inotify_add_watch.argtypes = [ ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32 ]
+        _libc.inotify_rm_watch.argtypes  = [ ctypes.c_int, ctypes.c_int ]
+    return _libc
+
+
+def parse_events(data):
+    """Yields (wd, mask, name) for each event in a buffer read from an inotify descriptor"""
+    offset = 0
+    while offset + EVENT_HEADER.size <= len(data):
+        wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+        offset += EVENT_HEADER.size
+        yield wd, mask, data[offset:offset + length].rstrip("\0")
+        offset += length
+
+
+class InotifySource(FileSystemSource):
+    """Filesystem changes reported by inotify"""
+
+    def __init__(self, name=None, latency=1.0, retry_interval=5.0):
+        super(InotifySource, self).__init__(name)
+        self.latency        = latency
+        self.retry_interval = retry_interval
+        self.fd          = None
+        self.reader      = None
+        self.loop        = None
+        self.wds         = dict()           # watch descriptor -> directory
+        self.dirs        = dict()           # directory -> watch descriptor
+        self.roots       = set()            # watched paths whose trees have been added
+        self.missing     = set()            # watched paths which don't exist
+        self.changed     = OrderedDict()    # directory -> recursive, for the current batch
+        self.timer       = None
+        self.retry_timer = None             # Looks for missing paths
+        self.watch_limit = False            # Set once the kernel has refused a watch for lack of space
+
+    def start(self, loop):
+        self.loop = loop
+        self.fd   = libc().inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1: %s" % os.strerror(ctypes.get_errno()))
+
+        self.reader = loop.add_reader(self.fd, self.read_events)
+        self.refresh(loop)
+
+    def stop(self):
+        for timer in (self.timer, self.retry_timer):
+            if timer is not None:
+                timer.cancel()
+        self.timer       = None
+        self.retry_timer = None
+        if self.reader is not None:
+            self.reader.cancel()
+            self.reader = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.wds.clear()
+        self.dirs.clear()
+        self.roots.clear()
+        self.missing.clear()
+
+    def refresh(self, loop):
+        """Adds the trees below new watched paths and removes watches which no watched path needs"""
+        paths = set(self.paths())
+
+        self.missing &= paths
+
+        for root in sorted(self.roots - paths):
+            self.roots.remove(root)
+            self.remove_tree(root)
+
+        for root in sorted(paths - self.roots):
+            if not os.path.exists(root):
+                if root not in self.missing:
+                    logging.warning("inotify: %s does not exist; it will be watched once it is created" % root)
+                    self.missing.add(root)
+                continue
+            if root in self.missing:
+                logging.info("inotify: %s has been created" % root)
+                self.missing.remove(root)
+                self.changed[root] = True
+            self.roots.add(root)
+            self.add_tree(root)
+
+        if self.missing and self.retry_timer is None:
+            self.retry_timer = self.loop.call_later(self.retry_interval, self.retry_missing)
+
+        logging.debug("inotify: watching %d directories for %d paths" % (len(self.dirs), len(self.roots)))
+
+    def retry_missing(self):
+        """Timer: watches any missing paths which have been created"""
+        self.retry_timer = None
+        self.refresh(self.loop)
+        self.schedule_flush()
+
+    def lose_root(self, root):
+        """Forgets a watched path which has been moved or deleted until it is created again"""
+        logging.warning("inotify: %s was moved or deleted; it will be watched again once it is recreated" % root)
+        self.roots.discard(root)
+        self.missing.add(root)
+        if self.retry_timer is None:
+            self.retry_timer = self.loop.call_later(self.retry_interval, self.retry_missing)
+
+    def add_tree(self, top):
+        """Watches top and every directory below it"""
+        for directory, subdirs, files in os.walk(top):
+            if not self.add_watch(directory):
+                subdirs[:] = []
+
+    def add_watch(self, directory):
+        """Watches one directory, returning False if it can't be watched"""
+        if directory in self.dirs:
+            return True
+
+        wd = libc().inotify_add_watch(self.fd, directory, WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                if not self.watch_limit:
+                    logging.error("inotify: unable to watch %s: the fs.inotify.max_user_watches limit has been reached" % directory)
+                self.watch_limit = True
+            elif err not in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                logging.error("inotify: unable to watch %s: %s" % (directory, os.strerror(err)))
+            return False
+
+        self.wds[wd]         = directory
+        self.dirs[directory] = wd
+        return True
+
+    def remove_tree(self, top, keep_covered=True):
+        """
+        Removes the watches for top and every directory below it; unless
+        keep_covered is False, directories below another watched path are kept
+        """
+        prefix = os.path.join(top, "")
+        for directory in [ d for d in self.dirs if d == top or d.startswith(prefix) ]:
+            if keep_covered and any(directory == r or directory.startswith(os.path.join(r, "")) for r in self.roots):
+                continue
+            wd = self.dirs.pop(directory)
+            del self.wds[wd]
+            libc().inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """Reads every available event and adds the changed directories to the current batch"""
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError, exc:
+                if exc.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
+            if not data:
+                break
+
+            for wd, mask, name in parse_events(data):
+                self.process_event(wd, mask, name)
+
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        if self.changed and self.timer is None:
+            self.timer = self.loop.call_later(self.latency, self.flush)
+
+    def process_event(self, wd, mask, name):
+        """Updates the watches for one inotify event and records the directory which changed"""
+        if mask & IN_Q_OVERFLOW:
+            self.os_dropped += 1
+            logging.error("The kernel was too slow processing inotify events and some events were dropped!")
+            for root in self.roots:
+                self.changed[root] = True
+            return
+
+        directory = self.wds.get(wd)
+        if directory is None:
+            return
+
+        if mask & IN_IGNORED:
+            # The kernel removed the watch because the directory was deleted or unmounted:
+            self.wds.pop(wd, None)
+            if self.dirs.get(directory) == wd:
+                del self.dirs[directory]
+            if directory in self.roots:
+                self.lose_root(directory)
+            return
+
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            # Reported as a change to the parent, which also receives IN_DELETE
+            # or IN_MOVED_FROM; a moved directory's watches no longer match
+            # their paths:
+            if mask & IN_MOVE_SELF:
+                self.remove_tree(directory, keep_covered=False)
+                if directory in self.roots:
+                    self.lose_root(directory)
+            return
+
+        self.changed[directory] = self.changed.get(directory, False)
+
+        if mask & IN_ISDIR and name:
+            child = os.path.join(directory, name)
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                # Anything created before the new watches were added would be missed:
+                self.add_tree(child)
+                self.changed[child] = True
+                if child in self.missing:
+                    self.refresh(self.loop)
+            elif mask & IN_MOVED_FROM:
+                self.remove_tree(child, keep_covered=False)
+
+    def flush(self):
+        """Reports each directory which changed during the batch"""
+        self.timer = None
+        changed, self.changed = self.changed, OrderedDict()
+        for path, recursive in changed.items():
+            self.emit(path, path=path, recursive=recursive)
+
+
+def main():
+    """Serves the FSEvents section of a crankd configuration using inotify"""
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+    config_file = sys.argv[1] if len(sys.argv) > 1 else os.path.expanduser('~/Library/Preferences/com.googlecode.pymacadmin.crankd.plist')
+
+    loop = actions.EVENT_LOOP = SelectEventLoop()
+    actions.COMMAND_EXECUTOR  = CommandExecutor(loop.call_later)
+    actions.WORKER_POOL       = WorkerPool()
+    actions.WORKER_GROUPS     = WorkerGroups(loop)
+
+    dispatcher = Dispatcher()
+    try:
+        configure_sources(dispatcher, load_config(config_file), { 'FSEvents': InotifySource })
+    except (AttributeError, RuntimeError), exc:
+        print >> sys.stderr, "Error configuring events: %s" % exc
+        sys.exit(1)
+
+    loop.add_signal_handler(signal.SIGCHLD, lambda signum: actions.COMMAND_EXECUTOR.reap())
+    loop.add_signal_handler(signal.SIGINT, lambda signum: loop.stop())
+    loop.add_signal_handler(signal.SIGTERM, lambda signum: loop.stop())
+
+    dispatcher.start(loop)
+    loop.run()
+
+    actions.WORKER_POOL.shutdown(timeout=5.0)
+    actions.WORKER_GROUPS.shutdown(timeout=5.0)
+
+
+if __name__ == '__main__':
+    main()
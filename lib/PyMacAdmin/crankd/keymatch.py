@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Resolves SystemConfiguration keys to the handlers which are interested in them
+
+crankd configurations may contain both explicit keys ("State:/Network/Global/IPv4")
+and regular expressions ("regexp:State:/Network/Interface/([^/]+)/Link").
+Testing every pattern against every changed key is expensive when a
+configuration contains hundreds of regexps so the KeyMatcher indexes each
+pattern by its literal prefix in a character trie: a key is walked through
+the trie once and only the patterns whose prefix matches are actually
+evaluated. Resolved keys are kept in a bounded LRU cache because
+SCDynamicStore tends to report the same handful of keys over and over.
+"""
+
+import re
+from collections import OrderedDict
+
+REGEXP_PREFIX = "regexp:"
+
+# Characters which end the literal prefix of a regular expression:
+_SPECIAL_CHARS = frozenset(".^$*+?{}[]\\|()")
+# Quantifiers apply to the preceding character, which therefore can't be
+# considered part of the literal prefix:
+_QUANTIFIERS   = frozenset("*+?{")
+# Inline flags such as (?i), which Python applies to the whole pattern
+# wherever they appear:
+_INLINE_FLAGS  = re.compile(r'\(\?[iLmsux]')
+
+
+def literal_prefix(pattern):
+    """
+    Returns the literal text which every string matched by pattern (using
+    re.match) must start with.
+
+    >>> literal_prefix(r'State:/Network/Interface/([^/]+)/Link')
+    'State:/Network/Interface/'
+    >>> literal_prefix(r'State:/Network/Service/.*/DNS')
+    'State:/Network/Service/'
+    >>> literal_prefix(r'Setup:/Network/Service/ab?')
+    'Setup:/Network/Service/a'
+    >>> literal_prefix(r'State:/Network/Global/IPv[46]|Setup:/')
+    ''
+    >>> literal_prefix(r'state:/network/(?i)interface')
+    ''
+    >>> literal_prefix(r'State:/Network/Interface/(?P<name>[^/]+)/Link')
+    'State:/Network/Interface/'
+    """
+
+    # Alternation and inline flags can change the meaning of everything
+    # before them so we simply don't index those patterns:
+    if "|" in pattern or _INLINE_FLAGS.search(pattern):
+        return ""
+
+    prefix = []
+    i      = 1 if pattern.startswith("^") else 0
+
+    while i < len(pattern):
+        c = pattern[i]
+
+        if c == "\\":
+            if i + 1 >= len(pattern) or pattern[i + 1].isalnum():
+                break           # \d, \w, backreferences, etc.
+            literal, i = pattern[i + 1], i + 2
+        elif c in _SPECIAL_CHARS:
+            break
+        else:
+            literal, i = c, i + 1
+
+        if i < len(pattern) and pattern[i] in _QUANTIFIERS:
+            break
+
+        prefix.append(literal)
+
+    return "".join(prefix)
+
+
+class KeyMatcher(object):
+    """
+    Maps SystemConfiguration keys to handlers
+
+    Explicit keys take precedence: regexp handlers are only used for keys
+    which do not have an explicit handler. resolve() returns a tuple of
+    (handler, re_obj) pairs where re_obj is None for explicit handlers.
+    """
+
+    def __init__(self, cache_size=1024):
+        self.explicit   = dict()
+        self.patterns   = list()        # [(compiled regexp, handler)] in configuration order
+        self.cache_size = cache_size
+        self.cache      = OrderedDict()
+        self.trie       = [dict(), []]  # [children, pattern indices]
+
+    def __len__(self):
+        return len(self.explicit) + len(self.patterns)
+
+    def add(self, key, handler):
+        """Registers a handler for a key using the crankd "regexp:" convention"""
+        if key.startswith(REGEXP_PREFIX):
+            self.add_regexp(key[len(REGEXP_PREFIX):], handler)
+        else:
+            self.add_explicit(key, handler)
+
+    def add_explicit(self, key, handler):
+        """Registers a handler for an exact key"""
+        self.explicit[key] = handler
+        self.cache.clear()
+
+    def add_regexp(self, pattern, handler):
+        """Registers a handler for every key matched by the regular expression pattern"""
+        self.patterns.append((re.compile(pattern), handler))
+
+        node = self.trie
+        for c in literal_prefix(pattern):
+            node = node[0].setdefault(c, [dict(), []])
+        node[1].append(len(self.patterns) - 1)
+
+        self.cache.clear()
+
+    def remove(self, key, handler):
+        """Unregisters a handler added with add()"""
+        if key.startswith(REGEXP_PREFIX):
+            pattern  = key[len(REGEXP_PREFIX):]
+            patterns = [ (r, h) for r, h in self.patterns if r.pattern != pattern or h is not handler ]
+            if len(patterns) == len(self.patterns):
+                raise KeyError(key)
+
+            self.patterns = list()
+            self.trie     = [dict(), []]
+            for re_obj, h in patterns:
+                self.add_regexp(re_obj.pattern, h)
+        else:
+            if self.explicit.get(key) is not handler:
+                raise KeyError(key)
+            del self.explicit[key]
+
+        self.cache.clear()
+
+    def explicit_keys(self):
+        """Returns the list of explicit keys, as needed by SCDynamicStoreSetNotificationKeys"""
+        return self.explicit.keys()
+
+    def regexp_patterns(self):
+        """Returns the list of regexp patterns, as needed by SCDynamicStoreSetNotificationKeys"""
+        return [ r.pattern for r, h in self.patterns ]
+
+    def resolve(self, key):
+        """Returns every (handler, re_obj) pair which should be called for key"""
+        try:
+            handlers = self.cache.pop(key)
+        except KeyError:
+            handlers = self._match(key)
+            if len(self.cache) >= self.cache_size:
+                self.cache.popitem(last=False)
+
+        self.cache[key] = handlers
+        return handlers
+
+    def _match(self, key):
+        """Resolves key without consulting the cache"""
+        if key in self.explicit:
+            return ((self.explicit[key], None),)
+
+        node       = self.trie
+        candidates = list(node[1])
+
+        for c in key:
+            node = node[0].get(c)
+            if node is None:
+                break
+            candidates.extend(node[1])
+
+        candidates.sort()
+
+        return tuple(
+            (handler, re_obj) for re_obj, handler in (self.patterns[i] for i in candidates) if re_obj.match(key)
+        )
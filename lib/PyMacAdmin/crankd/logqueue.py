@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Non-blocking logging for crankd
+
+Writes to syslog can stall when syslogd is busy, and crankd logs from its
+runloop. A QueueHandler formats each record in the calling thread and puts it
+on a bounded queue; a single writer thread takes records off the queue in
+batches and passes them to the real handlers. Along the way the writer:
+
+    - collapses runs of identical messages into the first copy followed by
+      "last message repeated N times", as syslogd does
+    - limits each logger to a sustained rate with a token bucket (the one
+      in PyMacAdmin.crankd.ratelimit), reporting how many messages were
+      suppressed once the logger is below its limit
+
+If the queue is full the record is dropped and counted rather than blocking
+the caller.
+"""
+
+import copy
+import logging
+import threading
+import time
+from Queue import Queue, Empty, Full
+
+from .ratelimit import TokenBucket
+
+# The maximum length of a syslog message:
+SYSLOG_MAX_LEN = 1024
+
+
+def chunk_items(items, max_len, separator=", "):
+    """
+    Yields lists of items whose joined length is at most max_len, in order.
+    Items longer than max_len are truncated. Runs in linear time.
+    """
+    chunk     = list()
+    chunk_len = 0
+
+    for item in items:
+        item = item[:max_len]
+
+        if chunk and chunk_len + len(separator) + len(item) > max_len:
+            yield chunk
+            chunk     = list()
+            chunk_len = 0
+
+        chunk_len += len(item) + (len(separator) if chunk else 0)
+        chunk.append(item)
+
+    if chunk:
+        yield chunk
+
+
+def log_list(msg, items, level=logging.INFO):
+    """
+    Record a a list of values with a message
+
+    This would ordinarily be a simple logging call but we want to keep the
+    length below the 1024-byte syslog() limitation and we'll format things
+    nicely by repeating our message with as many of the values as will fit.
+
+    Individual items longer than the maximum length will be truncated.
+    """
+    for chunk in list(chunk_items(items, SYSLOG_MAX_LEN - len(msg % ""))) or [[]]:
+        logging.log(level, msg % ", ".join(chunk))
+
+
+class LogWriter(object):
+    """
+    Passes batches of queued records to the target handlers, collapsing
+    repeats and limiting the rate of each logger
+
+    This class does the work for the QueueHandler's writer thread and has no
+    threading of its own so it can be tested directly.
+    """
+
+    def __init__(self, targets, rate=50, burst=200, clock=time.time):
+        self.targets    = targets
+        self.rate       = rate
+        self.burst      = burst
+        self.clock      = clock
+        self.buckets    = dict()     # logger name -> TokenBucket
+        self.suppressed = dict()     # logger name -> messages dropped by the rate limit
+        self.last       = None       # the most recent record written
+        self.repeats    = 0          # copies of self.last which have not been written
+
+    def write(self, batch):
+        """Processes a list of records"""
+        for record in batch:
+            if self.last is not None and self.same(record, self.last):
+                self.repeats += 1
+                continue
+
+            self.flush_repeats()
+
+            if self.rate and not self.allow(record):
+                continue
+
+            self.emit(record)
+            self.last = record
+
+    def flush_repeats(self):
+        """Reports any repeats of the last message; called when a run ends or the queue is idle"""
+        if self.repeats:
+            self.emit(self.notice(self.last, "last message repeated %d times" % self.repeats))
+            self.repeats = 0
+
+    def allow(self, record):
+        """Applies the per-logger rate limit"""
+        bucket = self.buckets.get(record.name)
+        if bucket is None:
+            bucket = self.buckets[record.name] = TokenBucket(self.rate, self.burst, clock=self.clock)
+
+        if not bucket.take():
+            self.suppressed[record.name] = self.suppressed.get(record.name, 0) + 1
+            return False
+
+        suppressed = self.suppressed.pop(record.name, 0)
+        if suppressed:
+            self.emit(self.notice(record, "%d messages were suppressed by the rate limit" % suppressed, level=logging.WARNING))
+        return True
+
+    def same(self, a, b):
+        return a.msg == b.msg and a.name == b.name and a.levelno == b.levelno
+
+    def notice(self, record, message, level=None):
+        """Returns a new record from the same logger as record"""
+        levelno = record.levelno if level is None else level
+        return logging.LogRecord(record.name, levelno, record.pathname, record.lineno, message, None, None)
+
+    def emit(self, record):
+        for target in self.targets:
+            if record.levelno >= target.level:
+                target.handle(record)
+
+
+class QueueHandler(logging.Handler):
+    """Queues records for a writer thread which passes them to the target handlers"""
+
+    def __init__(self, targets, maxsize=10000, batch_size=100, idle_flush=1.0, **writer_args):
+        logging.Handler.__init__(self)
+        self.queue      = Queue(maxsize)
+        self.writer     = LogWriter(targets, **writer_args)
+        self.batch_size = batch_size
+        self.idle_flush = idle_flush
+        self.dropped    = 0          # records discarded because the queue was full
+        self.reported   = 0          # ... of which the writer has logged
+
+        self.thread = threading.Thread(target=self.run, name="crankd log writer")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def prepare(self, record):
+        """Formats the message now, since its arguments may change before the writer sees them"""
+        record          = copy.copy(record)
+        record.msg      = self.format(record)
+        record.args     = None
+        record.exc_info = None
+        record.exc_text = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def run(self):
+        """The writer thread: takes records off the queue in batches until it receives None"""
+        while True:
+            try:
+                batch = [ self.queue.get(timeout=self.idle_flush) ]
+            except Empty:
+                self.writer.flush_repeats()
+                continue
+
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+
+            records = [ r for r in batch if r is not None ]
+            try:
+                dropped = self.dropped
+                if dropped > self.reported:
+                    self.writer.emit(logging.LogRecord(
+                        "crankd", logging.WARNING, __file__, 0,
+                        "%d log messages were dropped because the queue was full" % (dropped - self.reported), None, None
+                    ))
+                    self.reported = dropped
+
+                self.writer.write(records)
+                if len(records) < len(batch):
+                    self.writer.flush_repeats()
+            except Exception:
+                pass    # There is nowhere left to report logging failures
+            finally:
+                for i in batch:
+                    self.queue.task_done()
+
+            if len(records) < len(batch):
+                return
+
+    def flush(self, timeout=5.0):
+        """Waits for the queue to drain, giving up after timeout seconds"""
+        deadline = time.time() + timeout
+        while self.queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.01)
+
+    def close(self):
+        """Writes everything still queued and stops the writer thread"""
+        if self.thread.isAlive():
+            self.queue.put(None)
+            self.thread.join(5.0)
+        logging.Handler.close(self)
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Event loop backends for crankd
+
+crankd only needs a few things from an event loop: one-shot timers, file
+descriptor readers and writers and prompt signal delivery. EventLoop defines that
+interface; the Cocoa implementation lives in PyMacAdmin.crankd.cocoa and
+SelectEventLoop is a pure-Python implementation which runs anywhere, allowing
+the dispatcher and handlers to be tested without the Mac frameworks.
+
+Signals are delivered using signal.set_wakeup_fd(): the C-level signal
+handler writes to a pipe which wakes the loop so the Python handlers run
+immediately rather than whenever the loop next happens to wake up. Other
+threads use the same pipe to have call_soon_threadsafe() callbacks run on the
+loop.
+"""
+
+import errno
+import fcntl
+import heapq
+import logging
+import os
+import select
+import signal
+import time
+from collections import deque
+
+
+def set_nonblocking(fd):
+    """Sets O_NONBLOCK on a file descriptor"""
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+
+class EventLoop(object):
+    """
+    Interface implemented by every event loop backend
+
+    Subclasses must implement call_later, add_reader, add_writer, run and stop;
+    add_signal_handler and call_soon_threadsafe are built on top of
+    add_reader. Only call_soon_threadsafe may be called from other threads.
+    """
+
+    def __init__(self):
+        self.signal_handlers = dict()
+        self.pending_signals = list()
+        self.pending_calls   = deque()
+        self.wakeup_fds      = None
+        self.wakeup_signals  = False    # Whether signals write to the wakeup pipe
+
+    def time(self):
+        """Returns the current time in seconds"""
+        return time.time()
+
+    def call_later(self, delay, callback):
+        """Calls callback after delay seconds; returns an object with a cancel() method"""
+        raise NotImplementedError()
+
+    def add_reader(self, fd, callback):
+        """Calls callback whenever fd is readable; returns an object with a cancel() method"""
+        raise NotImplementedError()
+
+    def add_writer(self, fd, callback):
+        """Calls callback whenever fd is writable; returns an object with a cancel() method"""
+        raise NotImplementedError()
+
+    def run(self):
+        """Processes events until stop() is called"""
+        raise NotImplementedError()
+
+    def stop(self):
+        """Causes run() to return"""
+        raise NotImplementedError()
+
+    def enable_wakeup(self):
+        """Creates the wakeup pipe; must be called from the loop's thread before other threads use it"""
+        if self.wakeup_fds is None:
+            self.wakeup_fds = os.pipe()
+            for fd in self.wakeup_fds:
+                set_nonblocking(fd)
+            self.add_reader(self.wakeup_fds[0], self.run_signal_handlers)
+
+    def call_soon_threadsafe(self, callback):
+        """Calls callback from the event loop; may be called from any thread once enable_wakeup() has been called"""
+        self.pending_calls.append(callback)
+        try:
+            os.write(self.wakeup_fds[1], "\0")
+        except OSError, exc:
+            # A full pipe will already wake the loop:
+            if exc.errno != errno.EAGAIN:
+                raise
+
+    def add_signal_handler(self, signum, callback):
+        """Calls callback(signum) from the event loop when signum is received"""
+        # The pipe may already exist for call_soon_threadsafe():
+        self.enable_wakeup()
+        if not self.wakeup_signals:
+            signal.set_wakeup_fd(self.wakeup_fds[1])
+            self.wakeup_signals = True
+
+        self.signal_handlers[signum] = callback
+        signal.signal(signum, self.record_signal)
+        signal.siginterrupt(signum, False)
+
+    def record_signal(self, signum, frame):
+        """Python-level signal handler: the callback will run once the loop wakes"""
+        self.pending_signals.append(signum)
+
+    def run_signal_handlers(self):
+        """Drains the wakeup pipe and runs the callbacks for any signals or threads which woke the loop"""
+        try:
+            while os.read(self.wakeup_fds[0], 4096):
+                pass
+        except OSError:
+            pass
+
+        pending, self.pending_signals = self.pending_signals, list()
+
+        for signum in pending:
+            try:
+                self.signal_handlers[signum](signum)
+            except Exception:
+                logging.exception("Signal handler for %d failed" % signum)
+
+        # Callbacks added after the pipe was drained will wake us again:
+        for i in range(len(self.pending_calls)):
+            callback = self.pending_calls.popleft()
+            try:
+                callback()
+            except Exception:
+                logging.exception("Callback %r failed" % callback)
+
+
+class Timer(object):
+    """A timer scheduled on a SelectEventLoop"""
+
+    def __init__(self, when, callback):
+        self.when      = when
+        self.callback  = callback
+        self.cancelled = False
+
+    def __cmp__(self, other):
+        return cmp(self.when, other.when)
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Reader(object):
+    """A file descriptor watched by a SelectEventLoop; watches is its readers or writers"""
+
+    def __init__(self, watches, fd, callback):
+        self.watches  = watches
+        self.fd       = fd
+        self.callback = callback
+
+    def cancel(self):
+        if self.watches.get(self.fd) is self:
+            del self.watches[self.fd]
+
+
+class SelectEventLoop(EventLoop):
+    """A portable event loop built on select()"""
+
+    def __init__(self):
+        super(SelectEventLoop, self).__init__()
+        self.timers  = list()     # heapq of Timer objects
+        self.readers = dict()     # fd -> Reader
+        self.writers = dict()     # fd -> Reader
+        self.running = False
+
+    def call_later(self, delay, callback):
+        timer = Timer(self.time() + max(0, delay), callback)
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def add_reader(self, fd, callback):
+        reader = self.readers[fd] = Reader(self.readers, fd, callback)
+        return reader
+
+    def add_writer(self, fd, callback):
+        writer = self.writers[fd] = Reader(self.writers, fd, callback)
+        return writer
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        self.running = True
+        while self.running:
+            self.run_once()
+
+    def run_once(self, timeout=None):
+        """Waits for the next timer or ready descriptor and processes every ready event"""
+        while self.timers and self.timers[0].cancelled:
+            heapq.heappop(self.timers)
+
+        if self.timers:
+            delay = max(0, self.timers[0].when - self.time())
+            timeout = delay if timeout is None else min(delay, timeout)
+
+        try:
+            readable, writable = select.select(self.readers.keys(), self.writers.keys(), [], timeout)[:2]
+        except (select.error, OSError), exc:
+            if exc.args[0] != errno.EINTR:
+                raise
+            readable, writable = [], []
+
+        # A failing callback is logged rather than allowed to stop the loop:
+        for watches, ready in ((self.readers, readable), (self.writers, writable)):
+            for fd in ready:
+                reader = watches.get(fd)
+                if reader is not None:
+                    try:
+                        reader.callback()
+                    except Exception:
+                        logging.exception("Descriptor callback %r failed" % reader.callback)
+
+        now = self.time()
+        while self.timers and self.timers[0].when <= now:
+            timer = heapq.heappop(self.timers)
+            if not timer.cancelled:
+                try:
+                    timer.callback()
+                except Exception:
+                    logging.exception("Timer callback %r failed" % timer.callback)
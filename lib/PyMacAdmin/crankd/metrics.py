@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Per-handler metrics for crankd
+
+Every handler created by get_callable_for_event (and every "class" delegate
+method) is wrapped in an InstrumentedHandler which counts calls and errors
+and records its latency in a fixed-bucket histogram. Everything else -
+coalesced events, shell command exit codes, event queues - is either counted
+where it happens or read from the object which already tracks it when the
+metrics are rendered, so the cost while nobody is looking is a few integer
+increments per call.
+
+A handler's dropped calls are those discarded by its rate limit or, for a
+worker_group handler, by its group's full queue; events dropped by a
+source's queue never reached any handler and are counted for the source.
+The latency of a worker_group handler is the time taken to queue the call
+for its worker process, not to run it there.
+
+Metrics are rendered in the Prometheus text exposition format and can be
+read from a UNIX socket (crankd --metrics-socket) or written to the log. The
+socket is served from the event loop without blocking it: each client is
+written to as its socket accepts data and dropped if it hasn't read
+everything within timeout seconds.
+"""
+
+import bisect
+import errno
+import logging
+import os
+import socket
+import time
+
+# Upper bounds, in seconds, of the latency histogram buckets:
+LATENCY_BUCKETS = ( 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0 )
+
+
+def escape_label(value):
+    """Escapes a Prometheus label value"""
+    return unicode(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class HandlerMetrics(object):
+    """Counters and latency histogram for a single handler"""
+
+    def __init__(self, name):
+        self.name       = name
+        self.fires      = 0
+        self.errors     = 0
+        self.dropped    = 0          # Calls discarded by a full worker group queue
+        self.unmatched  = 0          # Events which didn't satisfy the handler's match conditions
+        self.buckets    = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total_time = 0.0
+        self.exit_codes = dict()     # exit status -> count, for shell commands
+        self.debouncers = list()     # Debouncers which report coalesced events for this handler
+        self.limiters   = list()     # RateLimiters which report throttled calls for this handler
+
+    def observe(self, elapsed):
+        """Records the latency of one call"""
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+        self.total_time += elapsed
+
+    @property
+    def coalesced(self):
+        """The number of events which were absorbed into another call by debouncing"""
+        return sum(d.events - d.invocations - d.pending for d in self.debouncers)
+
+    @property
+    def throttled(self):
+        """The number of calls which exceeded the handler's rate limit"""
+        return sum(l.throttled for l in self.limiters)
+
+
+class InstrumentedHandler(object):
+    """Wraps a handler to update its HandlerMetrics"""
+
+    def __init__(self, handler, metrics):
+        self.handler = handler
+        self.metrics = metrics
+        self.name    = metrics.name
+
+    def __call__(self, *args, **kwargs):
+        metrics        = self.metrics
+        metrics.fires += 1
+        start          = time.time()
+        try:
+            return self.handler(*args, **kwargs)
+        except Exception:
+            metrics.errors += 1
+            raise
+        finally:
+            metrics.observe(time.time() - start)
+
+
+class MetricsRegistry(object):
+    """The metrics for every handler plus the dispatcher and command executor totals"""
+
+    def __init__(self):
+        self.handlers   = dict()     # name -> HandlerMetrics
+        self.dispatcher = None
+        self.executor   = None
+        self.workers    = None
+        self.groups     = None       # WorkerGroups
+
+    def handler(self, name):
+        """Returns the HandlerMetrics for name, creating it if necessary"""
+        try:
+            return self.handlers[name]
+        except KeyError:
+            metrics = self.handlers[name] = HandlerMetrics(name)
+            return metrics
+
+    def instrument(self, handler, name):
+        """Returns handler wrapped so its calls are counted under name"""
+        return InstrumentedHandler(handler, self.handler(name))
+
+    def record_drop(self, context):
+        """WorkerGroups drop hook: counts calls discarded by a full worker group queue"""
+        self.handler(context).dropped += 1
+
+    def record_exit(self, child, rc):
+        """CommandExecutor exit hook: counts exit statuses for each handler"""
+        exit_codes = self.handler(child.context).exit_codes
+        exit_codes[rc] = exit_codes.get(rc, 0) + 1
+
+    def render(self):
+        """Returns the metrics in the Prometheus text exposition format"""
+        lines = list()
+
+        def metric(name, kind, help_text, samples, suffix=""):
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in samples:
+                label_text = ",".join('%s="%s"' % (k, escape_label(v)) for k, v in labels)
+                lines.append("%s%s{%s} %s" % (name, suffix, label_text, value) if label_text else "%s%s %s" % (name, suffix, value))
+
+        handlers = [ self.handlers[k] for k in sorted(self.handlers) ]
+
+        metric("crankd_handler_calls_total", "counter", "Handler invocations",
+            [ ((("handler", h.name),), h.fires) for h in handlers ])
+        metric("crankd_handler_errors_total", "counter", "Handler invocations which raised an exception",
+            [ ((("handler", h.name),), h.errors) for h in handlers ])
+        metric("crankd_handler_dropped_total", "counter", "Events which were dropped instead of reaching the handler",
+            [ ((("handler", h.name),), h.dropped + sum(l.dropped for l in h.limiters)) for h in handlers ])
+        metric("crankd_handler_throttled_total", "counter", "Calls which exceeded the handler's rate limit and were dropped, deferred or replaced",
+            [ ((("handler", h.name),), h.throttled) for h in handlers ])
+        metric("crankd_handler_unmatched_total", "counter", "Events discarded because they didn't satisfy the handler's match conditions",
+            [ ((("handler", h.name),), h.unmatched) for h in handlers ])
+        metric("crankd_handler_coalesced_total", "counter", "Events which were merged into another call by debounce or coalesce",
+            [ ((("handler", h.name),), h.coalesced) for h in handlers ])
+
+        samples = list()
+        for h in handlers:
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), h.buckets):
+                cumulative += count
+                samples.append(((("handler", h.name), ("le", bound)), cumulative))
+        metric("crankd_handler_duration_seconds", "histogram", "Time spent in each handler call", samples, suffix="_bucket")
+        # The _sum and _count samples belong to the histogram above:
+        lines.extend('crankd_handler_duration_seconds_sum{handler="%s"} %f' % (escape_label(h.name), h.total_time) for h in handlers)
+        lines.extend('crankd_handler_duration_seconds_count{handler="%s"} %d' % (escape_label(h.name), sum(h.buckets)) for h in handlers)
+
+        metric("crankd_command_exits_total", "counter", "Shell command exit statuses; negative values are signals",
+            [ ((("handler", h.name), ("code", rc)), count) for h in handlers for rc, count in sorted(h.exit_codes.items()) ])
+
+        if self.dispatcher is not None:
+            metric("crankd_events_total", "counter", "Events dispatched", [ ((), self.dispatcher.dispatched) ])
+            metric("crankd_events_unhandled_total", "counter", "Events with no handler", [ ((), self.dispatcher.unhandled) ])
+
+            sources = [ self.dispatcher.sources[k] for k in sorted(self.dispatcher.sources) ]
+            queues  = [ (s.name, s.queue) for s in sources if s.queue is not None ]
+            metric("crankd_source_os_dropped_total", "counter", "Events the operating system reported it dropped before crankd saw them",
+                [ ((("source", s.name),), s.os_dropped) for s in sources ])
+            limited = [ s for s in sources if s.limiter is not None ]
+            metric("crankd_source_throttled_total", "counter", "Events which exceeded each source's rate limit",
+                [ ((("source", s.name),), s.limiter.throttled) for s in limited ])
+            metric("crankd_source_rate_limit_dropped_total", "counter", "Events discarded by each source's rate limit",
+                [ ((("source", s.name),), s.limiter.dropped) for s in limited ])
+
+            # Bonjour browsing, for each service type:
+            browsing = [ (t, s.browsing[t]) for s in sources if hasattr(s, 'browsing') for t in sorted(s.browsing) ]
+            metric("crankd_mdns_announced_total", "counter", "Services reported by each Bonjour browser",
+                [ ((("type", t),), b.announced) for t, b in browsing ])
+            metric("crankd_mdns_removed_total", "counter", "Services each Bonjour browser reported had gone away",
+                [ ((("type", t),), b.removals) for t, b in browsing ])
+            metric("crankd_mdns_resolves_total", "counter", "Services which had to be resolved",
+                [ ((("type", t),), b.resolves) for t, b in browsing ])
+            metric("crankd_mdns_resolve_failures_total", "counter", "Resolves which failed or timed out",
+                [ ((("type", t),), b.failures) for t, b in browsing ])
+            metric("crankd_mdns_cache_hits_total", "counter", "Announcements of services which were already resolved",
+                [ ((("type", t),), b.cache_hits) for t, b in browsing ])
+            metric("crankd_mdns_cached_services", "gauge", "Resolved services remembered for each type",
+                [ ((("type", t),), len(b.cache)) for t, b in browsing ])
+            metric("crankd_mdns_batches_total", "counter", "Events emitted for bursts of announcements",
+                [ ((("type", t),), b.batches) for t, b in browsing ])
+
+            metric("crankd_queue_depth", "gauge", "Events waiting in each source's queue",
+                [ ((("source", name),), len(q)) for name, q in queues ])
+            metric("crankd_queue_high_water", "gauge", "The most events ever waiting in each source's queue",
+                [ ((("source", name),), q.high_water) for name, q in queues ])
+            metric("crankd_queue_dropped_total", "counter", "Events discarded by each source's queue overflow policy",
+                [ ((("source", name),), q.dropped) for name, q in queues ])
+            metric("crankd_queue_coalesced_total", "counter", "Events which replaced a queued event with the same key",
+                [ ((("source", name),), q.coalesced) for name, q in queues ])
+            metric("crankd_queue_rescans_total", "counter", "Rescan events queued in place of dropped events",
+                [ ((("source", name),), q.rescanned) for name, q in queues ])
+
+        if self.executor is not None:
+            metric("crankd_commands_running", "gauge", "Shell commands currently running", [ ((), len(self.executor.running)) ])
+            metric("crankd_commands_queued", "gauge", "Shell commands waiting to start", [ ((), len(self.executor.pending)) ])
+
+        if self.workers is not None:
+            metric("crankd_worker_threads", "gauge", "Threads started to run threaded handlers", [ ((), len(self.workers.threads)) ])
+            metric("crankd_worker_tasks_running", "gauge", "Threaded handler calls currently running", [ ((), self.workers.busy) ])
+            metric("crankd_worker_tasks_queued", "gauge", "Threaded handler calls waiting for a thread or an earlier call for the same key", [ ((), self.workers.queued) ])
+
+        if self.groups is not None:
+            groups = [ (name, self.groups.groups[name]) for name in sorted(self.groups.groups) ]
+            metric("crankd_worker_group_up", "gauge", "Whether each worker group's process is running",
+                [ ((("group", name),), int(w.process is not None)) for name, w in groups ])
+            metric("crankd_worker_group_queue_depth", "gauge", "Calls waiting for or running in each worker group's process",
+                [ ((("group", name),), len(w)) for name, w in groups ])
+            metric("crankd_worker_group_calls_total", "counter", "Calls submitted to each worker group",
+                [ ((("group", name),), w.calls) for name, w in groups ])
+            metric("crankd_worker_group_failures_total", "counter", "Calls which raised an exception or crashed their worker process",
+                [ ((("group", name),), w.failures) for name, w in groups ])
+            metric("crankd_worker_group_dropped_total", "counter", "Calls discarded because a worker group's queue was full",
+                [ ((("group", name),), w.dropped) for name, w in groups ])
+            metric("crankd_worker_group_crashes_total", "counter", "Worker processes which exited unexpectedly",
+                [ ((("group", name),), w.crashes) for name, w in groups ])
+
+        return "\n".join(lines) + "\n"
+
+    def log(self, level=logging.INFO):
+        """Writes the current metrics to the log, skipping comments and zero samples"""
+        for line in self.render().splitlines():
+            if not line.startswith("#") and not line.endswith(" 0"):
+                logging.log(level, "metrics: %s" % line)
+
+
+class MetricsClient(object):
+    """Writes one rendering of the metrics to a connection as fast as the client reads it"""
+
+    def __init__(self, server, conn, data):
+        self.server = server
+        self.conn   = conn
+        self.data   = data
+        self.offset = 0
+        self.writer = None
+        self.timer  = None
+
+    def send(self):
+        """Sends as much as the socket will take; called again by the loop whenever it's writable"""
+        try:
+            self.offset += self.conn.send(buffer(self.data, self.offset))
+        except socket.error, exc:
+            if exc.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            logging.debug("Unable to send metrics: %s" % exc)
+            self.close()
+            return
+
+        if self.offset >= len(self.data):
+            self.close()
+        elif self.writer is None:
+            loop        = self.server.loop
+            self.writer = loop.add_writer(self.conn.fileno(), self.send)
+            self.timer  = loop.call_later(self.server.timeout, self.expire)
+            self.server.clients.add(self)
+
+    def expire(self):
+        """Timer: drops a client which has fallen behind"""
+        self.timer = None
+        logging.warning("Dropping a metrics client which read %d of %d bytes in %ss" % (self.offset, len(self.data), self.server.timeout))
+        self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.cancel()
+            self.writer = None
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.conn.close()
+        self.server.clients.discard(self)
+
+
+class MetricsServer(object):
+    """Serves the metrics to anyone who connects to a UNIX socket"""
+
+    def __init__(self, registry, path, loop, timeout=5.0, max_clients=16):
+        self.registry    = registry
+        self.path        = path
+        self.loop        = loop
+        self.timeout     = timeout
+        self.max_clients = max_clients
+        self.clients     = set()     # MetricsClients still being written to
+
+        if os.path.exists(path):
+            os.unlink(path)
+
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(path)
+        self.socket.listen(5)
+        self.socket.setblocking(False)
+
+        self.reader = loop.add_reader(self.socket.fileno(), self.accept)
+
+    def accept(self):
+        """Starts sending the current metrics to each waiting client"""
+        while True:
+            try:
+                conn, addr = self.socket.accept()
+            except socket.error:
+                return
+
+            if len(self.clients) >= self.max_clients:
+                logging.warning("Refusing a metrics client: %d clients are still reading" % len(self.clients))
+                conn.close()
+                continue
+
+            conn.setblocking(False)
+            MetricsClient(self, conn, self.registry.render().encode('utf-8')).send()
+
+    def close(self):
+        for client in list(self.clients):
+            client.close()
+        self.reader.cancel()
+        self.socket.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+METRICS = MetricsRegistry()
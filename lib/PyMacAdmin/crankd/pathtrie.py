@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Maps filesystem paths to the callbacks watching them or one of their parents
+
+FSEvents reports changes for directories, and crankd needs to call every
+handler watching that directory or any of its ancestors. Storing the watched
+paths in a trie keyed by path component makes that lookup proportional to the
+depth of the changed path rather than the number of watches, and ensures that
+/tmpfoo is never considered to be inside /tmp.
+"""
+
+
+def split_path(path):
+    """
+    Returns the list of components in an absolute path
+
+    >>> split_path('/Library/Preferences/')
+    ['Library', 'Preferences']
+    >>> split_path('/')
+    []
+    """
+    return [ c for c in path.split("/") if c ]
+
+
+class PathTrie(object):
+    """
+    A trie of watched paths
+
+    Each node is a [children, path, callbacks] list: path is None for nodes
+    which only exist as intermediate components.
+    """
+
+    def __init__(self):
+        self.root  = [dict(), None, None]
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter(self.paths())
+
+    def __contains__(self, path):
+        node = self._find(path)
+        return node is not None and node[1] is not None
+
+    def __getitem__(self, path):
+        node = self._find(path)
+        if node is None or node[1] is None:
+            raise KeyError(path)
+        return node[2]
+
+    def add(self, path, callback):
+        """Adds a callback for the given directory"""
+        node = self.root
+        for component in split_path(path):
+            node = node[0].setdefault(component, [dict(), None, None])
+
+        if node[1] is None:
+            node[1] = path
+            node[2] = list()
+            self.count += 1
+
+        node[2].append(callback)
+
+    def remove(self, path, callback=None):
+        """Removes callback, or every callback if it is None, for the given directory"""
+        components = split_path(path)
+        nodes      = [self.root]
+
+        for component in components:
+            node = nodes[-1][0].get(component)
+            if node is None:
+                raise KeyError(path)
+            nodes.append(node)
+
+        if nodes[-1][1] is None:
+            raise KeyError(path)
+
+        if callback is not None:
+            nodes[-1][2].remove(callback)
+            if nodes[-1][2]:
+                return
+
+        nodes[-1][1] = nodes[-1][2] = None
+        self.count -= 1
+
+        # Prune intermediate nodes which no longer lead to a watched path:
+        for parent, component in reversed(zip(nodes[:-1], components)):
+            child = parent[0][component]
+            if child[0] or child[1] is not None:
+                break
+            del parent[0][component]
+
+    def paths(self):
+        """Returns the list of watched paths"""
+        paths = list()
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node[1] is not None:
+                paths.append(node[1])
+            stack.extend(node[0].values())
+        return paths
+
+    def match(self, path):
+        """Returns a (watched path, callbacks) pair for path and every watched ancestor, outermost first"""
+        node    = self.root
+        matches = list()
+
+        if node[1] is not None:
+            matches.append((node[1], node[2]))
+
+        for component in split_path(path):
+            node = node[0].get(component)
+            if node is None:
+                break
+            if node[1] is not None:
+                matches.append((node[1], node[2]))
+
+        return matches
+
+    def _find(self, path):
+        """Returns the node for path or None"""
+        node = self.root
+        for component in split_path(path):
+            node = node[0].get(component)
+            if node is None:
+                return None
+        return node
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Declarative conditions which decide whether an event reaches its handler
+
+Many command handlers begin with a shell test ("only if NSApplicationName is
+Safari", "only if the interface is en0") and exit if it fails, which costs a
+fork and exec of /bin/sh for every event they discard. An event
+configuration may instead contain a match dictionary, mapping fields of the
+event to conditions:
+
+    <key>match</key>
+    <dict>
+        <key>user_info.NSApplicationName</key>  <string>Safari</string>
+        <key>capture.1</key>                    <array><string>en0</string><string>en1</string></array>
+        <key>path</key>                         <dict><key>glob</key><string>*.pkg</string></dict>
+    </dict>
+
+Fields are the handler's keyword arguments - key, path, user_info and so on
+- with a dotted name looking inside dictionaries and lists
+("service_info.name", "new_value.Addresses.0"). capture.N is the Nth group (or
+named group) of a regexp key's match. A condition is either a value, which
+the field must equal, a list of values, one of which it must equal, or a
+dictionary of operators which must all hold:
+
+equals:       the field equals this value
+in:           the field equals one of this list of values
+glob:         the field matches this shell-style pattern
+regex:        the field matches this regular expression (using re.search)
+exists:       true if the field must be present, false if it must not
+
+A missing field fails every condition except exists: false. Every field must
+match for the handler to be called. Conditions are compiled when the
+configuration is loaded and tested before debouncing, rate limiting or any
+other work, so events which don't match cost a few comparisons.
+"""
+
+import fnmatch
+import re
+
+MATCH_OPERATORS = ( 'equals', 'in', 'glob', 'regex', 'exists' )
+
+MISSING = object()      # The value of a field which the event doesn't have
+
+
+def compile_condition(name, field, condition):
+    """Returns a function testing a field's value against condition; raises AttributeError"""
+    if isinstance(condition, list):
+        condition = { 'in': condition }
+    elif not isinstance(condition, dict):
+        condition = { 'equals': condition }
+
+    unknown = set(condition) - set(MATCH_OPERATORS)
+    if unknown or not condition:
+        raise AttributeError("%s: match %s must be a value, a list or a dictionary using %s" % (name, field, ", ".join(MATCH_OPERATORS)))
+
+    tests = list()
+
+    if 'equals' in condition:
+        expected = condition['equals']
+        tests.append(lambda value: value == expected)
+
+    if 'in' in condition:
+        if not isinstance(condition['in'], list):
+            raise AttributeError("%s: match %s: in must be a list of values" % (name, field))
+        choices = list(condition['in'])
+        tests.append(lambda value: value in choices)
+
+    for operator in ('glob', 'regex'):
+        if operator in condition:
+            pattern = condition[operator]
+            if not isinstance(pattern, basestring):
+                raise AttributeError("%s: match %s: %s must be a string" % (name, field, operator))
+            try:
+                regex = re.compile(fnmatch.translate(pattern) if operator == 'glob' else pattern)
+            except re.error, exc:
+                raise AttributeError("%s: match %s: invalid regex %r: %s" % (name, field, pattern, exc))
+            search = regex.match if operator == 'glob' else regex.search
+            tests.append(lambda value, search=search: value is not MISSING and value is not None and search(unicode(value)) is not None)
+
+    if 'exists' in condition:
+        if not isinstance(condition['exists'], bool):
+            raise AttributeError("%s: match %s: exists must be true or false" % (name, field))
+        wanted = condition['exists']
+        tests.append(lambda value: (value is not MISSING) == wanted)
+    else:
+        tests.insert(0, lambda value: value is not MISSING)
+
+    return lambda value: all(test(value) for test in tests)
+
+
+def get_field(field, args, kwargs):
+    """Returns the value of a dotted field name from a handler's arguments, or MISSING"""
+    parts = field.split(".")
+
+    if parts[0] == 'capture':
+        re_obj = kwargs.get('re_obj')
+        key    = kwargs.get('key')
+        if re_obj is None or key is None or len(parts) != 2:
+            return MISSING
+        m = re_obj.match(key)
+        try:
+            value = m.group(int(parts[1]) if parts[1].isdigit() else parts[1])
+        except (AttributeError, IndexError):
+            return MISSING
+        return MISSING if value is None else value
+
+    if parts[0] not in kwargs:
+        return MISSING
+
+    value = kwargs[parts[0]]
+    for part in parts[1:]:
+        try:
+            if isinstance(value, (list, tuple)):
+                value = value[int(part)]
+            else:
+                value = value[part]
+        except (KeyError, IndexError, ValueError, TypeError):
+            return MISSING
+    return value
+
+
+class Predicate(object):
+    """A compiled match dictionary: calling it with a handler's arguments returns True if the event matches"""
+
+    def __init__(self, name, spec):
+        if not isinstance(spec, dict) or not spec:
+            raise AttributeError("%s: match must be a dictionary of fields and conditions" % name)
+
+        self.fields = [ (field, compile_condition(name, field, condition)) for field, condition in sorted(spec.items()) ]
+
+    def __call__(self, args, kwargs):
+        for field, test in self.fields:
+            if not test(get_field(field, args, kwargs)):
+                return False
+        return True
+
+
+class MatchingHandler(object):
+    """Calls a handler only for events which satisfy its Predicate"""
+
+    def __init__(self, handler, predicate, key, metrics=None):
+        self.handler   = handler
+        self.predicate = predicate
+        self.key       = key        # Handlers receive the configured key unless the event has its own
+        self.metrics   = metrics
+
+    def __call__(self, *args, **kwargs):
+        if 'key' in kwargs:
+            matched = self.predicate(args, kwargs)
+        else:
+            matched = self.predicate(args, dict(kwargs, key=self.key))
+
+        if not matched:
+            if self.metrics is not None:
+                self.metrics.unmatched += 1
+            return None
+
+        return self.handler(*args, **kwargs)
+
+    def flush(self):
+        if hasattr(self.handler, 'flush'):
+            self.handler.flush()
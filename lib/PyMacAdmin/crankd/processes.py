@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Runs Python handlers in separate worker processes
+
+Handlers normally share crankd's process: a CPU-bound handler holds the GIL
+while every other event waits, and a crash in an extension module or ctypes
+call takes the daemon down with it. A function or method handler whose
+configuration sets worker_group to a name runs in that group's worker
+process instead:
+
+    - crankd keeps every operating system subscription and forwards each
+      call over a pipe as a line of JSON; payload values are converted as
+      they are for recordings, so handlers receive plain dicts, lists and
+      strings rather than Cocoa objects
+    - each group has one process and its own bounded queue: calls run one at
+      a time, in the order they arrived, and the oldest waiting call is
+      dropped if the queue is full
+    - a process which exits or crashes is restarted after a delay which
+      doubles with each consecutive crash, up to max_delay seconds; the call
+      it was running counts as a failure
+    - processes are started when their group is first used and run a fresh
+      interpreter ("python -m PyMacAdmin.crankd.processes"), so nothing is
+      inherited from crankd's Cocoa process
+"""
+
+import errno
+import json
+import logging
+import os
+import re
+import signal
+import subprocess
+import sys
+import time
+import traceback
+from collections import deque
+from functools import partial
+
+from . import actions
+from .events import normalize
+from .loop import set_nonblocking
+
+DEFAULT_QUEUE_SIZE = 1000
+
+# The directory containing the PyMacAdmin package, which worker processes need to import:
+PACKAGE_PATH = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class WorkerProcess(object):
+    """
+    The process for one worker group, its queue of calls and its statistics
+
+    definitions maps handler IDs to (key, event config, context); each
+    process is sent the definition of a handler before its first call.
+    drop_hooks are called with the context of each call dropped from the
+    queue.
+    """
+
+    def __init__(self, name, loop, definitions, max_queue=DEFAULT_QUEUE_SIZE, restart_delay=1.0, max_delay=60.0, drop_hooks=()):
+        self.name          = name
+        self.loop          = loop
+        self.definitions   = definitions
+        self.drop_hooks    = drop_hooks
+        self.max_queue     = max_queue
+        self.restart_delay = restart_delay
+        self.max_delay     = max_delay
+
+        self.process       = None
+        self.reader        = None
+        self.buffer        = ""
+        self.pending       = deque()    # (handler ID, args, kwargs) waiting for the process
+        self.running       = None       # The call the process is working on
+        self.defined       = set()      # Handler IDs the current process has been sent
+        self.timer         = None       # Restarts the process after a crash
+        self.crashed       = 0          # Consecutive crashes, for the restart delay
+        self.closed        = False
+
+        # Counters:
+        self.calls         = 0
+        self.completed     = 0
+        self.failures      = 0
+        self.crashes       = 0
+        self.restarts      = 0
+        self.dropped       = 0
+        self.reported      = 0          # Dropped calls which have been logged
+
+    def __len__(self):
+        return len(self.pending) + (self.running is not None)
+
+    @property
+    def pid(self):
+        return self.process.pid if self.process else None
+
+    def submit(self, handler_id, args, kwargs):
+        """Queues a call; args and kwargs must already be JSON-compatible"""
+        if self.closed:
+            raise RuntimeError("Worker group %s has been shut down" % self.name)
+
+        self.calls += 1
+        if len(self.pending) >= self.max_queue:
+            dropped_id = self.pending.popleft()[0]
+            self.dropped += 1
+            for hook in self.drop_hooks:
+                hook(self.definitions[dropped_id][2])
+
+        self.pending.append((handler_id, args, kwargs))
+        self.send_next()
+
+    def start(self):
+        """Starts a new worker process"""
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [ PACKAGE_PATH, env.get('PYTHONPATH') ]))
+
+        try:
+            self.process = subprocess.Popen(
+                [ sys.executable, "-m", "PyMacAdmin.crankd.processes", self.name ],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env, close_fds=True
+            )
+        except OSError, exc:
+            logging.error("Worker group %s: unable to start a worker process: %s" % (self.name, exc))
+            self.crashed += 1
+            self.schedule_restart()
+            return
+
+        set_nonblocking(self.process.stdout.fileno())
+        self.reader  = self.loop.add_reader(self.process.stdout.fileno(), self.read)
+        self.buffer  = ""
+        self.defined = set()
+        self.write([ [ 'init', sys.path ] ])
+
+        logging.info("Worker group %s: started process %d" % (self.name, self.process.pid))
+
+    def send_next(self):
+        """Sends the oldest queued call if the process is idle, starting the process if necessary"""
+        if self.dropped > self.reported:
+            logging.warning("Worker group %s: %d call(s) were dropped because the queue was full" % (self.name, self.dropped - self.reported))
+            self.reported = self.dropped
+
+        if self.running is not None or not self.pending or self.timer is not None:
+            return
+
+        if self.process is None:
+            self.start()
+            if self.process is None:
+                return
+
+        handler_id, args, kwargs = self.running = self.pending.popleft()
+
+        messages = list()
+        if handler_id not in self.defined:
+            key, event_config, context = self.definitions[handler_id]
+            messages.append([ 'define', handler_id, key, event_config, context ])
+            self.defined.add(handler_id)
+        messages.append([ 'call', handler_id, args, kwargs ])
+
+        self.write(messages)
+
+    def write(self, messages):
+        """Writes messages to the process; a process which has gone away is noticed by read()"""
+        data = "".join(json.dumps(m, separators=(',', ':')) + "\n" for m in messages)
+        try:
+            self.process.stdin.write(data)
+            self.process.stdin.flush()
+        except IOError, exc:
+            if exc.errno != errno.EPIPE:
+                raise
+
+    def read(self):
+        """Reads replies from the process"""
+        try:
+            data = os.read(self.process.stdout.fileno(), 65536)
+        except OSError, exc:
+            if exc.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            data = ""
+
+        if not data:
+            self.exited()
+            return
+
+        self.buffer += data
+        while "\n" in self.buffer:
+            line, self.buffer = self.buffer.split("\n", 1)
+            self.finished(json.loads(line)[1])
+
+    def finished(self, error):
+        """Records the result of the running call and sends the next one"""
+        handler_id, args, kwargs = self.running
+        self.running    = None
+        self.completed += 1
+        self.crashed    = 0
+
+        if error:
+            self.failures += 1
+            logging.error("%s: handler failed in worker group %s:\n%s" % (self.definitions[handler_id][2], self.name, error.rstrip()))
+
+        self.send_next()
+
+    def exited(self):
+        """Cleans up after the process exits and schedules a restart unless we're shutting down"""
+        self.reader.cancel()
+        self.reader = None
+
+        rc = self.process.poll()
+        if rc is None:
+            # It closed its end of the pipe but is still running:
+            self.process.kill()
+            rc = self.process.wait()
+
+        for f in (self.process.stdin, self.process.stdout):
+            try:
+                f.close()
+            except IOError:
+                pass
+        self.process = None
+
+        if self.closed:
+            return
+
+        self.crashes += 1
+        self.crashed += 1
+
+        if self.running is not None:
+            handler_id, args, kwargs = self.running
+            self.running   = None
+            self.failures += 1
+            logging.error("Worker group %s: the worker process exited with status %d while running %s" % (self.name, rc, self.definitions[handler_id][2]))
+        else:
+            logging.error("Worker group %s: the worker process exited with status %d" % (self.name, rc))
+
+        self.schedule_restart()
+
+    def schedule_restart(self):
+        """Restarts the process after a delay which grows with each consecutive crash"""
+        delay = min(self.max_delay, self.restart_delay * 2 ** (self.crashed - 1))
+        logging.info("Worker group %s: restarting in %0.1fs" % (self.name, delay))
+        self.timer = self.loop.call_later(delay, self.restart)
+
+    def restart(self):
+        self.timer     = None
+        self.restarts += 1
+        if self.process is None:
+            self.start()
+        self.send_next()
+
+    def shutdown(self, timeout=None):
+        """Lets the process finish the running call and exit; queued calls are discarded. Returns False if it had to be killed"""
+        self.closed = True
+
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        if self.pending:
+            logging.warning("Worker group %s: discarding %d queued call(s)" % (self.name, len(self.pending)))
+            self.pending.clear()
+
+        if self.process is None:
+            return True
+
+        process = self.process
+        try:
+            process.stdin.close()
+        except IOError:
+            pass
+
+        deadline = None if timeout is None else time.time() + timeout
+        while process.poll() is None and (deadline is None or time.time() < deadline):
+            time.sleep(0.01)
+
+        finished = process.poll() is not None
+        if not finished:
+            logging.warning("Worker group %s: killing process %d which had not finished after %ss" % (self.name, process.pid, timeout))
+            process.kill()
+            process.wait()
+
+        self.exited()
+        return finished
+
+
+class WorkerGroups(object):
+    """
+    The worker process for each group, started when the group is first used
+
+    drop_hooks are called with the context of each call which a full queue
+    dropped.
+    """
+
+    def __init__(self, loop, **settings):
+        self.loop        = loop
+        self.settings    = settings     # WorkerProcess keyword arguments
+        self.groups      = dict()       # name -> WorkerProcess
+        self.definitions = dict()       # handler ID -> (key, event config, context)
+        self.drop_hooks  = list()
+
+    def handler(self, group, key, event_config, context=None):
+        """Returns a handler which runs the handler described by event_config in group's process"""
+        handler_id = len(self.definitions) + 1
+        self.definitions[handler_id] = (key, event_config, context or key)
+        return RemoteHandler(self, group, handler_id, context or key)
+
+    def submit(self, group, handler_id, args, kwargs):
+        worker = self.groups.get(group)
+        if worker is None:
+            worker = self.groups[group] = WorkerProcess(group, self.loop, self.definitions, drop_hooks=self.drop_hooks, **self.settings)
+        worker.submit(handler_id, args, kwargs)
+
+    def idle(self):
+        """Returns True if no group has a call queued or running"""
+        return not any(len(worker) for worker in self.groups.values())
+
+    def shutdown(self, timeout=None):
+        """Stops every worker process"""
+        return all([ worker.shutdown(timeout) for worker in self.groups.values() ])
+
+
+class RemoteHandler(object):
+    """Forwards calls to a worker group"""
+
+    def __init__(self, groups, group, handler_id, name):
+        self.groups     = groups
+        self.group      = group
+        self.handler_id = handler_id
+        self.name       = name
+
+    def __call__(self, *args, **kwargs):
+        # Regexp handlers receive the pattern, which the worker compiles again:
+        if hasattr(kwargs.get('re_obj'), 'pattern'):
+            kwargs = dict(kwargs, re_obj=kwargs['re_obj'].pattern)
+        self.groups.submit(self.group, self.handler_id, normalize(args), normalize(kwargs))
+
+
+def create_handler(key, event_config, context):
+    """Creates the callable for a handler definition inside a worker process"""
+    for action, factory in actions.ACTIONS:
+        if action in event_config:
+            return partial(factory(event_config), context=context, key=key, config=event_config)
+    raise AttributeError("%s must have a function or method" % key)
+
+
+def serve(requests, replies):
+    """Runs the calls read from requests, writing a reply for each, until requests is closed"""
+    handlers = dict()
+
+    for line in iter(requests.readline, ""):
+        message = json.loads(line)
+
+        if message[0] == 'init':
+            sys.path.extend(p for p in message[1] if p not in sys.path)
+
+        elif message[0] == 'define':
+            handler_id, key, event_config, context = message[1:]
+            handlers[handler_id] = create_handler(key, event_config, context)
+
+        elif message[0] == 'call':
+            handler_id, args, kwargs = message[1:]
+            kwargs = dict((str(k), v) for k, v in kwargs.items())
+            if 're_obj' in kwargs:
+                kwargs['re_obj'] = re.compile(kwargs['re_obj'])
+
+            error = None
+            try:
+                handlers[handler_id](*args, **kwargs)
+            except Exception:
+                error = traceback.format_exc()
+
+            replies.write(json.dumps([ 'done', error ]) + "\n")
+            replies.flush()
+
+
+def main():
+    """The worker process: serves calls from crankd on stdin"""
+    name = sys.argv[1] if len(sys.argv) > 1 else "default"
+    logging.basicConfig(level=logging.INFO, format="crankd worker %s[%d]: %%(levelname)s: %%(message)s" % (name, os.getpid()))
+
+    # crankd stops us by closing our stdin:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # Handlers may print, so replies use a private copy of stdout:
+    replies = os.fdopen(os.dup(1), 'w')
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+
+    serve(sys.stdin, replies)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Profiles handlers while crankd runs
+
+crankd --profile[=DIR] sets actions.PROFILER, which wraps each handler created
+by get_callable_for_event (and each class handler's delegate method) so its
+calls are profiled under the handler's name. The statistics are written to
+DIR as one pstats file per handler, "<handler>.pstats", whenever crankd
+receives SIGUSR2 and when it exits; read them with the pstats module or any
+tool which understands its format. Each dump replaces the previous one and
+contains everything since crankd started.
+
+Profiler uses cProfile, which measures every call exactly but slows handlers
+down considerably. SamplingProfiler instead looks at the stack of each thread
+which is running a handler every interval seconds of wall-clock time and
+estimates the time spent in each function from the number of samples it
+appeared in, which costs little enough to leave running for a day; its
+pstats files count samples rather than calls.
+"""
+
+import cProfile
+import logging
+import marshal
+import os
+import re
+import sys
+import thread
+import threading
+
+
+def stats_file_name(directory, name):
+    """Returns the pstats file for the handler called name"""
+    return os.path.join(directory, re.sub(r'[^A-Za-z0-9_.-]+', '_', name).strip('_') + ".pstats")
+
+
+class ProfiledHandler(object):
+    """Wraps a handler so its calls are profiled under name"""
+
+    def __init__(self, handler, profiler, name):
+        self.handler  = handler
+        self.profiler = profiler
+        self.name     = name
+
+    def __call__(self, *args, **kwargs):
+        return self.profiler.run(self.name, self.handler, args, kwargs)
+
+
+class Profiler(object):
+    """Profiles handlers with cProfile, keeping a profile for each handler and thread"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.profiles  = dict()             # (name, thread ID) -> cProfile.Profile
+        self.local     = threading.local()  # Whether this thread is already profiling a handler
+        self.lock      = threading.Lock()
+        self.dumps     = 0
+
+    def wrap(self, handler, name):
+        return ProfiledHandler(handler, self, name)
+
+    def run(self, name, handler, args, kwargs):
+        # Only one profiler can be active in a thread; a handler which calls
+        # another is counted as part of the outer one:
+        if getattr(self.local, 'active', False):
+            return handler(*args, **kwargs)
+
+        key = (name, thread.get_ident())
+        with self.lock:
+            profile = self.profiles.get(key)
+            if profile is None:
+                profile = self.profiles[key] = cProfile.Profile()
+
+        self.local.active = True
+        try:
+            return profile.runcall(handler, *args, **kwargs)
+        finally:
+            self.local.active = False
+
+    def stats(self):
+        """Returns { handler name: pstats-format statistics dict }"""
+        with self.lock:
+            profiles = self.profiles.items()
+
+        stats = dict()
+        for (name, ident), profile in profiles:
+            profile.snapshot_stats()     # Unlike create_stats(), this leaves a running profile enabled
+            merged = stats.setdefault(name, dict())
+            for func, (cc, nc, tt, ct, callers) in profile.stats.items():
+                if func in merged:
+                    m_cc, m_nc, m_tt, m_ct, m_callers = merged[func]
+                    callers = add_callers(m_callers, callers)
+                    cc, nc, tt, ct = cc + m_cc, nc + m_nc, tt + m_tt, ct + m_ct
+                merged[func] = (cc, nc, tt, ct, callers)
+        return stats
+
+    def dump(self):
+        """Writes a pstats file for each handler which has been called; returns the list of files"""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        files = list()
+        for name, stats in sorted(self.stats().items()):
+            file_name = stats_file_name(self.directory, name)
+            with open(file_name + ".tmp", "wb") as f:
+                marshal.dump(stats, f)
+            os.rename(file_name + ".tmp", file_name)
+            files.append(file_name)
+
+        self.dumps += 1
+        logging.info("Wrote profiles for %d handler(s) to %s" % (len(files), self.directory))
+        return files
+
+    def stop(self):
+        pass
+
+
+def add_callers(target, source):
+    """Combines two pstats callers dictionaries"""
+    combined = dict(target)
+    for func, value in source.items():
+        if func in combined:
+            old = combined[func]
+            if isinstance(value, tuple):
+                value = tuple(a + b for a, b in zip(old, value))
+            else:
+                value = old + value
+        combined[func] = value
+    return combined
+
+
+class SamplingProfiler(Profiler):
+    """
+    Estimates where handlers spend their time by sampling the stacks of the
+    threads running them
+
+    A background thread wakes every interval seconds and records the stack of
+    each thread which is inside a handler, up to the handler's wrapper.
+    """
+
+    def __init__(self, directory, interval=0.01):
+        super(SamplingProfiler, self).__init__(directory)
+        self.interval = interval
+        self.active   = dict()      # thread ID -> name of the handler it's running
+        self.samples  = dict()      # name -> { stack (tuple of functions, outermost first): count }
+        self.thread   = None
+        self.stopped  = threading.Event()
+
+        # Counters:
+        self.sampled  = 0           # Wake-ups which found at least one handler running
+
+    def run(self, name, handler, args, kwargs):
+        ident = thread.get_ident()
+        if ident in self.active:
+            return handler(*args, **kwargs)
+
+        self.start()
+        self.active[ident] = name
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            del self.active[ident]
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.sample_forever, name="crankd profiler")
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def sample_forever(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        """Records the stack of every thread which is running a handler"""
+        active = self.active.items()
+        if not active:
+            return
+
+        frames = sys._current_frames()
+        with self.lock:
+            self.sampled += 1
+            for ident, name in active:
+                frame = frames.get(ident)
+                stack = list()
+                while frame is not None:
+                    if frame.f_code is SAMPLING_RUN_CODE:
+                        break
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                else:
+                    continue    # The handler returned before we looked
+
+                if stack:
+                    stack.reverse()
+                    counts = self.samples.setdefault(name, dict())
+                    stack  = tuple(stack)
+                    counts[stack] = counts.get(stack, 0) + 1
+
+    def stats(self):
+        """Converts the samples to pstats statistics: times are samples * interval and counts are samples"""
+        with self.lock:
+            samples = dict((name, dict(counts)) for name, counts in self.samples.items())
+
+        stats = dict()
+        for name, counts in samples.items():
+            entries = dict()    # func -> [ samples on the stack, samples at the top, { caller: samples } ]
+            for stack, count in counts.items():
+                for i, func in enumerate(stack):
+                    entry = entries.setdefault(func, [ 0, 0, dict() ])
+                    if func not in stack[:i]:       # Recursive calls are only counted once
+                        entry[0] += count
+                    if i:
+                        caller = stack[i - 1]
+                        entry[2][caller] = entry[2].get(caller, 0) + count
+                entries[stack[-1]][1] += count
+
+            stats[name] = dict(
+                (func, (total, total, top * self.interval, total * self.interval, callers))
+                for func, (total, top, callers) in entries.items()
+            )
+        return stats
+
+
+SAMPLING_RUN_CODE = SamplingProfiler.run.im_func.func_code
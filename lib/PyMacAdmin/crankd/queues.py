@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Bounded queues between event sources and the dispatcher
+
+Once the dispatcher has started, each EventSource puts the events reported by
+the operating system on an EventQueue and returns; the queue dispatches them
+from the event loop in batches so a flood from one source can't starve the
+others. When a queue is full its overflow policy decides what happens:
+
+drop-oldest:  discard the oldest queued event
+drop-newest:  discard the new event
+coalesce:     replace a queued event with the same key, so only the latest
+              state is delivered (keeping the first event's old_value); if
+              the key isn't queued, discard the oldest event and queue a
+              "rescan" event for its root instead, e.g. the watched directory
+              for FSEvents, so handlers know to look again rather than
+              silently losing state
+block:        dispatch the oldest events immediately, delaying the operating
+              system's callback until there is room
+
+Each queue counts its depth, high-water mark and dropped, coalesced and
+rescan events. Queues are configured per source in the Queues section of the
+configuration, which may also limit the rate at which a source's events are
+dispatched (see PyMacAdmin.crankd.ratelimit):
+
+    <key>Queues</key>
+    <dict>
+        <key>FSEvents</key>
+        <dict>
+            <key>max_size</key>     <integer>500</integer>
+            <key>overflow</key>     <string>coalesce</string>
+        </dict>
+        <key>NSDistributed</key>
+        <dict>
+            <key>rate_limit</key>
+            <dict>
+                <key>rate</key>     <integer>10</integer>
+                <key>policy</key>   <string>latest</string>
+            </dict>
+        </dict>
+    </dict>
+"""
+
+import logging
+from collections import OrderedDict, deque
+
+from .ratelimit import get_rate_limit_settings
+
+OVERFLOW_POLICIES  = ( 'drop-oldest', 'drop-newest', 'coalesce', 'block' )
+DEFAULT_QUEUE_SIZE = 1000
+
+
+def get_queue_settings(name, settings):
+    """Returns validated EventQueue keyword arguments from a Queues entry; raises AttributeError"""
+    if not isinstance(settings, dict):
+        raise AttributeError("Queues %s must be a dictionary" % name)
+
+    kwargs = dict()
+
+    for k in ('max_size', 'batch_size'):
+        if k in settings:
+            v = settings[k]
+            if not isinstance(v, (int, long)) or isinstance(v, bool) or v < 1:
+                raise AttributeError("Queues %s: %s must be a positive integer, not %r" % (name, k, v))
+            kwargs[k] = v
+
+    if 'overflow' in settings:
+        if settings['overflow'] not in OVERFLOW_POLICIES:
+            raise AttributeError("Queues %s: overflow must be one of %s, not %r" % (name, ", ".join(OVERFLOW_POLICIES), settings['overflow']))
+        kwargs['overflow'] = settings['overflow']
+
+    if 'rate_limit' in settings:
+        kwargs['rate_limit'] = get_rate_limit_settings("Queues %s" % name, settings['rate_limit'])
+
+    unknown = set(settings) - set(('max_size', 'batch_size', 'overflow', 'rate_limit'))
+    if unknown:
+        raise AttributeError("Queues %s: unknown settings %s" % (name, ", ".join(sorted(unknown))))
+
+    return kwargs
+
+
+class EventQueue(object):
+    """
+    A bounded queue of events waiting to be dispatched
+
+    deliver(event) dispatches an event. call_later(delay, callback) must
+    schedule callback on the event loop and return an object with a cancel()
+    method. rescan(event) returns the event which replaces a dropped event on
+    a coalescing queue; events with the same key are only queued once.
+    """
+
+    def __init__(self, name, deliver, call_later, rescan=None, max_size=DEFAULT_QUEUE_SIZE, overflow='drop-oldest', batch_size=100):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy %s" % overflow)
+
+        self.name       = name
+        self.deliver    = deliver
+        self.call_later = call_later
+        self.rescan     = rescan or (lambda event: event)
+        self.max_size   = max_size
+        self.overflow   = overflow
+        self.batch_size = batch_size
+
+        self.events     = deque()
+        self.by_key     = dict()            # key -> queued Event, for the coalesce policy
+        self.rescans    = OrderedDict()     # key -> rescan Event, delivered before the queued events
+        self.timer      = None
+
+        # Counters:
+        self.enqueued   = 0
+        self.high_water = 0
+        self.dropped    = 0
+        self.coalesced  = 0
+        self.rescanned  = 0
+        self.blocked    = 0                 # Events dispatched early by the block policy
+        self.reported   = 0                 # Dropped events which have been logged
+
+    def __len__(self):
+        return len(self.events) + len(self.rescans)
+
+    def configure(self, max_size=DEFAULT_QUEUE_SIZE, overflow='drop-oldest', batch_size=100):
+        """Changes the queue's settings; events already queued are kept"""
+        if overflow != self.overflow:
+            self.by_key = dict((e.key, e) for e in self.events) if overflow == 'coalesce' else dict()
+        self.max_size   = max_size
+        self.overflow   = overflow
+        self.batch_size = batch_size
+
+    def put(self, event):
+        """Queues an event, applying the overflow policy if the queue is full"""
+        self.enqueued += 1
+
+        if self.overflow == 'coalesce':
+            queued = self.by_key.get(event.key)
+            if queued is not None:
+                self.coalesced += 1
+                payload = event.payload
+                for k in ('recursive', 'rescan'):
+                    if queued.payload.get(k) and not payload.get(k):
+                        payload = dict(payload, **{k: True})
+                # Handlers see the change from the first event's old value,
+                # and FSEvents handlers the first event's ID so the events
+                # before a checkpoint have all been dispatched:
+                for k in ('old_value', 'old_values', 'event_id'):
+                    if k in queued.payload:
+                        payload = dict(payload, **{k: queued.payload[k]})
+                queued.payload = payload
+                return
+
+        if len(self.events) >= self.max_size:
+            if self.overflow == 'drop-newest':
+                self.dropped += 1
+                self.schedule()
+                return
+            elif self.overflow == 'block':
+                while len(self.events) >= self.max_size:
+                    self.blocked += 1
+                    self.deliver(self.events.popleft())
+            else:
+                dropped = self.events.popleft()
+                self.dropped += 1
+                if self.overflow == 'coalesce':
+                    if self.by_key.get(dropped.key) is dropped:
+                        del self.by_key[dropped.key]
+                    rescan = self.rescan(dropped)
+                    if rescan.key not in self.rescans:
+                        self.rescanned += 1
+                        self.rescans[rescan.key] = rescan
+
+        self.events.append(event)
+        if self.overflow == 'coalesce':
+            self.by_key[event.key] = event
+
+        self.high_water = max(self.high_water, len(self))
+        self.schedule()
+
+    def schedule(self):
+        if self.timer is None:
+            self.timer = self.call_later(0, self.drain)
+
+    def drain(self):
+        """Dispatches pending rescans and up to batch_size events, then yields to the event loop"""
+        self.timer = None
+
+        if self.dropped > self.reported:
+            logging.warning("%s: %d event(s) were dropped because the queue was full (%d queued, overflow policy %s)" % (
+                self.name, self.dropped - self.reported, len(self), self.overflow
+            ))
+            self.reported = self.dropped
+
+        rescans, self.rescans = self.rescans.values(), OrderedDict()
+        for event in rescans:
+            self.deliver(event)
+
+        for i in range(min(self.batch_size, len(self.events))):
+            event = self.events.popleft()
+            if self.by_key.get(event.key) is event:
+                del self.by_key[event.key]
+            self.deliver(event)
+
+        if self.events or self.rescans:
+            self.schedule()
+
+    def flush(self):
+        """Dispatches every queued event immediately"""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        while self.events or self.rescans:
+            self.drain()
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Token-bucket rate limiting for handlers and event sources
+
+Some notifications fire many times a second (com.apple.iTunes.playerInfo, a
+flapping interface's Link key) and a command handler forks a shell for each
+one. An event configuration, or a source's entry in the Queues section, may
+contain a rate_limit dictionary:
+
+rate:         the sustained number of calls allowed per second
+burst:        the number of calls allowed at once before the rate applies
+              (default 1)
+policy:       what to do with a call which exceeds the limit:
+              drop    discard it (the default)
+              defer   hold it until the bucket refills; at most max_pending
+                      calls wait and the oldest is discarded beyond that
+              latest  hold only the newest call for each key (event key,
+                      SystemConfiguration key or FSEvents path), so the
+                      handler sees the current state once the limit allows
+
+Handlers are limited after debounce and coalesce, so the limit applies to
+the calls which actually run; source limits apply to every event before the
+dispatcher looks for handlers.
+"""
+
+import logging
+import time
+from collections import OrderedDict
+
+RATE_LIMIT_POLICIES = ( 'drop', 'defer', 'latest' )
+DEFAULT_MAX_PENDING = 1000
+
+
+def get_rate_limit_settings(name, settings):
+    """Returns validated RateLimiter keyword arguments from a rate_limit dictionary; raises AttributeError"""
+    if not isinstance(settings, dict):
+        raise AttributeError("%s: rate_limit must be a dictionary" % name)
+
+    try:
+        rate = float(settings['rate'])
+    except KeyError:
+        raise AttributeError("%s: rate_limit must include a rate" % name)
+    except (TypeError, ValueError):
+        raise AttributeError("%s: rate_limit rate must be a number of calls per second, not %r" % (name, settings['rate']))
+    if rate <= 0:
+        raise AttributeError("%s: rate_limit rate must be positive" % name)
+
+    kwargs = { 'rate': rate }
+
+    for k in ('burst', 'max_pending'):
+        if k in settings:
+            v = settings[k]
+            if not isinstance(v, (int, long)) or isinstance(v, bool) or v < 1:
+                raise AttributeError("%s: rate_limit %s must be a positive integer, not %r" % (name, k, v))
+            kwargs[k] = v
+
+    if 'policy' in settings:
+        if settings['policy'] not in RATE_LIMIT_POLICIES:
+            raise AttributeError("%s: rate_limit policy must be one of %s, not %r" % (name, ", ".join(RATE_LIMIT_POLICIES), settings['policy']))
+        kwargs['policy'] = settings['policy']
+
+    unknown = set(settings) - set(('rate', 'burst', 'policy', 'max_pending'))
+    if unknown:
+        raise AttributeError("%s: unknown rate_limit settings %s" % (name, ", ".join(sorted(unknown))))
+
+    return kwargs
+
+
+def call_key(args, kwargs):
+    """The key used by the latest policy for handler calls"""
+    return kwargs.get('key') or kwargs.get('path')
+
+
+class TokenBucket(object):
+    """Allows burst calls at once and rate calls per second after that"""
+
+    def __init__(self, rate, burst=1, clock=time.time):
+        self.rate    = rate
+        self.burst   = burst
+        self.clock   = clock
+        self.tokens  = float(burst)
+        self.updated = clock()
+
+    def refill(self):
+        now          = self.clock()
+        self.tokens  = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        """Uses a token if one is available"""
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def delay(self):
+        """Returns the number of seconds until the next token is available"""
+        self.refill()
+        return max(0, (1 - self.tokens) / self.rate)
+
+
+class RateLimiter(object):
+    """
+    Wraps a callable so it is called at most rate times per second
+
+    call_later(delay, callback) must schedule callback on the event loop and
+    return an object with a cancel() method. key(args, kwargs) identifies
+    calls which replace each other under the latest policy.
+    """
+
+    def __init__(self, callback, call_later, rate, burst=1, policy='drop', max_pending=DEFAULT_MAX_PENDING, name=None, key=call_key, clock=time.time):
+        if policy not in RATE_LIMIT_POLICIES:
+            raise ValueError("Unknown rate limit policy %s" % policy)
+
+        self.callback    = callback
+        self.call_later  = call_later
+        self.bucket      = TokenBucket(rate, burst, clock)
+        self.policy      = policy
+        self.max_pending = max_pending
+        self.name        = name
+        self.key         = key
+
+        self.pending     = OrderedDict()    # key -> (args, kwargs), in the order they will be released
+        self.sequence    = 0                # Keys for deferred calls
+        self.timer       = None
+
+        # Counters:
+        self.allowed     = 0                # Calls made, immediately or after waiting
+        self.throttled   = 0                # Calls which exceeded the limit
+        self.dropped     = 0
+        self.replaced    = 0                # Held calls replaced by a newer call for the same key
+
+    def __call__(self, *args, **kwargs):
+        # Calls which are already waiting go first:
+        if not self.pending and self.bucket.take():
+            self.allowed += 1
+            return self.callback(*args, **kwargs)
+
+        self.throttled += 1
+
+        if self.policy == 'drop':
+            if not self.dropped % 100:
+                logging.warning("%s: rate limit exceeded; dropped %d call(s) so far" % (self.name, self.dropped + 1))
+            self.dropped += 1
+            return None
+
+        if self.policy == 'latest':
+            key = self.key(args, kwargs)
+            if key in self.pending:
+                self.replaced += 1
+        else:
+            self.sequence += 1
+            key = self.sequence
+
+        if key not in self.pending and len(self.pending) >= self.max_pending:
+            self.pending.popitem(last=False)
+            self.dropped += 1
+
+        self.pending[key] = (args, kwargs)
+        self.schedule()
+
+    def schedule(self):
+        if self.timer is None and self.pending:
+            self.timer = self.call_later(self.bucket.delay(), self.release)
+
+    def release(self):
+        """Called by the timer: makes held calls as tokens become available"""
+        self.timer = None
+        while self.pending and self.bucket.take():
+            self.run(*self.pending.popitem(last=False)[1])
+        self.schedule()
+
+    def run(self, args, kwargs):
+        self.allowed += 1
+        try:
+            self.callback(*args, **kwargs)
+        except Exception:
+            logging.exception("%s: rate limited call failed" % self.name)
+
+    def flush(self):
+        """Makes every held call immediately, e.g. before the handler is removed"""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        while self.pending:
+            self.run(*self.pending.popitem(last=False)[1])
+        if hasattr(self.callback, 'flush'):
+            self.callback.flush()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Records crankd events and replays them through the dispatcher
+
+Recordings are append-only files with one compact JSON array per event:
+
+    [timestamp, source, key, payload]
+
+Payload values are converted to plain Python types by
+PyMacAdmin.crankd.events.normalize: mappings (including NSDictionary) become
+dicts, sequences become lists, NSNotification objects become their name and
+anything else becomes its string description.
+
+Replaying loads a configuration using the portable event sources, so no
+operating system subscriptions are made, and feeds the recorded events
+through the normal Dispatcher either with their original timing (optionally
+sped up) or as fast as possible. When the recording is exhausted and every
+child process, threaded handler and worker group has finished a report with
+throughput, per-handler latency percentiles and queue depth is logged.
+"""
+
+import json
+import signal
+
+from . import actions
+from .config import configure_sources
+from .events import Dispatcher, Event, EventSource, handler_name, normalize
+from .executor import CommandExecutor
+from .loop import SelectEventLoop
+from .processes import WorkerGroups
+from .sources import SystemConfigurationSource, FileSystemSource, NetServiceSource, LocationSource
+from .workers import WorkerPool
+
+# Event sources used to replay each configuration section:
+REPLAY_SOURCES = {
+    'NSDistributed':       EventSource,
+    'NSWorkspace':         EventSource,
+    'SystemConfiguration': SystemConfigurationSource,
+    'FSEvents':            FileSystemSource,
+    'NSNetService':        NetServiceSource,
+    'CLLocation':          LocationSource,
+    'Timers':              EventSource,     # Recorded runs are replayed, not rescheduled
+}
+
+
+class EventRecorder(object):
+    """Appends every dispatched event to a recording; use as a Dispatcher event hook"""
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.output    = open(file_name, 'a')
+        self.recorded  = 0
+
+    def __call__(self, event):
+        self.output.write(json.dumps(
+            [ round(event.timestamp, 6), event.source, normalize(event.key), normalize(event.payload) ],
+            separators=(',', ':')
+        ))
+        self.output.write("\n")
+        self.output.flush()
+        self.recorded += 1
+
+    def close(self):
+        self.output.close()
+
+
+def read_events(file_name):
+    """Yields the Event objects in a recording"""
+    for line_number, line in enumerate(open(file_name), 1):
+        if not line.strip():
+            continue
+        try:
+            timestamp, source, key, payload = json.loads(line)
+        except ValueError, exc:
+            raise ValueError("%s:%d: invalid event record: %s" % (file_name, line_number, exc))
+        if isinstance(key, list):
+            key = tuple(key)        # SystemConfiguration batches
+        yield Event(source, key, dict((str(k), v) for k, v in payload.items()), timestamp)
+
+
+def percentile(sorted_values, fraction):
+    """Returns the value at fraction (0-1) of a sorted list using the nearest-rank method"""
+    if not sorted_values:
+        return 0
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class ReplayStats(object):
+    """Collects handler latencies and queue depth during a replay"""
+
+    def __init__(self):
+        self.latencies   = dict()   # handler name -> [seconds]
+        self.errors      = dict()   # handler name -> count
+        self.lag         = list()   # milliseconds behind the recorded timing, sampled at each dispatch
+        self.child_depth = list()   # running + queued shell commands, sampled at each dispatch
+
+    def record_handler(self, event, handler, elapsed, error):
+        """Dispatcher handler hook"""
+        name = handler_name(handler)
+        self.latencies.setdefault(name, list()).append(elapsed)
+        if error is not None:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def report(self, event_count, elapsed):
+        """Returns the report as a list of lines"""
+        lines = [ "Replayed %d events in %0.3fs: %0.1f events/s" % (event_count, elapsed, event_count / elapsed if elapsed else 0) ]
+
+        for name, values in (("Dispatch lag (ms)", self.lag), ("Shell commands running or queued", self.child_depth)):
+            if values:
+                lines.append("%s: mean %0.1f, max %d" % (name, float(sum(values)) / len(values), max(values)))
+
+        lines.append("%8s %10s %10s %10s %10s %7s  %s" % ("Calls", "p50 ms", "p90 ms", "p99 ms", "max ms", "Errors", "Handler"))
+        for name in sorted(self.latencies):
+            values = sorted(self.latencies[name])
+            lines.append("%8d %10.3f %10.3f %10.3f %10.3f %7d  %s" % (
+                len(values),
+                1000 * percentile(values, 0.5),
+                1000 * percentile(values, 0.9),
+                1000 * percentile(values, 0.99),
+                1000 * values[-1],
+                self.errors.get(name, 0),
+                name
+            ))
+
+        return lines
+
+
+class Replayer(object):
+    """
+    Feeds recorded events to a dispatcher from an event loop
+
+    rate is a speed multiplier for the original timing: 1 replays in real
+    time, 10 ten times faster and 0 as fast as possible.
+    """
+
+    def __init__(self, dispatcher, loop, events, rate=1.0, batch_size=100):
+        self.dispatcher = dispatcher
+        self.loop       = loop
+        self.events     = iter(events)
+        self.rate       = rate
+        self.batch_size = batch_size
+        self.stats      = ReplayStats()
+        self.count      = 0
+        self.next_event = None
+        self.finished   = False
+
+        dispatcher.handler_hooks.append(self.stats.record_handler)
+
+    def start(self):
+        self.started    = self.loop.time()
+        self.next_event = next(self.events, None)
+        self.origin     = self.next_event.timestamp if self.next_event else 0
+        self.loop.call_later(0, self.run_batch)
+
+    def due(self, event):
+        """Returns the loop time when event should be dispatched"""
+        if not self.rate:
+            return self.started
+        return self.started + (event.timestamp - self.origin) / self.rate
+
+    def run_batch(self):
+        """Dispatches every event which is due, up to batch_size, then yields to the loop"""
+        now = self.loop.time()
+        for i in range(self.batch_size):
+            event = self.next_event
+            if event is None or self.due(event) > now:
+                break
+
+            self.next_event = next(self.events, None)
+            self.sample(event, now)
+            self.dispatcher.dispatch(event)
+            self.count += 1
+
+        if self.next_event is None:
+            self.finished = True
+            self.wait_for_children()
+        else:
+            self.loop.call_later(max(0, self.due(self.next_event) - self.loop.time()), self.run_batch)
+
+    def sample(self, event, now):
+        """Records how far behind the recorded timing we are and the shell command queue depth"""
+        if self.rate:
+            self.stats.lag.append(int(max(0, now - self.due(event)) * 1000))
+
+        executor = actions.COMMAND_EXECUTOR
+        if executor is not None:
+            self.stats.child_depth.append(len(executor.running) + len(executor.pending))
+
+    def wait_for_children(self):
+        """Stops the loop once every shell command, threaded handler and worker group has finished"""
+        executor = actions.COMMAND_EXECUTOR
+        workers  = actions.WORKER_POOL
+        groups   = actions.WORKER_GROUPS
+        if executor is not None and (executor.running or executor.pending):
+            executor.reap()
+            self.loop.call_later(0.05, self.wait_for_children)
+        elif workers is not None and not workers.join(0):
+            self.loop.call_later(0.05, self.wait_for_children)
+        elif groups is not None and not groups.idle():
+            self.loop.call_later(0.05, self.wait_for_children)
+        else:
+            self.elapsed = self.loop.time() - self.started
+            self.loop.stop()
+
+
+def replay(config, file_name, rate=1.0, max_children=4, max_workers=4):
+    """Replays a recording against config, returning the report lines"""
+    loop = actions.EVENT_LOOP = SelectEventLoop()
+    actions.COMMAND_EXECUTOR  = CommandExecutor(loop.call_later, max_children=max_children)
+    actions.WORKER_POOL       = WorkerPool(max_workers)
+    actions.WORKER_GROUPS     = WorkerGroups(loop)
+    loop.add_signal_handler(signal.SIGCHLD, lambda signum: actions.COMMAND_EXECUTOR.reap())
+
+    dispatcher = Dispatcher()
+    configure_sources(dispatcher, config, REPLAY_SOURCES)
+
+    # Events for sections which aren't configured are counted as unhandled:
+    for name in set(REPLAY_SOURCES) - set(dispatcher.sources):
+        dispatcher.add_source(REPLAY_SOURCES[name](name))
+
+    replayer = Replayer(dispatcher, loop, read_events(file_name), rate=rate)
+    replayer.start()
+    loop.run()
+    actions.WORKER_GROUPS.shutdown(timeout=5.0)
+
+    report = replayer.stats.report(replayer.count, replayer.elapsed)
+    report.append("Unhandled events: %d, handler failures: %d" % (dispatcher.unhandled, dispatcher.failures))
+    return report
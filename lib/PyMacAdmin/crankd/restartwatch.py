@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Restarts crankd when its configuration or code changes
+
+A RestartWatch keeps a manifest of (mtime, size) for each file which should
+trigger a restart: the configuration file and the source of every loaded
+module except the standard library and OS-supplied frameworks, which change
+only when the system itself is updated. Only the outermost directories in
+the manifest are watched and a filesystem event for a directory checks just
+the files which live in it, so unrelated activity costs a dictionary lookup.
+"""
+
+import logging
+import os
+import sys
+from distutils import sysconfig
+
+
+def default_excludes():
+    """Returns the directories whose modules never trigger a restart"""
+    excludes = set([ "/System/Library/" ])
+    for prefix in (sys.prefix, sys.exec_prefix):
+        for plat_specific in (False, True):
+            excludes.add(os.path.join(os.path.realpath(sysconfig.get_python_lib(plat_specific, True, prefix)), ""))
+    return sorted(excludes)
+
+
+def source_file(file_name):
+    """Returns the .py file for a compiled module if it exists, otherwise file_name"""
+    base, ext = os.path.splitext(file_name)
+    if ext in ('.pyc', '.pyo') and os.path.exists(base + '.py'):
+        return base + '.py'
+    return file_name
+
+
+def file_signature(file_name):
+    """Returns (mtime, size) for file_name or None if it does not exist"""
+    try:
+        st = os.stat(file_name)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+
+class RestartWatch(object):
+    """
+    Calls restart(reason) when a file in the manifest changes, unless the file
+    was added with its own callback
+
+    exclude is a list of directory prefixes (ending in os.sep) whose modules
+    are ignored by add_modules(); third-party packages in site-packages or
+    dist-packages are watched even if they are installed below one of them.
+    """
+
+    def __init__(self, restart, exclude=None):
+        self.restart  = restart
+        self.exclude  = default_excludes() if exclude is None else exclude
+        self.manifest   = dict()     # directory -> { file name: (signature, reason, callback) }
+        self.subscribed = set()      # directories registered with the FileSystemSource
+
+    def is_excluded(self, file_name):
+        """Returns True if file_name belongs to the standard library or the OS"""
+        components = file_name.split(os.sep)
+        if "site-packages" in components or "dist-packages" in components:
+            return False
+        return any(file_name.startswith(prefix) for prefix in self.exclude)
+
+    def add(self, file_name, reason, callback=None):
+        """
+        Adds a file to the manifest; missing files are watched using their
+        closest existing parent. callback(reason) is called instead of
+        restart(reason) each time the file changes.
+        """
+        file_name = os.path.realpath(file_name)
+        while not os.path.exists(file_name):
+            file_name = os.path.dirname(file_name)
+
+        directory = file_name if os.path.isdir(file_name) else os.path.dirname(file_name)
+        self.manifest.setdefault(directory, dict())[file_name] = (file_signature(file_name), reason, callback)
+
+    def add_modules(self, modules):
+        """Adds the source of each new module which is not excluded, returning the number added"""
+        added = 0
+        for m in modules:
+            file_name = getattr(m, '__file__', None)
+            if not file_name:
+                continue
+
+            file_name = source_file(os.path.realpath(file_name))
+            if self.is_excluded(file_name) or file_name in self.manifest.get(os.path.dirname(file_name), ()):
+                continue
+
+            if m.__name__ == "__main__":
+                self.add(file_name, "%s was updated" % file_name)
+            else:
+                self.add(file_name, "Module %s was updated" % m.__name__)
+            added += 1
+        return added
+
+    def directories(self):
+        """Returns the smallest set of directories which covers every file in the manifest"""
+        roots = set()
+        for directory in sorted(self.manifest, key=len):
+            parent = directory
+            while parent not in roots and os.path.dirname(parent) != parent:
+                parent = os.path.dirname(parent)
+            if parent not in roots:
+                roots.add(directory)
+        return sorted(roots)
+
+    def subscribe(self, source):
+        """
+        Registers any of our directories which are not already watched with a
+        FileSystemSource, returning True if there were any
+        """
+        added = False
+        for directory in self.directories():
+            parent = directory
+            while parent not in self.subscribed and os.path.dirname(parent) != parent:
+                parent = os.path.dirname(parent)
+            if parent in self.subscribed:
+                continue
+
+            source.subscribe(directory, self.check)
+            self.subscribed.add(directory)
+            added = True
+
+        logging.debug("Watching %d files in %d directories for changes" % (
+            sum(len(files) for files in self.manifest.values()), len(self.manifest)
+        ))
+        return added
+
+    def check(self, watched_path=None, path=None, recursive=False, **kwargs):
+        """FileSystemSource handler: restarts if any manifest file in the changed directory was modified"""
+        if path is None or recursive:
+            root        = path or watched_path
+            prefix      = os.path.join(root, "")
+            directories = [ d for d in self.manifest if d == root or d.startswith(prefix) ]
+        elif path in self.manifest:
+            directories = [ path ]
+        else:
+            return
+
+        for directory in directories:
+            files = self.manifest[directory]
+            for file_name, (signature, reason, callback) in files.items():
+                current = file_signature(file_name)
+                if current == signature:
+                    continue
+
+                if callback is None:
+                    self.restart(reason)
+                    return
+
+                files[file_name] = (current, reason, callback)
+                callback(reason)
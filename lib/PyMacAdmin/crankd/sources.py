@@ -0,0 +1,548 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Event sources whose routing or delivery is more involved than an exact key match
+
+These classes only know how to map events to handlers: platform backends
+subclass them to subscribe to the operating system and call emit().
+"""
+
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+
+from . import actions
+from .events import Event, EventSource, handler_name
+from .geofence import Region, RegionIndex, distance
+from .keymatch import KeyMatcher
+from .pathtrie import PathTrie
+
+
+class SystemConfigurationSource(EventSource):
+    """
+    Routes SystemConfiguration keys to handlers
+
+    Keys starting with "regexp:" are regular expressions. Events must include
+    the changed key in their payload; handlers for regexp keys also receive
+    the compiled regular expression as re_obj.
+
+    Handlers configured with batch are called once for each notification
+    from the store rather than once per key: emit_changes() sends a single
+    event, keyed by the tuple of changed keys which batch handlers want, and
+    each batch handler receives the keys it matched as keys and a { key:
+    regexp groups } dict as captures.
+
+    When the source can read the store (see copy_values()) the values of
+    every changed key are fetched with a single request per notification and
+    compared with a snapshot of the previous values: handlers receive
+    old_value and new_value, or old_values and new_values dicts for batches,
+    and handlers configured with only_if_changed are skipped when a key was
+    rewritten with the same value.
+
+    Only the current value of a key matters so the queue coalesces events
+    for the same key; a dropped key is delivered again with rescan set.
+    """
+    name     = "SystemConfiguration"
+    overflow = 'coalesce'
+    store    = None                         # An object with copy_multiple(), e.g. a MemoryDynamicStore
+
+    def __init__(self, name=None):
+        super(SystemConfigurationSource, self).__init__(name)
+        self.matcher = KeyMatcher()
+        self.batch   = KeyMatcher()         # Handlers which receive every matching key at once
+        self.values  = dict()               # key -> last value seen
+
+    def add_handler(self, key, event_config):
+        if "class" in event_config:
+            return super(SystemConfigurationSource, self).add_handler(key, event_config)
+
+        handler = actions.get_callable_for_event(key, event_config, context=self.context(key))
+        if event_config.get('only_if_changed'):
+            handler = OnlyIfChanged(handler)
+
+        self.subscribe(key, handler, batch=bool(event_config.get('batch')))
+        return handler
+
+    def subscribe(self, key, handler, batch=False):
+        super(SystemConfigurationSource, self).subscribe(key, handler)
+        if batch:
+            self.batch.add(key, handler)
+        else:
+            self.matcher.add(key, handler)
+
+    def unsubscribe(self, key, handler):
+        super(SystemConfigurationSource, self).unsubscribe(key, handler)
+        try:
+            self.matcher.remove(key, handler)
+        except KeyError:
+            self.batch.remove(key, handler)
+
+    def notification_keys(self):
+        """Returns (explicit keys, regexp patterns), as needed by SCDynamicStoreSetNotificationKeys"""
+        keys     = set(self.matcher.explicit_keys()) | set(self.batch.explicit_keys())
+        patterns = set(self.matcher.regexp_patterns()) | set(self.batch.regexp_patterns())
+        return sorted(keys), sorted(patterns)
+
+    def copy_values(self, keys, patterns=()):
+        """
+        Returns { key: value } for each of keys, and every key matching one of
+        patterns, which exists in the store, or None if there is no store.
+        Platform backends override this to use SCDynamicStoreCopyMultiple.
+        """
+        if self.store is None:
+            return None
+        return self.store.copy_multiple(keys, patterns)
+
+    def load_values(self):
+        """Replaces the snapshot with the current value of every watched key; call when the watched keys change"""
+        values = self.copy_values(*self.notification_keys())
+        if values is not None:
+            self.values = dict(values)
+
+    def emit_changes(self, changed_keys, **payload):
+        """
+        Emits the keys reported by one SCDynamicStore callback: an event for
+        each key unless only batch handlers want it, then one event for the
+        batch handlers
+        """
+        batched = [ key for key in changed_keys if self.batch.resolve(key) ]
+        only    = set(key for key in batched if not self.matcher.resolve(key))
+
+        current = self.copy_values(changed_keys)
+        if current is not None:
+            old_values = dict((key, self.values.get(key)) for key in changed_keys)
+            new_values = dict((key, current.get(key)) for key in changed_keys)
+            for key in changed_keys:
+                if key in current:
+                    self.values[key] = current[key]
+                else:
+                    self.values.pop(key, None)
+
+        for key in changed_keys:
+            if key not in only:
+                if current is None:
+                    self.emit(key, key=key, **payload)
+                else:
+                    self.emit(key, key=key, old_value=old_values[key], new_value=new_values[key], **payload)
+
+        if batched:
+            if current is None:
+                self.emit(tuple(batched), keys=batched, **payload)
+            else:
+                self.emit(tuple(batched), keys=batched,
+                    old_values=dict((k, old_values[k]) for k in batched),
+                    new_values=dict((k, new_values[k]) for k in batched),
+                    **payload
+                )
+
+    def resolve(self, event):
+        if isinstance(event.key, tuple):
+            return self.resolve_batch(event)
+
+        return [
+            (handler, (), {} if re_obj is None else {'re_obj': re_obj}) for handler, re_obj in self.matcher.resolve(event.key)
+        ]
+
+    def resolve_batch(self, event):
+        """Returns each batch handler with the keys it matched"""
+        matched = OrderedDict()     # handler -> (keys, captures)
+
+        for key in event.key:
+            for handler, re_obj in self.batch.resolve(key):
+                keys, captures = matched.setdefault(handler, ([], {}))
+                keys.append(key)
+                captures[key] = re_obj.match(key).groups() if re_obj is not None else ()
+
+        return [
+            (handler, (), {'keys': keys, 'captures': captures}) for handler, (keys, captures) in matched.items()
+        ]
+
+
+class OnlyIfChanged(object):
+    """
+    Wraps a SystemConfiguration handler so it is only called when a key's
+    value actually changed. Batch handlers are called with just the keys
+    which changed. Events without values, and rescans, are always delivered.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.name    = handler_name(handler)
+        self.skipped = 0
+
+    def __call__(self, *args, **kwargs):
+        if not kwargs.get('rescan'):
+            if 'new_values' in kwargs:
+                old, new = kwargs.get('old_values', {}), kwargs['new_values']
+                keys     = [ k for k in kwargs['keys'] if old.get(k) != new.get(k) ]
+                if len(keys) != len(kwargs['keys']):
+                    if not keys:
+                        self.skipped += 1
+                        return None
+                    captures = kwargs.get('captures', {})
+                    kwargs   = dict(kwargs, keys=keys, captures=dict((k, captures[k]) for k in keys if k in captures))
+            elif 'new_value' in kwargs and kwargs['new_value'] == kwargs.get('old_value'):
+                self.skipped += 1
+                return None
+
+        return self.handler(*args, **kwargs)
+
+    def flush(self):
+        if hasattr(self.handler, 'flush'):
+            self.handler.flush()
+
+
+class MemoryDynamicStore(object):
+    """
+    An in-memory stand-in for SCDynamicStore, used as
+    SystemConfigurationSource.store for tests and replays
+    """
+
+    def __init__(self, values=None):
+        self.values = dict(values or {})
+        self.copies = 0         # Number of copy_multiple() calls, i.e. round trips to configd
+
+    def set_value(self, key, value):
+        self.values[key] = value
+
+    def remove_value(self, key):
+        self.values.pop(key, None)
+
+    def copy_multiple(self, keys, patterns=()):
+        """Behaves like SCDynamicStoreCopyMultiple"""
+        self.copies += 1
+        keys    = set(keys)
+        regexps = [ re.compile(p) for p in patterns ]
+        return dict(
+            (k, v) for k, v in self.values.items() if k in keys or any(r.match(k) for r in regexps)
+        )
+
+
+class FileSystemSource(EventSource):
+    """
+    Routes filesystem events to every handler watching the changed directory
+    or one of its parents
+
+    Event keys are the changed directory. Handlers are called with the watched
+    path as their first argument, as crankd has always done.
+
+    The queue coalesces events for the same directory; if an event has to be
+    dropped, its outermost watched directory is rescanned recursively instead.
+    """
+    name     = "FSEvents"
+    overflow = 'coalesce'
+
+    def __init__(self, name=None):
+        super(FileSystemSource, self).__init__(name)
+        self.watches = PathTrie()
+
+    def context(self, key):
+        return "FSEvent: %s" % key
+
+    def subscribe(self, f_path, handler):
+        """Watches a file or directory: files are watched using their parent directory"""
+        path = os.path.realpath(os.path.expanduser(f_path))
+        if not os.path.exists(path):
+            raise AttributeError("Cannot add an FSEvent notification: %s does not exist!" % path)
+
+        if not os.path.isdir(path):
+            path = os.path.dirname(path)
+
+        super(FileSystemSource, self).subscribe(path, handler)
+        self.watches.add(path, handler)
+
+    def unsubscribe(self, f_path, handler):
+        """Stops watching a file or directory; the path need not exist any longer"""
+        # The file may have been replaced by a directory or removed since
+        # subscribe() so look for the handler everywhere if it isn't watching
+        # the path or its parent:
+        path = os.path.realpath(os.path.expanduser(f_path))
+        for path in [ path, os.path.dirname(path) ] + self.handlers.keys():
+            handlers = self.handlers.get(path, ())
+            if handler in handlers:
+                super(FileSystemSource, self).unsubscribe(path, handler)
+                self.watches.remove(path, handler)
+                return
+        raise KeyError(f_path)
+
+    def paths(self):
+        """Returns the list of watched directories"""
+        return self.watches.paths()
+
+    def rescan_event(self, event):
+        matches = self.watches.match(event.key)
+        root    = matches[0][0] if matches else event.key
+        return Event(self.name, root, dict(event.payload, path=root, recursive=True, rescan=True), event.timestamp)
+
+    def resolve(self, event):
+        handlers = list()
+        for watched_path, callbacks in self.watches.match(event.key):
+            logging.debug("FSEvent: %s: processing %d callback(s) for path %s" % (watched_path, len(callbacks), event.key))
+            handlers.extend((callback, (watched_path,), {}) for callback in callbacks)
+        return handlers
+
+
+RESOLVE_TTL = 3600.0        # Seconds a resolved service is remembered unless resolve_ttl is set
+
+
+def get_resolve_ttl(name, event_config):
+    """Returns the resolve_ttl for an NSNetService event; raises AttributeError if it's invalid"""
+    ttl = event_config.get('resolve_ttl', RESOLVE_TTL)
+    if not isinstance(ttl, (int, long, float)) or isinstance(ttl, bool) or ttl < 0:
+        raise AttributeError("%s: resolve_ttl must be a number of seconds, not %r" % (name, ttl))
+    return float(ttl)
+
+
+class ServiceBrowse(object):
+    """The resolve cache, pending batch and counters for one Bonjour service type"""
+
+    def __init__(self, ttl):
+        self.ttl         = ttl
+        self.cache       = dict()           # service key -> (expires, service_info)
+        self.added       = OrderedDict()    # service key -> service_info, for the next batch
+        self.gone        = OrderedDict()
+        self.resolving   = set()            # Keys of services found in this batch which haven't resolved yet
+        self.more_coming = False
+
+        # Counters:
+        self.announced   = 0                # Services reported by the browser
+        self.resolves    = 0
+        self.failures    = 0                # Resolves which failed or timed out
+        self.cache_hits  = 0                # Announcements of services which were already resolved
+        self.removals    = 0
+        self.batches     = 0
+
+
+class NetServiceSource(EventSource):
+    """
+    Routes Bonjour (mDNS) service announcements for each service type
+
+    The browser reports services one at a time with a "more coming" flag, so
+    a busy network can announce hundreds of services at once. Platform
+    backends report each announcement to service_found() and
+    service_removed(), implement resolve_service() and report its result to
+    service_resolved(); the source emits one event per burst, once the
+    browser has nothing more coming and every new service has resolved.
+    Handlers receive the resolved services as services, the removed services
+    as removed and, as they always have, the last resolved service as
+    service_info.
+
+    Resolved services are cached for resolve_ttl seconds: an announcement of
+    a service which is already cached neither resolves it again nor reaches
+    the handlers. Services are identified by (name, type, domain).
+    """
+    name = "NSNetService"
+
+    def __init__(self, name=None, clock=time.time):
+        super(NetServiceSource, self).__init__(name)
+        self.clock    = clock
+        self.browsing = dict()      # service type -> ServiceBrowse
+
+    def context(self, key):
+        return "NSNetServiceBrowser type: %s" % key
+
+    def add_handler(self, type_, event_config):
+        handler = super(NetServiceSource, self).add_handler(type_, event_config)
+        if handler is not None:
+            ttl = get_resolve_ttl("%s %s" % (self.name, type_), event_config)
+            self.browsing.setdefault(type_, ServiceBrowse(ttl)).ttl = ttl
+        return handler
+
+    def unsubscribe(self, type_, handler):
+        super(NetServiceSource, self).unsubscribe(type_, handler)
+        if type_ not in self.handlers:
+            self.browsing.pop(type_, None)
+
+    def resolve_service(self, type_, key, service):
+        """Asks the platform to resolve service; the result must be passed to service_resolved()"""
+        pass
+
+    def service_found(self, type_, key, service, more_coming):
+        browse = self.browsing.get(type_)
+        if browse is None:
+            return
+
+        browse.announced  += 1
+        browse.more_coming = more_coming
+
+        cached = browse.cache.get(key)
+        if cached is not None and cached[0] > self.clock():
+            browse.cache_hits += 1
+        elif key not in browse.resolving:
+            browse.resolving.add(key)
+            browse.resolves += 1
+            self.resolve_service(type_, key, service)
+
+        self.flush(type_)
+
+    def service_resolved(self, type_, key, service_info):
+        """Records the result of resolve_service(); service_info's resolved entry says whether it succeeded"""
+        browse = self.browsing.get(type_)
+        if browse is None or key not in browse.resolving:
+            return
+
+        browse.resolving.remove(key)
+        if service_info.get('resolved'):
+            browse.cache[key] = (self.clock() + browse.ttl, service_info)
+        else:
+            browse.failures += 1
+
+        browse.gone.pop(key, None)
+        browse.added[key] = service_info
+        self.flush(type_)
+
+    def service_removed(self, type_, key, service_info, more_coming):
+        browse = self.browsing.get(type_)
+        if browse is None:
+            return
+
+        browse.removals   += 1
+        browse.more_coming = more_coming
+        browse.cache.pop(key, None)
+        browse.resolving.discard(key)
+
+        # A service which comes and goes within one batch isn't reported at all:
+        if browse.added.pop(key, None) is None:
+            browse.gone[key] = service_info
+
+        self.flush(type_)
+
+    def flush(self, type_):
+        """Emits the pending batch for type_ once the browser and every resolve have finished"""
+        browse = self.browsing[type_]
+        if browse.more_coming or browse.resolving or not (browse.added or browse.gone):
+            return
+
+        services = browse.added.values()
+        removed  = browse.gone.values()
+        browse.added, browse.gone = OrderedDict(), OrderedDict()
+        browse.batches += 1
+
+        now = self.clock()
+        for key, (expires, service_info) in browse.cache.items():
+            if expires <= now:
+                del browse.cache[key]
+
+        self.emit(type_, service_info=services[-1] if services else None, services=services, removed=removed)
+
+
+def get_location_settings(name, event_config):
+    """
+    Returns the thresholds and geofence regions for a CLLocation event;
+    raises AttributeError if they're invalid
+    """
+    settings = dict()
+    for k in ('min_distance', 'min_interval', 'accuracy'):
+        v = event_config.get(k)
+        if v is not None and (not isinstance(v, (int, long, float)) or isinstance(v, bool) or v < 0 or (k == 'accuracy' and not v)):
+            raise AttributeError("%s: %s must be a %s number, not %r" % (name, k, "positive" if k == 'accuracy' else "non-negative", v))
+        settings[k] = None if v is None else float(v)
+
+    regions = event_config.get('regions')
+    if regions is not None and (not isinstance(regions, dict) or not regions):
+        raise AttributeError("%s: regions must be a dictionary of region names and their latitude, longitude and radius" % name)
+
+    settings['regions'] = list()
+    for region_name, region in sorted((regions or {}).items()):
+        try:
+            latitude, longitude, radius = [ float(region[k]) for k in ('latitude', 'longitude', 'radius') ]
+        except (KeyError, TypeError, ValueError):
+            raise AttributeError("%s: region %s must have a numeric latitude, longitude and radius" % (name, region_name))
+        if not -90 <= latitude <= 90 or not -180 <= longitude <= 180 or radius <= 0:
+            raise AttributeError("%s: region %s is not a valid circle" % (name, region_name))
+        settings['regions'].append(Region(region_name, latitude, longitude, radius))
+
+    return settings
+
+
+class LocationSource(EventSource):
+    """
+    Routes CoreLocation updates to each CLLocation entry
+
+    Platform backends start a location manager for each entry, configured
+    with its min_distance (the distance filter, in metres) and accuracy (the
+    desired accuracy, in metres), and pass every update to
+    location_updated(). Managers may still deliver updates more often than
+    entries want, so updates are filtered again here: an update is ignored if
+    its horizontal accuracy is worse than accuracy, or if it is closer than
+    min_distance or sooner than min_interval seconds after the last update
+    which was delivered.
+
+    Entries with regions are geofences: rather than every update, handlers
+    receive an event with region set to the region's name and transition set
+    to "enter" or "exit" each time the location crosses a region's boundary.
+    The first update enters every region which contains it.
+    """
+    name = "CLLocation"
+
+    def __init__(self, name=None, clock=time.time):
+        super(LocationSource, self).__init__(name)
+        self.clock      = clock
+        self.thresholds = dict()    # key -> location settings
+        self.regions    = dict()    # key -> RegionIndex, for geofences
+        self.inside     = dict()    # key -> names of the regions the last update was in
+        self.last       = dict()    # key -> (time, location_info) of the last update delivered
+        self.ignored    = 0         # Updates which didn't pass the thresholds
+
+    def context(self, key):
+        return "CLCoreLocation"
+
+    def add_handler(self, key, event_config):
+        handler = super(LocationSource, self).add_handler(key, event_config)
+        if handler is not None:
+            settings = self.thresholds[key] = get_location_settings("%s %s" % (self.name, key), event_config)
+            if settings['regions']:
+                index = self.regions[key] = RegionIndex()
+                for region in settings['regions']:
+                    index.add(region)
+                self.inside[key] = set()
+        return handler
+
+    def unsubscribe(self, key, handler):
+        super(LocationSource, self).unsubscribe(key, handler)
+        if key not in self.handlers:
+            for d in (self.thresholds, self.regions, self.inside, self.last):
+                d.pop(key, None)
+
+    def location_updated(self, key, location_info):
+        """Filters an update from the location manager for key and emits the events it causes"""
+        settings = self.thresholds.get(key)
+        if settings is None:
+            return
+
+        now      = self.clock()
+        accuracy = location_info.get('horizontalAccuracy')
+        last     = self.last.get(key)
+
+        if accuracy is not None and (accuracy < 0 or (settings['accuracy'] and accuracy > settings['accuracy'])):
+            self.ignored += 1       # A negative accuracy means the location is invalid
+            return
+
+        if last is not None:
+            last_time, last_info = last
+            if settings['min_interval'] and now - last_time < settings['min_interval']:
+                self.ignored += 1
+                return
+            if settings['min_distance'] and distance(last_info['latitude'], last_info['longitude'],
+                                                     location_info['latitude'], location_info['longitude']) < settings['min_distance']:
+                self.ignored += 1
+                return
+
+        self.last[key] = (now, location_info)
+
+        index = self.regions.get(key)
+        if index is None:
+            self.emit(key, location_info=location_info)
+            return
+
+        inside  = index.containing(location_info['latitude'], location_info['longitude'])
+        entered = inside - self.inside[key]
+        left    = self.inside[key] - inside
+        self.inside[key] = inside
+
+        for region in sorted(left):
+            self.emit(key, location_info=location_info, region=region, transition="exit")
+        for region in sorted(entered):
+            self.emit(key, location_info=location_info, region=region, transition="enter")
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Compares loading a configuration without (cold) and with (warm) the
+compiled configuration cache
+
+Usage: bench_config.py [events] [repetitions]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+from plistlib import writePlist
+
+from PyMacAdmin.crankd.config import CACHE_SUFFIX, read_config
+
+def make_config(event_count):
+    sc = dict(
+        ('regexp:State:/Network/Service/svc%d/.*' % i, { 'command': '/usr/local/bin/network-changed %d' % i, 'debounce': 0.5 })
+        for i in range(event_count)
+    )
+    sc.update(
+        ('State:/Network/Interface/en%d/Link' % i, { 'function': 'handlers.network.link_changed' })
+        for i in range(event_count)
+    )
+    return {
+        'SystemConfiguration': sc,
+        'NSWorkspace': dict(
+            ('com.example.Notification%d' % i, { 'method': [ 'handlers.Workspace', 'changed' ] }) for i in range(event_count)
+        ),
+    }
+
+def timed(f, repetitions):
+    start = time.time()
+    for i in range(repetitions):
+        f()
+    return (time.time() - start) / repetitions
+
+def main():
+    event_count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    repetitions = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    temp_dir    = tempfile.mkdtemp()
+    config_file = os.path.join(temp_dir, "crankd.plist")
+    cache_file  = config_file + CACHE_SUFFIX
+    try:
+        writePlist(make_config(event_count), config_file)
+        xml_size = os.path.getsize(config_file)
+
+        def cold():
+            if os.path.exists(cache_file):
+                os.unlink(cache_file)
+            read_config(config_file)
+
+        cold_time = timed(cold, repetitions)
+        read_config(config_file)
+        warm_time = timed(lambda: read_config(config_file), repetitions)
+    finally:
+        shutil.rmtree(temp_dir)
+
+    print "%d events, %d bytes of XML" % (event_count * 3, xml_size)
+    print "Cold start (parse, validate, write cache): %8.2f ms" % (cold_time * 1000)
+    print "Warm start (compiled cache):               %8.2f ms" % (warm_time * 1000)
+    print "Speedup: %0.1fx" % (cold_time / warm_time)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Load test for the crankd dispatcher using synthetic event sources
+
+A configuration with the given number of explicit and regexp
+SystemConfiguration keys plus NSWorkspace notifications is loaded through the
+normal config loader, then events are emitted as fast as possible on a
+SelectEventLoop.
+
+Usage: bench_dispatch.py [events] [regexp keys]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+from plistlib import writePlist
+
+from PyMacAdmin.crankd import actions
+from PyMacAdmin.crankd.config import load_config, configure_sources
+from PyMacAdmin.crankd.events import Dispatcher, EventSource
+from PyMacAdmin.crankd.loop import SelectEventLoop
+from PyMacAdmin.crankd.sources import SystemConfigurationSource
+
+CALLS = [0]
+
+def handler(*args, **kwargs):
+    CALLS[0] += 1
+
+def make_config(regexp_count):
+    function = { 'function': '%s.handler' % __name__ }
+    sc       = dict(('regexp:State:/Network/Service/svc%d/.*' % i, function) for i in range(regexp_count))
+    sc['State:/Network/Global/IPv4'] = function
+    sc['regexp:State:/Network/Interface/([^/]+)/Link'] = function
+    return {
+        'SystemConfiguration': sc,
+        'NSWorkspace': { 'NSWorkspaceDidWakeNotification': function },
+    }
+
+def main():
+    event_count  = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    regexp_count = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    temp_dir    = tempfile.mkdtemp()
+    config_file = os.path.join(temp_dir, "crankd.plist")
+    try:
+        writePlist(make_config(regexp_count), config_file)
+        actions.EVENT_LOOP = loop = SelectEventLoop()
+        dispatcher = Dispatcher()
+        configure_sources(dispatcher, load_config(config_file), {
+            'SystemConfiguration': SystemConfigurationSource,
+            'NSWorkspace':         EventSource,
+        })
+    finally:
+        shutil.rmtree(temp_dir)
+
+    sc  = dispatcher.sources['SystemConfiguration']
+    nsw = dispatcher.sources['NSWorkspace']
+    sc_keys = [ 'State:/Network/Interface/en%d/Link' % (i % 8) for i in range(16) ] \
+            + [ 'State:/Network/Service/svc%d/IPv4' % i for i in range(0, regexp_count, 7) ] \
+            + [ 'State:/Network/Global/IPv4' ]
+
+    def generate(remaining=[event_count]):
+        """Emits a batch of events per loop iteration, as an OS callback would"""
+        for i in range(min(1000, remaining[0])):
+            if i % 10:
+                key = sc_keys[i % len(sc_keys)]
+                sc.emit(key, key=key, info=None)
+            else:
+                nsw.emit('NSWorkspaceDidWakeNotification', event=None, user_info=None)
+        remaining[0] -= min(1000, remaining[0])
+        if remaining[0]:
+            loop.call_later(0, generate)
+        else:
+            loop.stop()
+
+    loop.call_later(0, generate)
+
+    start   = time.time()
+    loop.run()
+    elapsed = time.time() - start
+
+    print "%d events, %d handler calls, %d regexp keys: %.3fs (%.0f events/s)" % (
+        dispatcher.dispatched, CALLS[0], regexp_count, elapsed, dispatcher.dispatched / elapsed
+    )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Compares the fsevent_callback path lookup using a PathTrie with the previous
+linear scan of every watched path
+
+Usage: bench_pathtrie.py [watched paths] [events per batch]
+"""
+
+import random
+import sys
+import timeit
+from PyMacAdmin.crankd.pathtrie import PathTrie
+
+def make_paths(count):
+    """Returns count plausible module directories"""
+    random.seed(0)
+    roots = [ "/System/Library/Frameworks/Python.framework/Versions/2.7/lib/python2.7", "/Library/Python/2.7/site-packages" ]
+    return [ "%s/pkg%d/sub%d" % (random.choice(roots), i, i % 7) for i in range(count) ]
+
+def make_events(paths, count):
+    """Returns a batch of count event paths, half inside a watched path"""
+    events = list()
+    for i in range(count):
+        if i % 2:
+            events.append("%s/child%d" % (random.choice(paths), i))
+        else:
+            events.append("/Users/someone/Documents/folder%d" % i)
+    return events
+
+def list_scan(watched, events):
+    for path in events:
+        for i in [k for k in watched if path.startswith(k)]:
+            for j in watched[i]:
+                j(i, path=path, recursive=False)
+
+def trie_scan(trie, events):
+    for path in events:
+        for watched_path, callbacks in trie.match(path):
+            for callback in callbacks:
+                callback(watched_path, path=path, recursive=False)
+
+def main():
+    watched_count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    event_count   = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+
+    callback = lambda *args, **kwargs: None
+    paths    = make_paths(watched_count)
+    events   = make_events(paths, event_count)
+    watched  = dict((p, [callback]) for p in paths)
+    trie     = PathTrie()
+    for p in paths:
+        trie.add(p, callback)
+
+    for name, func, arg in (("list scan", list_scan, watched), ("path trie", trie_scan, trie)):
+        elapsed = min(timeit.repeat(lambda: func(arg, events), number=1, repeat=3))
+        print "%-10s %d watched paths, %d events: %.3fs (%.0f events/s)" % (name, watched_count, event_count, elapsed, event_count / elapsed)
+
+if __name__ == '__main__':
+    main()
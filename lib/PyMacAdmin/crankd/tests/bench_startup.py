@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Measures the cost of resolving Python handlers at startup
+
+A configuration whose handlers live in a variety of standard library modules
+is loaded in a fresh interpreter with lazy resolution (the default) and with
+every handler preloaded; each run reports its wall clock time and peak
+resident memory. Framework imports can only be measured on a Mac, e.g. by
+comparing "python -c 'import Foundation'" with "python -c 'import Cocoa'".
+
+Usage: bench_startup.py [repetitions]
+"""
+
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+from plistlib import writePlist
+
+# Handlers which import a good slice of the standard library:
+HANDLERS = [
+    'BaseHTTPServer.test', 'cookielib.CookieJar', 'csv.reader', 'decimal.Decimal',
+    'difflib.unified_diff', 'email.message_from_string', 'ftplib.FTP', 'imaplib.IMAP4',
+    'json.loads', 'mailbox.Maildir', 'nntplib.NNTP', 'poplib.POP3', 'pydoc.render_doc',
+    'smtplib.SMTP', 'sqlite3.connect', 'tarfile.open', 'telnetlib.Telnet',
+    'urllib2.urlopen', 'xml.dom.minidom.parseString', 'xmlrpclib.ServerProxy', 'zipfile.ZipFile',
+]
+
+CHILD = """
+import resource, sys, time
+start = time.time()
+from PyMacAdmin.crankd import actions
+from PyMacAdmin.crankd.config import load_config, configure_sources
+from PyMacAdmin.crankd.events import Dispatcher, EventSource
+actions.EVENT_LOOP = None
+configure_sources(Dispatcher(), load_config(sys.argv[1]), { 'NSWorkspace': EventSource })
+print time.time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, len(sys.modules)
+"""
+
+def run(config_file, repetitions):
+    results = list()
+    for i in range(repetitions):
+        output = subprocess.check_output([ sys.executable, "-c", CHILD, config_file ], env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+        results.append(tuple(float(v) for v in output.split()))
+    results.sort()
+    return results[len(results) // 2]
+
+def main():
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        for label, preload in (("lazy", False), ("preload", True)):
+            config_file = os.path.join(temp_dir, "%s.plist" % label)
+            writePlist({
+                'NSWorkspace': dict(
+                    ('com.example.Notification%d' % i, { 'function': f_name, 'preload': preload }) for i, f_name in enumerate(HANDLERS)
+                )
+            }, config_file)
+
+            elapsed, max_rss, module_count = run(config_file, repetitions)
+            # ru_maxrss is reported in kilobytes on Linux and bytes on OS X:
+            if sys.platform == "darwin":
+                max_rss /= 1024
+            print "%-8s %8.1f ms %8d KB max RSS %6d modules" % (label, elapsed * 1000, max_rss, module_count)
+    finally:
+        shutil.rmtree(temp_dir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from PyMacAdmin.crankd.checkpoint import Checkpoint, CHECKPOINT_VERSION
+
+class FakeTimer(object):
+    def __init__(self, callback):
+        self.callback  = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class CheckpointTests(unittest.TestCase):
+    """Unit test for saving and resuming event stream positions"""
+
+    def setUp(self):
+        self.temp_dir  = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.temp_dir, "crankd.plist.fsevents")
+        self.timers    = []
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def call_later(self, delay, callback):
+        timer = FakeTimer(callback)
+        self.timers.append(timer)
+        return timer
+
+    def run_timers(self):
+        while self.timers:
+            timer = self.timers.pop(0)
+            if not timer.cancelled:
+                timer.callback()
+
+    def checkpoint(self):
+        return Checkpoint(self.file_name, self.call_later)
+
+    def saved(self):
+        with open(self.file_name) as f:
+            return json.load(f)
+
+    def test_bounded_writes(self):
+        c = self.checkpoint()
+        c.reset(10, { "/a": "uuid-1" })
+        for event_id in range(11, 1000):
+            c.update(event_id)
+        c.update(500)
+
+        self.assertEquals(len(self.timers), 1)
+        self.failIf(os.path.exists(self.file_name))
+        self.run_timers()
+        self.assertEquals(c.writes, 1)
+        self.assertEquals(self.saved(), { 'version': CHECKPOINT_VERSION, 'event_id': 999, 'roots': { "/a": "uuid-1" } })
+
+    def test_flush(self):
+        c = self.checkpoint()
+        c.flush()
+        self.assertEquals(c.writes, 0)
+
+        c.update(42)
+        c.flush()
+        self.assertEquals((c.writes, self.saved()['event_id'], self.timers[0].cancelled), (1, 42, True))
+
+    def test_pending(self):
+        # A coalesced event has been dispatched ahead of event 12:
+        pending   = [ 12 ]
+        c         = self.checkpoint()
+        c.pending = lambda: pending[0] if pending else None
+        c.reset(10)
+        c.update(15)
+        c.flush()
+        self.assertEquals(self.saved()['event_id'], 11)
+
+        pending.pop()
+        c.update(16)
+        self.run_timers()
+        self.assertEquals(self.saved()['event_id'], 16)
+
+    def test_unchanged(self):
+        c = self.checkpoint()
+        c.reset(10, { "/a": "uuid-1" })
+        self.run_timers()
+        c.reset(10, { "/a": "uuid-1" })
+        self.run_timers()
+        self.assertEquals(c.writes, 1)
+
+        # A restart doesn't rewrite the position it resumed from:
+        c = self.checkpoint()
+        c.reset(*c.resume({ "/a": "uuid-1" })[:1])
+        self.run_timers()
+        self.assertEquals(c.writes, 0)
+
+    def test_resume(self):
+        c = self.checkpoint()
+        self.assertEquals(c.resume({ "/a": "uuid-1" }), (None, []))
+        c.reset(100, { "/a": "uuid-1", "/b": "uuid-2" })
+        c.flush()
+
+        # The volume containing /b has a new event history and /c wasn't watched before:
+        c = self.checkpoint()
+        self.assertEquals(c.resume({ "/a": "uuid-1", "/b": "uuid-3", "/c": "uuid-1" }), (100, [ "/b" ]))
+
+    def test_unusable_checkpoints(self):
+        logging.disable(logging.WARNING)
+        try:
+            for contents in ("not json", json.dumps([ 1 ]), json.dumps({ 'version': CHECKPOINT_VERSION + 1, 'event_id': 5 })):
+                with open(self.file_name, "w") as f:
+                    f.write(contents)
+                self.assertEquals(self.checkpoint().resume({ "/a": None }), (None, []))
+        finally:
+            logging.disable(logging.NOTSET)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import logging
+import unittest
+from PyMacAdmin.crankd.coalesce import Debouncer, get_debounce_settings
+
+class FakeScheduler(object):
+    """Collects timers so tests can control the passage of time"""
+
+    def __init__(self):
+        self.now    = 0.0
+        self.timers = []
+
+    def clock(self):
+        return self.now
+
+    def call_later(self, delay, callback):
+        timer = FakeTimer(self.now + delay, callback)
+        self.timers.append(timer)
+        return timer
+
+    def advance(self, seconds):
+        self.now += seconds
+        for timer in list(self.timers):
+            if timer.when <= self.now and not timer.cancelled:
+                self.timers.remove(timer)
+                timer.callback()
+
+class FakeTimer(object):
+    def __init__(self, when, callback):
+        self.when      = when
+        self.callback  = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class DebouncerTests(unittest.TestCase):
+    """Unit test for event debouncing and coalescing"""
+
+    def setUp(self):
+        self.scheduler = FakeScheduler()
+        self.calls     = []
+
+    def handler(self, *args, **kwargs):
+        self.calls.append((args, kwargs))
+
+    def debouncer(self, **kwargs):
+        return Debouncer(self.handler, self.scheduler.call_later, clock=self.scheduler.clock, **kwargs)
+
+    def test_settings(self):
+        self.assertEquals(get_debounce_settings("k", {}), (None, None))
+        self.assertEquals(get_debounce_settings("k", {'debounce': '0.5', 'coalesce': 2}), (0.5, 2.0))
+        self.assertRaises(AttributeError, get_debounce_settings, "k", {'debounce': 'soon'})
+        self.assertRaises(AttributeError, get_debounce_settings, "k", {'coalesce': -1})
+
+    def test_debounce_burst(self):
+        d = self.debouncer(debounce=1.0)
+        for key in ("State:/Network/Global/IPv4", "State:/Network/Global/DNS", "State:/Network/Global/IPv4"):
+            d(key=key, info=None)
+            self.scheduler.advance(0.5)
+
+        self.assertEquals(self.calls, [])
+        self.scheduler.advance(0.5)
+
+        self.assertEquals(len(self.calls), 1)
+        kwargs = self.calls[0][1]
+        self.assertEquals(kwargs['keys'], ["State:/Network/Global/IPv4", "State:/Network/Global/DNS"])
+        self.assertEquals(kwargs['key'], "State:/Network/Global/IPv4")
+        self.assertEquals(kwargs['event_count'], 3)
+        self.assertEquals((d.events, d.invocations, d.absorbed), (3, 1, 3))
+
+    def test_coalesce_limits_delay(self):
+        d = self.debouncer(debounce=1.0, coalesce=2.0)
+        for i in range(10):
+            d("/tmp", path="/tmp/%d" % i, recursive=(i == 3))
+            self.scheduler.advance(0.5)
+
+        self.assertEquals(len(self.calls), 2)
+        args, kwargs = self.calls[0]
+        self.assertEquals(args, ("/tmp",))
+        self.assertEquals(kwargs['paths'], ["/tmp/0", "/tmp/1", "/tmp/2", "/tmp/3"])
+        self.assertEquals(kwargs['recursive'], True)
+        self.assertEquals(self.calls[1][1]['recursive'], False)
+
+    def test_flush(self):
+        d = self.debouncer(coalesce=5)
+        d(user_info={'NSApplicationName': 'Mail'})
+        d.flush()
+        self.assertEquals(self.calls, [((), {'user_info': {'NSApplicationName': 'Mail'}, 'event_count': 1})])
+        self.failUnless(self.scheduler.timers[0].cancelled)
+
+    def test_failure(self):
+        def fail(**kwargs):
+            raise ValueError("boom")
+
+        d = Debouncer(fail, self.scheduler.call_later, debounce=1.0, clock=self.scheduler.clock)
+        logging.disable(logging.ERROR)
+        try:
+            d(key="a")
+            self.scheduler.advance(1.0)
+        finally:
+            logging.disable(logging.NOTSET)
+
+        self.assertEquals((d.invocations, d.failures, d.pending), (1, 1, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import logging
+import marshal
+import os
+import shutil
+import tempfile
+import unittest
+from plistlib import Data, writePlist
+
+from PyMacAdmin.crankd import config
+from PyMacAdmin.crankd.config import CACHE_SUFFIX, compile_config, read_config
+
+class ConfigCacheTests(unittest.TestCase):
+    """Unit test for configuration validation and the compiled configuration cache"""
+
+    def setUp(self):
+        self.temp_dir    = tempfile.mkdtemp()
+        self.config_file = os.path.join(self.temp_dir, "crankd.plist")
+        self.parsed      = []
+
+        self.original_parser = config.readPlistFromString
+        def counting_parser(data):
+            self.parsed.append(len(data))
+            return self.original_parser(data)
+        config.readPlistFromString = counting_parser
+
+    def tearDown(self):
+        config.readPlistFromString = self.original_parser
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, plist):
+        writePlist(plist, self.config_file)
+
+    def test_compile(self):
+        plist = {
+            'SystemConfiguration': {
+                'State:/Network/Global/IPv4': { 'function': 'handlers.network.changed' },
+                'regexp:State:/Network/Interface/([^/]+)/Link': { 'command': 'true', 'debounce': 1 },
+            },
+            'NSWorkspace': {
+                'NSWorkspaceDidWakeNotification': { 'method': ( 'handlers.Power', 'wake' ) },
+            },
+        }
+        compiled = compile_config(plist)
+        self.assertEquals(compiled['NSWorkspace']['NSWorkspaceDidWakeNotification']['method'], [ 'handlers.Power', 'wake' ])
+        self.assertEquals(compiled['SystemConfiguration'], plist['SystemConfiguration'])
+
+    def test_invalid(self):
+        for plist in (
+            { 'NSWorkspace': [ 'NSWorkspaceDidWakeNotification' ] },
+            { 'NSWorkspace': { 'NSWorkspaceDidWakeNotification': { 'debounce': 1 } } },
+            { 'NSWorkspace': { 'NSWorkspaceDidWakeNotification': { 'command': 'true', 'debounce': 'soon' } } },
+            { 'NSWorkspace': { 'NSWorkspaceDidWakeNotification': { 'method': [ 'handlers.Power' ] } } },
+            { 'SystemConfiguration': { 'regexp:State:/Network/(': { 'command': 'true' } } },
+            { 'Queues': { 'FSEvents': { 'overflow': 'sometimes' } } },
+            { 'NSWorkspace': { 'NSWorkspaceDidWakeNotification': { 'command': 'true', 'rate_limit': { 'rate': -1 } } } },
+            { 'Queues': { 'NSWorkspace': { 'rate_limit': { 'policy': 'drop' } } } },
+            { 'NSWorkspace': { 'NSWorkspaceDidWakeNotification': { 'command': 'true', 'batch': True } } },
+            { 'NSWorkspace': { 'NSWorkspaceDidWakeNotification': { 'command': 'true', 'worker_group': 'inventory' } } },
+            { 'NSWorkspace': { 'NSWorkspaceDidWakeNotification': { 'function': 'handlers.wake', 'worker_group': 'inventory', 'threaded': True } } },
+        ):
+            self.assertRaises(AttributeError, compile_config, plist)
+
+    def test_warm_start_uses_cache(self):
+        self.write({ 'NSWorkspace': { 'NSWorkspaceDidWakeNotification': { 'command': 'true' } } })
+        cold = read_config(self.config_file)
+        warm = read_config(self.config_file)
+
+        self.assertEquals(len(self.parsed), 1)
+        self.assertEquals(cold, warm)
+        self.failUnless(os.path.exists(self.config_file + CACHE_SUFFIX))
+
+    def test_changed_file_is_reparsed(self):
+        self.write({ 'NSWorkspace': { 'NSWorkspaceDidWakeNotification': { 'command': 'true' } } })
+        read_config(self.config_file)
+
+        # Same size and, within the filesystem's timestamp resolution, the same mtime:
+        self.write({ 'NSWorkspace': { 'NSWorkspaceDidWakeNotification': { 'command': 'echo' } } })
+        self.assertEquals(read_config(self.config_file)['NSWorkspace']['NSWorkspaceDidWakeNotification'], { 'command': 'echo' })
+        self.assertEquals(len(self.parsed), 2)
+
+    def test_corrupt_cache(self):
+        self.write({ 'NSWorkspace': { 'NSWorkspaceDidWakeNotification': { 'command': 'true' } } })
+        open(self.config_file + CACHE_SUFFIX, "w").write("garbage")
+        self.assertEquals(read_config(self.config_file)['NSWorkspace'].keys(), ['NSWorkspaceDidWakeNotification'])
+        self.failUnless('signature' in marshal.load(open(self.config_file + CACHE_SUFFIX, 'rb')))
+
+    def test_untrusted_cache(self):
+        self.write({ 'NSWorkspace': { 'NSWorkspaceDidWakeNotification': { 'command': 'true' } } })
+        read_config(self.config_file)
+        os.chmod(self.config_file + CACHE_SUFFIX, 0666)
+
+        logging.disable(logging.WARNING)
+        try:
+            read_config(self.config_file)
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEquals(len(self.parsed), 2)
+        self.assertEquals(os.stat(self.config_file + CACHE_SUFFIX).st_mode & 0777, 0644)
+
+    def test_validator_changes_invalidate_the_cache(self):
+        self.write({ 'NSWorkspace': { 'NSWorkspaceDidWakeNotification': { 'command': 'true' } } })
+        read_config(self.config_file)
+
+        original, config.VALIDATOR_HASH = config.VALIDATOR_HASH, "changed"
+        try:
+            read_config(self.config_file)
+        finally:
+            config.VALIDATOR_HASH = original
+        self.assertEquals(len(self.parsed), 2)
+
+    def test_uncacheable_values(self):
+        self.write({ 'NSWorkspace': { 'NSWorkspaceDidWakeNotification': { 'command': 'true', 'blob': Data("x") } } })
+        read_config(self.config_file)
+        read_config(self.config_file)
+        self.assertEquals(len(self.parsed), 2)
+        self.failIf(os.path.exists(self.config_file + CACHE_SUFFIX))
+
+if __name__ == '__main__':
+    unittest.main()
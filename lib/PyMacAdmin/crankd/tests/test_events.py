@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import logging
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import unittest
+from plistlib import writePlist
+
+from PyMacAdmin.crankd import actions
+from PyMacAdmin.crankd.config import load_config, configure_sources, reload_sources
+from PyMacAdmin.crankd.events import Dispatcher, Event, EventSource
+from PyMacAdmin.crankd.executor import CommandExecutor
+from PyMacAdmin.crankd.loop import SelectEventLoop
+from PyMacAdmin.crankd.sources import MemoryDynamicStore, SystemConfigurationSource, FileSystemSource, NetServiceSource
+
+CALLS = []
+
+def record_call(*args, **kwargs):
+    """Handler used by the test configurations"""
+    CALLS.append((args, kwargs))
+
+def broken_handler(*args, **kwargs):
+    raise ValueError("This handler always fails")
+
+class DispatcherTests(unittest.TestCase):
+    """Runs the dispatcher, handlers and config loader against synthetic sources"""
+
+    def setUp(self):
+        del CALLS[:]
+        self.temp_dir    = tempfile.mkdtemp()
+        self.loop        = actions.EVENT_LOOP = SelectEventLoop()
+        self.dispatcher  = Dispatcher()
+        self.sources     = {
+            'NSWorkspace':         EventSource,
+            'SystemConfiguration': SystemConfigurationSource,
+            'FSEvents':            FileSystemSource,
+            'NSNetService':        NetServiceSource,
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+        actions.EVENT_LOOP = actions.COMMAND_EXECUTOR = None
+
+    def configure(self, config):
+        config_file = os.path.join(self.temp_dir, "crankd.plist")
+        writePlist(config, config_file)
+        return configure_sources(self.dispatcher, load_config(config_file), self.sources)
+
+    def test_notification_routing(self):
+        self.configure({
+            'NSWorkspace': {
+                'NSWorkspaceDidWakeNotification': { 'function': '%s.record_call' % __name__ },
+                'NSWorkspaceWillSleepNotification': { 'function': '%s.broken_handler' % __name__ },
+            }
+        })
+        source = self.dispatcher.sources['NSWorkspace']
+        source.emit('NSWorkspaceDidWakeNotification', user_info={'a': 1})
+        source.emit('NSWorkspaceWillSleepNotification', user_info=None)
+        source.emit('NSWorkspaceDidMountNotification', user_info=None)
+
+        self.assertEquals(len(CALLS), 1)
+        self.assertEquals(CALLS[0][1]['context'], "NSWorkspace: NSWorkspaceDidWakeNotification")
+        self.assertEquals(CALLS[0][1]['user_info'], {'a': 1})
+        self.assertEquals((self.dispatcher.dispatched, self.dispatcher.failures, self.dispatcher.unhandled), (3, 1, 1))
+
+    def test_sc_routing(self):
+        self.configure({
+            'SystemConfiguration': {
+                'regexp:State:/Network/Interface/([^/]+)/Link': { 'function': '%s.record_call' % __name__ },
+            }
+        })
+        self.dispatcher.dispatch(Event('SystemConfiguration', 'State:/Network/Interface/en0/Link', {'key': 'State:/Network/Interface/en0/Link', 'info': None}))
+
+        self.assertEquals(len(CALLS), 1)
+        kwargs = CALLS[0][1]
+        self.assertEquals(kwargs['key'], 'State:/Network/Interface/en0/Link')
+        self.assertEquals(kwargs['re_obj'].pattern, 'State:/Network/Interface/([^/]+)/Link')
+
+    def test_sc_batch(self):
+        self.configure({
+            'SystemConfiguration': {
+                'regexp:State:/Network/Interface/([^/]+)/IPv4': { 'function': '%s.record_call' % __name__, 'batch': True },
+                'State:/Network/Global/IPv4': { 'function': '%s.record_call' % __name__, 'batch': True },
+                'State:/Network/Interface/en0/IPv4': { 'function': '%s.record_call' % __name__ },
+            }
+        })
+        source = self.dispatcher.sources['SystemConfiguration']
+        self.assertEquals(source.notification_keys(), (
+            [ 'State:/Network/Global/IPv4', 'State:/Network/Interface/en0/IPv4' ], [ 'State:/Network/Interface/([^/]+)/IPv4' ]
+        ))
+
+        source.emit_changes([ 'State:/Network/Interface/en0/IPv4', 'State:/Network/Interface/en1/IPv4', 'State:/Network/Global/IPv4' ], info=None)
+
+        # en0 has its own handler; the regexp batch handler is called once for both interfaces:
+        calls = sorted((kwargs['key'], kwargs.get('keys'), kwargs.get('captures')) for args, kwargs in CALLS)
+        self.assertEquals(calls, [
+            ('State:/Network/Global/IPv4', [ 'State:/Network/Global/IPv4' ], { 'State:/Network/Global/IPv4': () }),
+            ('State:/Network/Interface/en0/IPv4', None, None),
+            ('regexp:State:/Network/Interface/([^/]+)/IPv4', [ 'State:/Network/Interface/en0/IPv4', 'State:/Network/Interface/en1/IPv4' ], {
+                'State:/Network/Interface/en0/IPv4': ('en0',), 'State:/Network/Interface/en1/IPv4': ('en1',)
+            }),
+        ])
+        self.assertEquals(self.dispatcher.unhandled, 0)
+
+        source.remove_handler('regexp:State:/Network/Interface/([^/]+)/IPv4')
+        self.assertEquals(len(source.batch), 1)
+
+    def test_sc_values(self):
+        self.configure({
+            'SystemConfiguration': {
+                'State:/Network/Global/IPv4': { 'function': '%s.record_call' % __name__, 'only_if_changed': True },
+                'regexp:State:/Network/Interface/([^/]+)/IPv4': { 'function': '%s.record_call' % __name__, 'batch': True, 'only_if_changed': True },
+                'State:/Network/Global/DNS': { 'function': '%s.record_call' % __name__ },
+            }
+        })
+        source = self.dispatcher.sources['SystemConfiguration']
+        store  = source.store = MemoryDynamicStore({
+            'State:/Network/Global/IPv4': { 'Router': '10.0.0.1' },
+            'State:/Network/Interface/en0/IPv4': { 'Addresses': [ '10.0.0.2' ] },
+            'State:/Network/Interface/en1/IPv4': { 'Addresses': [ '10.0.1.2' ] },
+            'State:/Network/Service/1/IPv4': { 'Addresses': [ '10.0.2.2' ] },
+        })
+        source.load_values()
+        self.assertEquals(sorted(source.values), [ 'State:/Network/Global/IPv4', 'State:/Network/Interface/en0/IPv4', 'State:/Network/Interface/en1/IPv4' ])
+
+        # Rewriting the same values only calls the handler without only_if_changed:
+        changed = [ 'State:/Network/Global/IPv4', 'State:/Network/Interface/en0/IPv4', 'State:/Network/Interface/en1/IPv4', 'State:/Network/Global/DNS' ]
+        source.emit_changes(changed, info=None)
+        self.assertEquals([ (kwargs['key'], kwargs['old_value'], kwargs['new_value']) for args, kwargs in CALLS ], [ ('State:/Network/Global/DNS', None, None) ])
+
+        del CALLS[:]
+        store.set_value('State:/Network/Global/IPv4', { 'Router': '10.0.0.254' })
+        store.remove_value('State:/Network/Interface/en1/IPv4')
+        source.emit_changes(changed, info=None)
+        calls = dict((kwargs['key'], kwargs) for args, kwargs in CALLS)
+        self.assertEquals(sorted(calls), [ 'State:/Network/Global/DNS', 'State:/Network/Global/IPv4', 'regexp:State:/Network/Interface/([^/]+)/IPv4' ])
+        self.assertEquals(calls['State:/Network/Global/IPv4']['new_value'], { 'Router': '10.0.0.254' })
+        batch = calls['regexp:State:/Network/Interface/([^/]+)/IPv4']
+        self.assertEquals((batch['keys'], batch['captures']), ([ 'State:/Network/Interface/en1/IPv4' ], { 'State:/Network/Interface/en1/IPv4': ('en1',) }))
+        self.assertEquals(batch['new_values']['State:/Network/Interface/en1/IPv4'], None)
+
+        # One round trip for the snapshot and one per notification:
+        self.assertEquals(store.copies, 3)
+
+    def test_fs_routing(self):
+        watched = os.path.join(self.temp_dir, "watched")
+        os.mkdir(watched)
+        self.configure({
+            'FSEvents': { watched: { 'function': '%s.record_call' % __name__ } }
+        })
+        source = self.dispatcher.sources['FSEvents']
+        source.emit(os.path.join(watched, "child"), path=os.path.join(watched, "child"), recursive=False)
+        source.emit(watched + "-sibling", path=watched + "-sibling", recursive=False)
+
+        self.assertEquals(len(CALLS), 1)
+        self.assertEquals(CALLS[0][0], (os.path.realpath(watched),))
+        self.assertEquals(CALLS[0][1]['path'], os.path.join(watched, "child"))
+
+    def test_mdns_batches(self):
+        self.configure({
+            'NSNetService': { '_ssh._tcp.': { 'function': '%s.record_call' % __name__, 'resolve_ttl': 60 } }
+        })
+        source   = self.dispatcher.sources['NSNetService']
+        resolves = []
+        now      = [ 1000.0 ]
+        source.resolve_service = lambda type_, key, service: resolves.append(key)
+        source.clock   = lambda: now[0]
+
+        def info(name, resolved=True):
+            return { 'name': name, 'type': '_ssh._tcp.', 'domain': 'local.', 'resolved': resolved }
+
+        # Nothing is delivered until the browser has finished and every service has resolved:
+        hosts = [ ("host%d" % n, '_ssh._tcp.', 'local.') for n in range(3) ]
+        for n, key in enumerate(hosts):
+            source.service_found('_ssh._tcp.', key, None, n < 2)
+        self.assertEquals(resolves, hosts)
+        source.service_resolved('_ssh._tcp.', hosts[0], info("host0"))
+        source.service_resolved('_ssh._tcp.', hosts[1], info("host1", False))
+        self.assertEquals(CALLS, [])
+        source.service_resolved('_ssh._tcp.', hosts[2], info("host2"))
+
+        self.assertEquals(len(CALLS), 1)
+        kwargs = CALLS[0][1]
+        self.assertEquals([ s['name'] for s in kwargs['services'] ], [ "host0", "host1", "host2" ])
+        self.assertEquals((kwargs['removed'], kwargs['service_info']['name']), ([], "host2"))
+
+        # Re-announcing a cached service neither resolves it nor calls the handler,
+        # but the service which failed to resolve is tried again:
+        del CALLS[:], resolves[:]
+        source.service_found('_ssh._tcp.', hosts[0], None, True)
+        source.service_found('_ssh._tcp.', hosts[1], None, True)
+        source.service_removed('_ssh._tcp.', hosts[2], info("host2", False), False)
+        self.assertEquals(resolves, [ hosts[1] ])
+        source.service_resolved('_ssh._tcp.', hosts[1], info("host1"))
+        self.assertEquals([ ([ s['name'] for s in k['services'] ], [ s['name'] for s in k['removed'] ]) for a, k in CALLS ], [ ([ "host1" ], [ "host2" ]) ])
+
+        # Cached services are resolved again once their TTL expires:
+        del CALLS[:], resolves[:]
+        now[0] += 61
+        source.service_found('_ssh._tcp.', hosts[0], None, False)
+        self.assertEquals((resolves, CALLS), ([ hosts[0] ], []))
+
+        browse = source.browsing['_ssh._tcp.']
+        self.assertEquals((browse.announced, browse.resolves, browse.failures, browse.cache_hits, browse.removals, browse.batches), (6, 5, 1, 1, 1, 2))
+
+    def test_unsupported_section(self):
+        self.configure({ 'CLLocation': { 'here': { 'function': '%s.record_call' % __name__ } } })
+        self.assertEquals(self.dispatcher.sources, {})
+
+    def test_debounced_command(self):
+        actions.COMMAND_EXECUTOR = CommandExecutor(self.loop.call_later)
+        output = os.path.join(self.temp_dir, "output")
+        self.configure({
+            'SystemConfiguration': {
+                'regexp:State:/Network/Global/.*': {
+                    'command': 'echo "$CRANKD_EVENT_COUNT $CRANKD_KEYS" > %s' % output,
+                    'debounce': 0.05,
+                }
+            }
+        })
+
+        self.loop.add_signal_handler(signal.SIGCHLD, lambda signum: actions.COMMAND_EXECUTOR.reap())
+        try:
+            source = self.dispatcher.sources['SystemConfiguration']
+            for key in ('State:/Network/Global/IPv4', 'State:/Network/Global/DNS', 'State:/Network/Global/IPv4'):
+                source.emit(key, key=key, info=None)
+
+            self.loop.call_later(2, self.loop.stop)
+            while not os.path.exists(output) or actions.COMMAND_EXECUTOR.running:
+                self.loop.run_once(timeout=0.1)
+        finally:
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            signal.set_wakeup_fd(-1)
+
+        self.assertEquals(open(output).read(), "3 State:/Network/Global/IPv4\nState:/Network/Global/DNS\n")
+
+
+    def test_lazy_handlers(self):
+        open(os.path.join(self.temp_dir, "crankd_lazy_handler.py"), "w").write("from %s import record_call as lazy_call\n" % __name__)
+        open(os.path.join(self.temp_dir, "crankd_preload_handler.py"), "w").write("def preloaded(**kwargs): pass\n")
+        sys.path.insert(0, self.temp_dir)
+        resolved = []
+        actions.RESOLVE_HOOKS.append(resolved.append)
+        try:
+            self.configure({
+                'NSWorkspace': {
+                    'NSWorkspaceDidWakeNotification': { 'function': 'crankd_lazy_handler.lazy_call' },
+                    'NSWorkspaceWillSleepNotification': { 'function': 'crankd_preload_handler.preloaded', 'preload': True },
+                    'NSWorkspaceDidMountNotification': { 'function': 'crankd_missing_handler.missing' },
+                }
+            })
+            self.failIf('crankd_lazy_handler' in sys.modules)
+            self.failUnless('crankd_preload_handler' in sys.modules)
+
+            source = self.dispatcher.sources['NSWorkspace']
+            source.emit('NSWorkspaceDidWakeNotification', user_info=None)
+            source.emit('NSWorkspaceDidWakeNotification', user_info=None)
+            source.emit('NSWorkspaceDidMountNotification', user_info=None)
+
+            self.failUnless('crankd_lazy_handler' in sys.modules)
+            self.assertEquals(len(CALLS), 2)
+            self.assertEquals(len(resolved), 1)
+            self.assertEquals(self.dispatcher.failures, 1)
+
+            self.assertRaises(RuntimeError, self.configure, {
+                'NSWorkspace': { 'NSWorkspaceDidUnmountNotification': { 'method': [ 'crankd_missing_handler', 'f' ], 'preload': True } }
+            })
+        finally:
+            actions.RESOLVE_HOOKS.remove(resolved.append)
+            sys.path.remove(self.temp_dir)
+            for name in ('crankd_lazy_handler', 'crankd_preload_handler'):
+                sys.modules.pop(name, None)
+
+    def test_reload(self):
+        watched = os.path.realpath(self.temp_dir)
+        handler = { 'function': '%s.record_call' % __name__ }
+        self.configure({
+            'NSWorkspace': {
+                'NSWorkspaceDidWakeNotification': handler,
+                'NSWorkspaceWillSleepNotification': handler,
+            },
+            'SystemConfiguration': { 'regexp:State:/Network/Global/.*': handler },
+            'FSEvents': { watched: handler },
+        })
+        self.dispatcher.start(self.loop)
+
+        workspace = self.dispatcher.sources['NSWorkspace']
+        kept      = workspace.configured['NSWorkspaceDidWakeNotification'][1]
+
+        changes = reload_sources(self.dispatcher, {
+            'NSWorkspace': {
+                'NSWorkspaceDidWakeNotification': handler,
+                'NSWorkspaceDidMountNotification': handler,
+            },
+            'SystemConfiguration': { 'regexp:State:/Network/Global/.*': dict(handler, debounce=1) },
+            'NSDistributed': { 'com.example.test': handler },
+        }, dict(self.sources, NSDistributed=EventSource))
+
+        self.assertEquals(sorted((section, sorted(added), sorted(removed)) for section, added, removed in changes), [
+            ('FSEvents', [], [watched]),
+            ('NSDistributed', ['com.example.test'], []),
+            ('NSWorkspace', ['NSWorkspaceDidMountNotification'], ['NSWorkspaceWillSleepNotification']),
+            ('SystemConfiguration', ['regexp:State:/Network/Global/.*'], ['regexp:State:/Network/Global/.*']),
+        ])
+        self.failUnless(workspace.configured['NSWorkspaceDidWakeNotification'][1] is kept)
+        self.assertEquals(sorted(workspace.keys()), ['NSWorkspaceDidMountNotification', 'NSWorkspaceDidWakeNotification'])
+        self.assertEquals(self.dispatcher.sources['FSEvents'].paths(), [])
+        self.assertEquals(len(self.dispatcher.sources['SystemConfiguration'].matcher), 1)
+
+        self.assertEquals(len(reload_sources(self.dispatcher, {}, self.sources)), 3)
+        self.assertEquals([ s.handlers for s in self.dispatcher.sources.values() ], [ {} ] * 4)
+
+
+class SelectEventLoopTests(unittest.TestCase):
+    """Unit test for the portable event loop"""
+
+    def setUp(self):
+        self.loop = SelectEventLoop()
+
+    def test_timers_run_in_order(self):
+        calls = []
+        self.loop.call_later(0.02, lambda: calls.append(2))
+        self.loop.call_later(0.01, lambda: calls.append(1))
+        self.loop.call_later(0.01, lambda: calls.append("cancelled")).cancel()
+        self.loop.call_later(0.03, self.loop.stop)
+        self.loop.run()
+        self.assertEquals(calls, [1, 2])
+
+    def test_reader(self):
+        read_fd, write_fd = os.pipe()
+        data = []
+        self.loop.add_reader(read_fd, lambda: data.append(os.read(read_fd, 10)) or self.loop.stop())
+        os.write(write_fd, "ping")
+        self.loop.run()
+        self.assertEquals(data, ["ping"])
+
+    def test_failing_callbacks(self):
+        def fail():
+            raise ValueError("boom")
+
+        read_fd, write_fd = os.pipe()
+        calls = []
+        self.loop.add_reader(read_fd, lambda: os.read(read_fd, 10) and fail())
+        self.loop.call_later(0, fail)
+        self.loop.call_later(0.01, lambda: calls.append(1))
+        self.loop.call_later(0.02, self.loop.stop)
+        os.write(write_fd, "ping")
+
+        logging.disable(logging.ERROR)
+        try:
+            self.loop.run()
+        finally:
+            logging.disable(logging.NOTSET)
+            os.close(read_fd)
+            os.close(write_fd)
+        self.assertEquals(calls, [1])
+
+    def test_signal_handler(self):
+        received = []
+        self.loop.add_signal_handler(signal.SIGUSR1, lambda signum: received.append(signum) or self.loop.stop())
+        try:
+            self.loop.call_later(0, lambda: os.kill(os.getpid(), signal.SIGUSR1))
+            self.loop.call_later(5, self.loop.stop)
+            self.loop.run()
+        finally:
+            signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+            signal.set_wakeup_fd(-1)
+        self.assertEquals(received, [signal.SIGUSR1])
+
+    def test_signal_handler_after_enable_wakeup(self):
+        received = []
+        self.loop.enable_wakeup()
+        self.loop.add_signal_handler(signal.SIGUSR1, lambda signum: received.append(signum) or self.loop.stop())
+        try:
+            self.loop.call_later(0, lambda: os.kill(os.getpid(), signal.SIGUSR1))
+            self.loop.call_later(5, self.loop.stop)
+            self.loop.run()
+        finally:
+            signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+            signal.set_wakeup_fd(-1)
+        self.assertEquals(received, [signal.SIGUSR1])
+
+
+if __name__ == '__main__':
+    unittest.main()
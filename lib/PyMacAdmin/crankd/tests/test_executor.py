@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import time
+import unittest
+from PyMacAdmin.crankd.executor import CommandExecutor
+
+class FakeTimer(object):
+    def __init__(self, delay, callback):
+        self.delay     = delay
+        self.callback  = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class CommandExecutorTests(unittest.TestCase):
+    """Unit test for the asynchronous shell command executor"""
+
+    def setUp(self):
+        self.timers   = []
+        self.executor = CommandExecutor(self.call_later, max_children=2, kill_grace=1)
+
+    def call_later(self, delay, callback):
+        timer = FakeTimer(delay, callback)
+        self.timers.append(timer)
+        return timer
+
+    def wait(self, timeout=5):
+        deadline = time.time() + timeout
+        while self.executor.running and time.time() < deadline:
+            time.sleep(0.01)
+            self.executor.reap()
+        self.failIf(self.executor.running)
+
+    def test_submit_does_not_block(self):
+        start = time.time()
+        child = self.executor.submit("sleep 0.5", context="test")
+        self.failUnless(time.time() - start < 0.4)
+        self.failUnless(child.pid in self.executor.running)
+        self.wait()
+        self.assertEquals(child.process.returncode, 0)
+
+    def test_global_limit(self):
+        children = [ self.executor.submit("true", context="handler %d" % i) for i in range(5) ]
+        self.assertEquals(len(self.executor.running), 2)
+        self.assertEquals(len(self.executor.pending), 3)
+        self.wait()
+        self.assertEquals([ c.process.returncode for c in children ], [0] * 5)
+
+    def test_per_handler_limit(self):
+        first  = self.executor.submit("sleep 0.1", context="slow", limit=1)
+        second = self.executor.submit("true", context="slow", limit=1)
+        other  = self.executor.submit("true", context="fast", limit=1)
+        self.assertEquals(second.process, None)
+        self.failIf(other.process is None)
+        self.assertEquals(list(self.executor.pending), [second])
+        self.wait()
+        self.failUnless(second.started >= first.started)
+        self.assertEquals(self.executor.per_handler, {})
+
+    def test_timeout_escalation(self):
+        child = self.executor.submit("trap '' TERM; sleep 10", context="stuck", timeout=30)
+        time.sleep(0.2)
+        self.assertEquals(self.timers[0].delay, 30)
+
+        self.timers[0].callback()       # SIGTERM is ignored
+        self.executor.reap()
+        self.failUnless(child.pid in self.executor.running)
+        self.assertEquals(self.timers[1].delay, 1)
+
+        self.timers[1].callback()       # SIGKILL
+        self.wait()
+        self.assertEquals(child.process.returncode, -9)
+
+    def test_timer_cancelled_on_exit(self):
+        self.executor.submit("true", context="quick", timeout=30)
+        self.wait()
+        self.failUnless(self.timers[0].cancelled)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import random
+import unittest
+
+from PyMacAdmin.crankd.config import configure_sources, compile_config
+from PyMacAdmin.crankd.events import Dispatcher
+from PyMacAdmin.crankd.geofence import Region, RegionIndex, distance
+from PyMacAdmin.crankd.sources import LocationSource, get_location_settings
+
+class RegionIndexTests(unittest.TestCase):
+    """Unit test for distances and the region grid"""
+
+    def test_distance(self):
+        self.assertAlmostEquals(distance(0, 0, 1, 0), 111195, places=0)
+        self.assertAlmostEquals(distance(51.5, -0.1, 51.5, -0.1), 0)
+        self.assertAlmostEquals(distance(0, 179.9, 0, -179.9), distance(0, 0, 0, 0.2))
+
+    def test_matches_brute_force(self):
+        rng     = random.Random(7)
+        index   = RegionIndex()
+        regions = list()
+        for n in range(500):
+            region = Region("r%d" % n, rng.uniform(37.0, 38.0), rng.uniform(-122.5, -121.5), rng.uniform(50, 20000))
+            regions.append(region)
+            index.add(region)
+
+        for i in range(2000):
+            lat, lon = rng.uniform(36.9, 38.1), rng.uniform(-122.6, -121.4)
+            self.assertEquals(index.containing(lat, lon), set(r.name for r in regions if r.contains(lat, lon)))
+
+    def test_edges_of_the_grid(self):
+        index = RegionIndex()
+        index.add(Region("dateline", 0.0, 180.0, 5000))
+        index.add(Region("pole", 89.99, 0.0, 5000))
+
+        self.assertEquals(index.containing(0.0, -179.99), set([ "dateline" ]))
+        self.assertEquals(index.containing(0.0, 179.99), set([ "dateline" ]))
+        self.assertEquals(index.containing(89.995, 135.0), set([ "pole" ]))
+
+        index.remove("dateline")
+        index.add(Region("pole", 0.0, 0.0, 100))
+        self.assertEquals((len(index), index.containing(89.995, 135.0), index.containing(0.0, 0.0)), (1, set(), set([ "pole" ])))
+
+class LocationSourceTests(unittest.TestCase):
+    """Thresholds and geofences for CLLocation entries"""
+
+    def setUp(self):
+        self.now        = 1000.0
+        self.dispatcher = Dispatcher()
+        self.calls      = []
+
+    def configure(self, event_config):
+        event_config = dict(event_config, command='true')
+        configure_sources(self.dispatcher, { 'CLLocation': { 'here': event_config } }, { 'CLLocation': LocationSource })
+        source = self.dispatcher.sources['CLLocation']
+        source.clock = lambda: self.now
+        source.handlers['here'] = [ lambda **kwargs: self.calls.append(kwargs) ]
+        return source
+
+    def update(self, source, lat, lon, accuracy=10.0, after=0):
+        self.now += after
+        source.location_updated('here', { 'latitude': lat, 'longitude': lon, 'horizontalAccuracy': accuracy })
+
+    def test_thresholds(self):
+        source = self.configure({ 'min_distance': 100, 'min_interval': 60, 'accuracy': 50 })
+        self.update(source, 37.0, -122.0)
+        self.update(source, 37.01, -122.0, after=10)           # Too soon
+        self.update(source, 37.0001, -122.0, after=60)         # Too close
+        self.update(source, 37.01, -122.0, accuracy=500)       # Too inaccurate
+        self.update(source, 37.01, -122.0, accuracy=-1)        # Invalid
+        self.update(source, 37.01, -122.0)
+
+        self.assertEquals([ c['location_info']['latitude'] for c in self.calls ], [ 37.0, 37.01 ])
+        self.assertEquals(source.ignored, 4)
+
+    def test_geofence(self):
+        source = self.configure({ 'regions': {
+            'office': { 'latitude': 37.0, 'longitude': -122.0, 'radius': 200 },
+            'campus': { 'latitude': 37.0, 'longitude': -122.0, 'radius': 2000 },
+        } })
+        self.update(source, 37.0, -122.0)
+        self.update(source, 37.0005, -122.0)
+        self.update(source, 37.01, -122.0)
+        self.update(source, 37.1, -122.0)
+
+        self.assertEquals([ (c['region'], c['transition']) for c in self.calls ], [
+            ('campus', 'enter'), ('office', 'enter'), ('office', 'exit'), ('campus', 'exit')
+        ])
+
+    def test_settings(self):
+        settings = get_location_settings("test", { 'min_distance': 50, 'regions': { 'a': { 'latitude': 1, 'longitude': 2, 'radius': 3 } } })
+        self.assertEquals((settings['min_distance'], settings['min_interval'], [ r.name for r in settings['regions'] ]), (50.0, None, [ 'a' ]))
+
+        for event_config in ({ 'min_distance': -1 }, { 'accuracy': 0 }, { 'min_interval': 'often' }, { 'regions': [] },
+                             { 'regions': { 'a': { 'latitude': 1, 'longitude': 2 } } },
+                             { 'regions': { 'a': { 'latitude': 91, 'longitude': 2, 'radius': 3 } } }):
+            self.assertRaises(AttributeError, get_location_settings, "test", event_config)
+
+        self.assertRaises(AttributeError, compile_config, { 'CLLocation': { 'here': { 'command': 'true', 'accuracy': -5 } } })
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+from PyMacAdmin.crankd.events import Dispatcher
+from PyMacAdmin.crankd.inotify import IN_Q_OVERFLOW, InotifySource
+from PyMacAdmin.crankd.loop import SelectEventLoop
+
+@unittest.skipUnless(sys.platform.startswith("linux"), "inotify is only available on Linux")
+class InotifySourceTests(unittest.TestCase):
+    """Runs the inotify backend against a temporary directory"""
+
+    def setUp(self):
+        self.temp_dir   = os.path.realpath(tempfile.mkdtemp())
+        self.loop       = SelectEventLoop()
+        self.dispatcher = Dispatcher()
+        self.source     = self.dispatcher.add_source(InotifySource(latency=0.05))
+        self.calls      = []
+
+    def tearDown(self):
+        self.source.stop()
+        shutil.rmtree(self.temp_dir)
+
+    def record(self, watched_path, path=None, recursive=None, **kwargs):
+        self.calls.append((watched_path, path, recursive))
+
+    def path(self, *components):
+        return os.path.join(self.temp_dir, *components)
+
+    def start(self, *paths):
+        for path in paths:
+            self.source.subscribe(path, self.record)
+        self.dispatcher.start(self.loop)
+
+    def wait(self, seconds=0.3):
+        """Runs the loop until the batch has been delivered"""
+        deadline = time.time() + seconds
+        while time.time() < deadline:
+            self.loop.run_once(timeout=0.02)
+
+    def test_batched_changes(self):
+        os.mkdir(self.path("a"))
+        self.start(self.temp_dir)
+
+        for i in range(5):
+            open(self.path("a", "file%d" % i), "w").write("data")
+        open(self.path("top"), "w").write("data")
+        self.wait()
+
+        # One call per changed directory, in the order they first changed:
+        self.assertEquals(self.calls, [
+            (self.temp_dir, self.path("a"), False),
+            (self.temp_dir, self.temp_dir, False),
+        ])
+
+    def test_new_directories_are_watched(self):
+        self.start(self.temp_dir)
+
+        os.makedirs(self.path("new", "deeper"))
+        self.wait()
+        self.failUnless(self.path("new", "deeper") in self.source.dirs)
+        self.failUnless((self.temp_dir, self.path("new"), True) in self.calls)
+
+        del self.calls[:]
+        open(self.path("new", "deeper", "file"), "w").write("data")
+        self.wait()
+        self.assertEquals(self.calls, [ (self.temp_dir, self.path("new", "deeper"), False) ])
+
+    def test_moved_and_removed_directories(self):
+        os.makedirs(self.path("a", "b"))
+        self.start(self.temp_dir)
+
+        os.rename(self.path("a"), self.path("c"))
+        self.wait()
+        self.assertEquals(sorted(self.source.dirs), [ self.temp_dir, self.path("c"), self.path("c", "b") ])
+
+        shutil.rmtree(self.path("c"))
+        self.wait()
+        self.assertEquals(sorted(self.source.dirs), [ self.temp_dir ])
+
+    def test_moved_root_is_watched_again(self):
+        os.makedirs(self.path("a", "b"))
+        self.source.retry_interval = 0.05
+        self.start(self.path("a"))
+
+        logging.disable(logging.WARNING)
+        try:
+            os.rename(self.path("a"), self.path("old"))
+            self.wait()
+            self.assertEquals((self.source.dirs, self.source.missing), ({}, set([ self.path("a") ])))
+
+            del self.calls[:]
+            os.mkdir(self.path("a"))
+            self.wait()
+        finally:
+            logging.disable(logging.NOTSET)
+
+        self.assertEquals((sorted(self.source.dirs), self.source.missing), ([ self.path("a") ], set()))
+        self.assertEquals(self.calls, [ (self.path("a"), self.path("a"), True) ])
+
+        del self.calls[:]
+        open(self.path("a", "file"), "w").write("data")
+        self.wait()
+        self.assertEquals(self.calls, [ (self.path("a"), self.path("a"), False) ])
+
+    def test_overflow(self):
+        os.mkdir(self.path("a"))
+        self.start(self.path("a"))
+
+        logging.disable(logging.CRITICAL)
+        try:
+            self.source.process_event(-1, IN_Q_OVERFLOW, "")
+        finally:
+            logging.disable(logging.NOTSET)
+        self.source.flush()
+        self.loop.run_once(timeout=0)
+
+        self.assertEquals(self.calls, [ (self.path("a"), self.path("a"), True) ])
+        self.assertEquals(self.source.os_dropped, 1)
+
+    def test_refresh(self):
+        os.makedirs(self.path("a", "b"))
+        os.mkdir(self.path("c"))
+        self.start(self.path("a"))
+        self.assertEquals(sorted(self.source.dirs), [ self.path("a"), self.path("a", "b") ])
+
+        self.source.subscribe(self.path("c"), self.record)
+        self.source.unsubscribe(self.path("a"), self.record)
+        self.source.refresh(self.loop)
+        self.assertEquals(sorted(self.source.dirs), [ self.path("c") ])
+
+if __name__ == '__main__':
+    unittest.main()
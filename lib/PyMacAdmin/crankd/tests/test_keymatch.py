@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import doctest
+import unittest
+from PyMacAdmin.crankd import keymatch
+from PyMacAdmin.crankd.keymatch import KeyMatcher
+
+class KeyMatcherTests(unittest.TestCase):
+    """Unit test for the SystemConfiguration key matcher"""
+
+    def setUp(self):
+        self.matcher = KeyMatcher(cache_size=4)
+        self.matcher.add("State:/Network/Global/IPv4", "global")
+        self.matcher.add("regexp:State:/Network/Interface/([^/]+)/Link", "link")
+        self.matcher.add("regexp:State:/Network/Interface/en0/.*", "en0")
+        self.matcher.add("regexp:.*/DNS", "dns")
+
+    def handlers(self, key):
+        return [ h for h, r in self.matcher.resolve(key) ]
+
+    def test_doctests(self):
+        failures, tests = doctest.testmod(keymatch)
+        self.assertEquals(failures, 0)
+
+    def test_explicit_key(self):
+        self.assertEquals(self.matcher.resolve("State:/Network/Global/IPv4"), (("global", None),))
+
+    def test_every_matching_regexp(self):
+        self.assertEquals(self.handlers("State:/Network/Interface/en0/Link"), ["link", "en0"])
+        self.assertEquals(self.handlers("State:/Network/Interface/en1/Link"), ["link"])
+        self.assertEquals(self.handlers("State:/Network/Global/DNS"), ["dns"])
+
+    def test_re_obj(self):
+        ((handler, re_obj),) = self.matcher.resolve("State:/Network/Interface/en1/Link")
+        self.assertEquals(re_obj.match("State:/Network/Interface/en1/Link").group(1), "en1")
+
+    def test_unmatched_key(self):
+        self.assertEquals(self.matcher.resolve("Setup:/Network/Global/IPv4"), ())
+
+    def test_cache_is_bounded(self):
+        for i in range(10):
+            self.matcher.resolve("State:/Network/Interface/en%d/Link" % i)
+        self.assertEquals(len(self.matcher.cache), 4)
+        self.assertEquals(self.handlers("State:/Network/Interface/en9/Link"), ["link"])
+
+    def test_add_invalidates_cache(self):
+        self.assertEquals(self.handlers("State:/Network/Global/Proxies"), [])
+        self.matcher.add("regexp:State:/Network/Global/Prox", "proxy")
+        self.assertEquals(self.handlers("State:/Network/Global/Proxies"), ["proxy"])
+
+    def test_remove(self):
+        self.handlers("State:/Network/Interface/en0/Link")
+        self.matcher.remove("regexp:State:/Network/Interface/([^/]+)/Link", "link")
+        self.matcher.remove("State:/Network/Global/IPv4", "global")
+        self.assertEquals(self.handlers("State:/Network/Interface/en0/Link"), ["en0"])
+        self.assertEquals(self.handlers("State:/Network/Global/IPv4"), [])
+        self.assertEquals(self.handlers("State:/Network/Global/DNS"), ["dns"])
+        self.assertRaises(KeyError, self.matcher.remove, "regexp:.*/DNS", "other")
+
+    def test_notification_keys(self):
+        self.assertEquals(self.matcher.explicit_keys(), ["State:/Network/Global/IPv4"])
+        self.assertEquals(
+            self.matcher.regexp_patterns(),
+            ["State:/Network/Interface/([^/]+)/Link", "State:/Network/Interface/en0/.*", ".*/DNS"]
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
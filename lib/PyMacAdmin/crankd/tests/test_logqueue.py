@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import logging
+import unittest
+
+from PyMacAdmin.crankd.logqueue import LogWriter, QueueHandler, chunk_items, log_list
+
+class ListHandler(logging.Handler):
+    """Collects formatted messages"""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(self.format(record))
+
+def record(msg, name="crankd", level=logging.INFO, args=None):
+    return logging.LogRecord(name, level, __file__, 0, msg, args, None)
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class ChunkTests(unittest.TestCase):
+    """Unit test for splitting lists into syslog-sized messages"""
+
+    def test_chunks(self):
+        self.assertEquals(list(chunk_items(["aaa", "bbb", "ccc"], 8)), [["aaa", "bbb"], ["ccc"]])
+        self.assertEquals(list(chunk_items(["aaaaaaaaaaaa", "b"], 8)), [["aaaaaaaa"], ["b"]])
+        self.assertEquals(list(chunk_items([], 8)), [])
+
+    def test_chunks_fit(self):
+        items = [ "State:/Network/Interface/en%d/Link" % i for i in range(5000) ]
+        chunks = list(chunk_items(items, 1000))
+        self.assertEquals(sum(chunks, []), items)
+        self.failUnless(max(len(", ".join(c)) for c in chunks) <= 1000)
+
+    def test_log_list(self):
+        handler = ListHandler()
+        logger  = logging.getLogger()
+        logger.addHandler(handler)
+        try:
+            log_list("Listening for: %s", [ "x" * 600, "y" * 600 ], level=logging.CRITICAL)
+            log_list("Listening for: %s", [], level=logging.CRITICAL)
+        finally:
+            logger.removeHandler(handler)
+        self.assertEquals(handler.messages, [ "Listening for: " + "x" * 600, "Listening for: " + "y" * 600, "Listening for: " ])
+
+class LogWriterTests(unittest.TestCase):
+    """Unit test for collapsing repeated messages and rate limiting"""
+
+    def setUp(self):
+        self.target = ListHandler()
+        self.target.setFormatter(logging.Formatter("%(name)s %(levelname)s %(message)s"))
+        self.clock  = FakeClock()
+
+    def test_repeats(self):
+        writer = LogWriter([ self.target ], rate=0)
+        writer.write([ record("link down") ] * 4 + [ record("link up") ])
+        writer.write([ record("link up") ])
+        writer.flush_repeats()
+        self.assertEquals(self.target.messages, [
+            "crankd INFO link down",
+            "crankd INFO last message repeated 3 times",
+            "crankd INFO link up",
+            "crankd INFO last message repeated 1 times",
+        ])
+
+    def test_rate_limit_per_logger(self):
+        writer = LogWriter([ self.target ], rate=1, burst=2, clock=self.clock)
+        writer.write([ record("event %d" % i, name="noisy") for i in range(5) ] + [ record("quiet", name="quiet") ])
+        self.clock.now += 1
+        writer.write([ record("event 5", name="noisy") ])
+        self.assertEquals(self.target.messages, [
+            "noisy INFO event 0",
+            "noisy INFO event 1",
+            "quiet INFO quiet",
+            "noisy WARNING 3 messages were suppressed by the rate limit",
+            "noisy INFO event 5",
+        ])
+
+class QueueHandlerTests(unittest.TestCase):
+    """Runs records through the writer thread"""
+
+    def test_queue(self):
+        target  = ListHandler()
+        handler = QueueHandler([ target ], rate=0)
+        args    = { 'key': 'State:/Network/Global/IPv4' }
+        handler.handle(record("changed: %(key)s", args=(args,)))
+        args['key'] = 'mutated'
+        for i in range(3):
+            handler.handle(record("same"))
+        handler.flush()
+        handler.close()
+        self.assertEquals(target.messages, [ "changed: State:/Network/Global/IPv4", "same", "last message repeated 2 times" ])
+        self.failIf(handler.thread.isAlive())
+
+    def test_full_queue_drops(self):
+        target  = ListHandler()
+        handler = QueueHandler([ target ], maxsize=1, rate=0)
+        handler.close()     # Nothing is taking records off the queue now
+        handler.handle(record("kept"))
+        handler.handle(record("dropped"))
+        self.assertEquals(handler.dropped, 1)
+
+if __name__ == '__main__':
+    unittest.main()
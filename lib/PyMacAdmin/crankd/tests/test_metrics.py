@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from PyMacAdmin.crankd.executor import Child
+from PyMacAdmin.crankd.loop import SelectEventLoop
+from PyMacAdmin.crankd.metrics import MetricsRegistry, MetricsServer
+
+class FakeDebouncer(object):
+    def __init__(self, events, invocations, pending):
+        self.events      = events
+        self.invocations = invocations
+        self.pending     = pending
+
+def fail(**kwargs):
+    raise ValueError("handler failure")
+
+class MetricsTests(unittest.TestCase):
+    """Unit test for per-handler metrics"""
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def test_counters(self):
+        ok  = self.registry.instrument(lambda **kwargs: kwargs['value'], "SystemConfiguration: State:/Network/Global/IPv4")
+        bad = self.registry.instrument(fail, "NSWorkspace Notification NSWorkspaceDidWakeNotification")
+
+        self.assertEquals(ok(value=42), 42)
+        ok(value=1)
+        self.assertRaises(ValueError, bad)
+
+        text = self.registry.render()
+        self.failUnless('crankd_handler_calls_total{handler="SystemConfiguration: State:/Network/Global/IPv4"} 2' in text)
+        self.failUnless('crankd_handler_calls_total{handler="NSWorkspace Notification NSWorkspaceDidWakeNotification"} 1' in text)
+        self.failUnless('crankd_handler_errors_total{handler="NSWorkspace Notification NSWorkspaceDidWakeNotification"} 1' in text)
+        self.failUnless('crankd_handler_errors_total{handler="SystemConfiguration: State:/Network/Global/IPv4"} 0' in text)
+
+    def test_histogram(self):
+        metrics = self.registry.handler("h")
+        for elapsed in (0.0005, 0.002, 0.002, 3.0, 120.0):
+            metrics.observe(elapsed)
+
+        text = self.registry.render()
+        self.failUnless("# TYPE crankd_handler_duration_seconds histogram" in text)
+        self.failUnless('crankd_handler_duration_seconds_bucket{handler="h",le="0.001"} 1' in text)
+        self.failUnless('crankd_handler_duration_seconds_bucket{handler="h",le="0.005"} 3' in text)
+        self.failUnless('crankd_handler_duration_seconds_bucket{handler="h",le="5.0"} 4' in text)
+        self.failUnless('crankd_handler_duration_seconds_bucket{handler="h",le="+Inf"} 5' in text)
+        self.failUnless('crankd_handler_duration_seconds_count{handler="h"} 5' in text)
+
+    def test_exit_codes_and_coalesced(self):
+        for rc in (0, 0, 1, -15):
+            self.registry.record_exit(Child("/bin/true", None, "cmd", None, None, None), rc)
+        self.registry.handler("cmd").debouncers.append(FakeDebouncer(10, 2, 1))
+
+        text = self.registry.render()
+        self.failUnless('crankd_command_exits_total{handler="cmd",code="0"} 2' in text)
+        self.failUnless('crankd_command_exits_total{handler="cmd",code="-15"} 1' in text)
+        self.failUnless('crankd_handler_coalesced_total{handler="cmd"} 7' in text)
+
+    def test_dropped(self):
+        self.registry.record_drop("remote")
+        self.registry.record_drop("remote")
+        self.failUnless('crankd_handler_dropped_total{handler="remote"} 2' in self.registry.render())
+
+    def test_label_escaping(self):
+        self.registry.handler('say "hi"\\now')
+        self.failUnless('handler="say \\"hi\\"\\\\now"' in self.registry.render())
+
+    def test_socket(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            loop   = SelectEventLoop()
+            path   = os.path.join(temp_dir, "metrics")
+            server = MetricsServer(self.registry, path, loop)
+            self.registry.instrument(lambda: None, "h")()
+
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect(path)
+            loop.run_once(1.0)
+
+            text = ""
+            while True:
+                data = client.recv(4096)
+                if not data:
+                    break
+                text += data
+            client.close()
+            server.close()
+
+            self.assertEquals(text, self.registry.render())
+            self.failIf(os.path.exists(path))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_socket_does_not_block(self):
+        for i in range(2000):
+            self.registry.handler("handler %d" % i)
+        expected = self.registry.render()
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            loop   = SelectEventLoop()
+            path   = os.path.join(temp_dir, "metrics")
+            server = MetricsServer(self.registry, path, loop, timeout=0.2)
+
+            # A client which never reads is dropped without holding up the loop:
+            stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            stalled.connect(path)
+            logging.disable(logging.WARNING)
+            try:
+                loop.run_once(1.0)
+                self.assertEquals(len(server.clients), 1)
+                loop.run_once(1.0)
+                self.assertEquals(len(server.clients), 0)
+            finally:
+                logging.disable(logging.NOTSET)
+            stalled.close()
+
+            # A client which reads receives everything, a socket buffer at a time:
+            server.timeout = 10.0
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect(path)
+            client.setblocking(False)
+            text = ""
+            while True:
+                loop.run_once(0.01)
+                try:
+                    data = client.recv(65536)
+                except socket.error:
+                    continue
+                if not data:
+                    break
+                text += data
+            client.close()
+            server.close()
+
+            self.assertEquals(len(text), len(expected))
+            self.assertEquals(text, expected)
+        finally:
+            shutil.rmtree(temp_dir)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import doctest
+import unittest
+from PyMacAdmin.crankd import pathtrie
+from PyMacAdmin.crankd.pathtrie import PathTrie
+
+class PathTrieTests(unittest.TestCase):
+    """Unit test for the FSEvents path trie"""
+
+    def setUp(self):
+        self.trie = PathTrie()
+        self.trie.add("/tmp", "tmp")
+        self.trie.add("/tmp/crankd", "crankd")
+        self.trie.add("/tmp/crankd", "crankd-2")
+        self.trie.add("/Library/Preferences", "prefs")
+
+    def test_doctests(self):
+        failures, tests = doctest.testmod(pathtrie)
+        self.assertEquals(failures, 0)
+
+    def test_paths(self):
+        self.assertEquals(len(self.trie), 3)
+        self.assertEquals(sorted(self.trie.paths()), ["/Library/Preferences", "/tmp", "/tmp/crankd"])
+        self.assertEquals(self.trie["/tmp/crankd"], ["crankd", "crankd-2"])
+        self.failUnless("/tmp" in self.trie)
+        self.failIf("/Library" in self.trie)
+
+    def test_match_ancestors(self):
+        self.assertEquals(
+            self.trie.match("/tmp/crankd/spool"),
+            [("/tmp", ["tmp"]), ("/tmp/crankd", ["crankd", "crankd-2"])]
+        )
+        self.assertEquals(self.trie.match("/tmp"), [("/tmp", ["tmp"])])
+
+    def test_match_is_component_based(self):
+        self.assertEquals(self.trie.match("/tmpfoo"), [])
+        self.assertEquals(self.trie.match("/Library/PreferencesBackup"), [])
+
+    def test_remove(self):
+        self.trie.remove("/tmp/crankd")
+        self.assertEquals(self.trie.match("/tmp/crankd"), [("/tmp", ["tmp"])])
+        self.trie.remove("/Library/Preferences")
+        self.assertEquals(self.trie.root[0].keys(), ["tmp"])
+        self.assertRaises(KeyError, self.trie.remove, "/Library")
+
+    def test_remove_callback(self):
+        self.trie.remove("/tmp/crankd", "crankd")
+        self.assertEquals(self.trie["/tmp/crankd"], ["crankd-2"])
+        self.trie.remove("/tmp/crankd", "crankd-2")
+        self.failIf("/tmp/crankd" in self.trie)
+
+
+if __name__ == '__main__':
+    unittest.main()
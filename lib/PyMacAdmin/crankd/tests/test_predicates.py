@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import re
+import unittest
+
+from PyMacAdmin.crankd.config import compile_config, configure_sources
+from PyMacAdmin.crankd.events import Dispatcher, EventSource
+from PyMacAdmin.crankd.metrics import METRICS
+from PyMacAdmin.crankd.predicates import Predicate
+from PyMacAdmin.crankd.sources import SystemConfigurationSource
+
+CALLS = []
+
+def record_call(*args, **kwargs):
+    """Handler used by the test configurations"""
+    CALLS.append(kwargs)
+
+class PredicateTests(unittest.TestCase):
+    """Unit test for compiling and evaluating match dictionaries"""
+
+    def matches(self, spec, **kwargs):
+        return Predicate("test", spec)((), kwargs)
+
+    def test_conditions(self):
+        user_info = { 'NSApplicationName': 'Safari', 'NSApplicationPath': '/Applications/Safari.app', 'pids': [ 1, 2 ] }
+
+        self.failUnless(self.matches({ 'user_info.NSApplicationName': 'Safari' }, user_info=user_info))
+        self.failIf(self.matches({ 'user_info.NSApplicationName': 'Mail' }, user_info=user_info))
+        self.failUnless(self.matches({ 'user_info.NSApplicationName': [ 'Mail', 'Safari' ] }, user_info=user_info))
+        self.failUnless(self.matches({ 'user_info.NSApplicationPath': { 'glob': '/Applications/*.app' } }, user_info=user_info))
+        self.failUnless(self.matches({ 'user_info.NSApplicationPath': { 'regex': 'Saf' } }, user_info=user_info))
+        self.failUnless(self.matches({ 'user_info.pids.1': 2 }, user_info=user_info))
+        self.failIf(self.matches({ 'user_info.pids.2': 2 }, user_info=user_info))
+
+        # Every field and every operator must hold:
+        self.failIf(self.matches({ 'user_info.NSApplicationName': 'Safari', 'path': { 'exists': True } }, user_info=user_info))
+        self.failIf(self.matches({ 'user_info.NSApplicationPath': { 'glob': '/Applications/*', 'regex': 'Mail' } }, user_info=user_info))
+
+    def test_missing_fields(self):
+        self.failIf(self.matches({ 'user_info.NSApplicationName': { 'regex': '.*' } }, user_info=None))
+        self.failIf(self.matches({ 'path': { 'glob': '*' } }))
+        self.failUnless(self.matches({ 'path': { 'exists': False } }))
+
+    def test_captures(self):
+        re_obj = re.compile(r"State:/Network/Interface/(?P<interface>[^/]+)/(\w+)")
+        key    = "State:/Network/Interface/en0/Link"
+        self.failUnless(self.matches({ 'capture.1': 'en0', 'capture.2': 'Link', 'capture.interface': 'en0' }, key=key, re_obj=re_obj))
+        self.failIf(self.matches({ 'capture.1': 'en1' }, key=key, re_obj=re_obj))
+        self.failIf(self.matches({ 'capture.3': 'en0' }, key=key, re_obj=re_obj))
+        self.failIf(self.matches({ 'capture.1': 'en0' }, key=key))
+
+    def test_invalid(self):
+        for spec in ({}, [ 'key' ], { 'key': {} }, { 'key': { 'like': 'x' } }, { 'key': { 'regex': '(' } }, { 'key': { 'glob': 5 } },
+                     { 'key': { 'in': 'abc' } }, { 'key': { 'exists': 'yes' } }):
+            self.assertRaises(AttributeError, Predicate, "test", spec)
+
+        self.assertRaises(AttributeError, compile_config, {
+            'NSWorkspace': { 'NSWorkspaceDidWakeNotification': { 'class': 'x.Y', 'match': { 'key': 'x' } } }
+        })
+
+class ConfiguredPredicateTests(unittest.TestCase):
+    """match dictionaries in a configuration"""
+
+    def setUp(self):
+        del CALLS[:]
+        self.dispatcher = Dispatcher()
+
+    def test_unmatched_events_are_discarded(self):
+        configure_sources(self.dispatcher, {
+            'NSWorkspace': {
+                'NSWorkspaceDidLaunchApplicationNotification': {
+                    'function': '%s.record_call' % __name__, 'match': { 'user_info.NSApplicationName': 'Safari', 'key': { 'glob': 'NSWorkspace*' } }
+                },
+            },
+            'SystemConfiguration': {
+                'regexp:State:/Network/Interface/([^/]+)/Link': { 'function': '%s.record_call' % __name__, 'match': { 'capture.1': [ 'en0', 'en1' ] } },
+            },
+        }, { 'NSWorkspace': EventSource, 'SystemConfiguration': SystemConfigurationSource })
+
+        workspace = self.dispatcher.sources['NSWorkspace']
+        for name in ('Mail', 'Safari'):
+            workspace.emit('NSWorkspaceDidLaunchApplicationNotification', user_info={ 'NSApplicationName': name })
+
+        sc = self.dispatcher.sources['SystemConfiguration']
+        sc.emit_changes([ 'State:/Network/Interface/%s/Link' % i for i in ('en0', 'en5', 'en1') ], info=None)
+
+        self.assertEquals([ c.get('user_info') or c['key'] for c in CALLS ], [
+            { 'NSApplicationName': 'Safari' }, 'State:/Network/Interface/en0/Link', 'State:/Network/Interface/en1/Link'
+        ])
+        self.assertEquals(METRICS.handler("NSWorkspace: NSWorkspaceDidLaunchApplicationNotification").unmatched, 1)
+        self.assertEquals(METRICS.handler("SystemConfiguration: regexp:State:/Network/Interface/([^/]+)/Link").unmatched, 1)
+
+if __name__ == '__main__':
+    unittest.main()
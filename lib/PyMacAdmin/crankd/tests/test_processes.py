@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+from PyMacAdmin.crankd import actions
+from PyMacAdmin.crankd.loop import SelectEventLoop
+from PyMacAdmin.crankd.processes import WorkerGroups
+
+HANDLER_MODULE = """
+import json, os
+
+def record(*args, **kwargs):
+    with open(%(output)r, "a") as f:
+        f.write(json.dumps([ os.getpid(), args, kwargs.get('key'), kwargs.get('n'), kwargs.get('re_obj') and kwargs['re_obj'].pattern ]) + "\\n")
+    if kwargs.get('crash'):
+        os._exit(3)
+    if kwargs.get('fail'):
+        raise ValueError("This handler always fails")
+"""
+
+class WorkerGroupTests(unittest.TestCase):
+    """Runs handlers in real worker processes"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.output   = os.path.join(self.temp_dir, "calls")
+        open(os.path.join(self.temp_dir, "crankd_group_handler.py"), "w").write(HANDLER_MODULE % { 'output': self.output })
+        sys.path.insert(0, self.temp_dir)
+
+        self.loop   = SelectEventLoop()
+        self.groups = WorkerGroups(self.loop, restart_delay=0.01)
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        self.groups.shutdown(timeout=5.0)
+        sys.path.remove(self.temp_dir)
+        shutil.rmtree(self.temp_dir)
+
+    def handler(self, group, key="State:/Network/Global/IPv4"):
+        return self.groups.handler(group, key, { 'function': 'crankd_group_handler.record', 'worker_group': group }, "test: %s" % key)
+
+    def wait(self, timeout=10.0):
+        deadline = time.time() + timeout
+        while not self.groups.idle() and time.time() < deadline:
+            self.loop.run_once(timeout=0.05)
+        self.failUnless(self.groups.idle(), "The worker groups did not finish in time")
+
+    def calls(self):
+        if not os.path.exists(self.output):
+            return []
+        return [ json.loads(line) for line in open(self.output) ]
+
+    def test_calls_run_in_order_in_the_group_process(self):
+        handler = self.handler("inventory")
+        for n in range(5):
+            handler("/Volumes/Data", n=n, re_obj=re.compile("State:/.*"))
+        self.wait()
+
+        calls = self.calls()
+        self.assertEquals([ c[3] for c in calls ], range(5))
+        self.assertEquals(calls[0][1:3], [ [ "/Volumes/Data" ], "State:/Network/Global/IPv4" ])
+        self.assertEquals(calls[0][4], "State:/.*")
+
+        worker = self.groups.groups["inventory"]
+        self.assertEquals(set(c[0] for c in calls), set([ worker.pid ]))
+        self.assertNotEquals(worker.pid, os.getpid())
+        self.assertEquals((worker.calls, worker.completed, worker.failures), (5, 5, 0))
+
+    def test_groups_are_isolated(self):
+        self.handler("a")(n=1)
+        self.handler("b")(n=2)
+        self.wait()
+        self.assertEquals(len(set(c[0] for c in self.calls())), 2)
+
+    def test_crashed_worker_is_restarted(self):
+        handler = self.handler("fragile")
+        handler(n=1, crash=True)
+        handler(n=2)
+        handler(n=3, fail=True)
+        self.wait()
+
+        worker = self.groups.groups["fragile"]
+        self.assertEquals([ c[3] for c in self.calls() ], [ 1, 2, 3 ])
+        self.assertEquals((worker.crashes, worker.restarts, worker.failures, worker.completed), (1, 1, 2, 2))
+        self.assertNotEquals(self.calls()[0][0], self.calls()[1][0])
+
+    def test_restart_backoff(self):
+        handler = self.handler("fragile")
+        worker  = None
+        for n in range(3):
+            handler(n=n, crash=True)
+            self.wait()
+            worker = self.groups.groups["fragile"]
+
+        # The first crash restarted after restart_delay; each further crash doubles it:
+        self.assertEquals((worker.crashes, worker.crashed), (3, 3))
+        delay = worker.timer.when - self.loop.time()
+        self.failUnless(0.03 < delay <= 0.04, delay)
+
+    def test_queue_overflow(self):
+        groups  = self.groups = WorkerGroups(self.loop, max_queue=2)
+        dropped = []
+        groups.drop_hooks.append(dropped.append)
+        handler = self.handler("small")
+        for n in range(5):
+            handler(n=n)
+        self.wait()
+
+        # The first call was sent at once; of the rest only the newest two were kept:
+        self.assertEquals([ c[3] for c in self.calls() ], [ 0, 3, 4 ])
+        self.assertEquals(groups.groups["small"].dropped, 2)
+        self.assertEquals(dropped, [ "test: State:/Network/Global/IPv4" ] * 2)
+
+    def test_get_callable_for_event(self):
+        actions.WORKER_GROUPS = self.groups
+        try:
+            handler = actions.get_callable_for_event("State:/Network/Global/IPv4", { 'function': 'crankd_group_handler.record', 'worker_group': 'g', 'threaded': False }, context="test")
+            handler(n=7)
+            self.wait()
+        finally:
+            actions.WORKER_GROUPS = None
+
+        self.assertEquals([ c[3] for c in self.calls() ], [ 7 ])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import logging
+import os
+import pstats
+import shutil
+import tempfile
+import time
+import unittest
+
+from PyMacAdmin.crankd import actions
+from PyMacAdmin.crankd.profiler import Profiler, SamplingProfiler
+
+def busy_handler(seconds=0.0, **kwargs):
+    """Handler used by the test configurations"""
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        pass
+
+class ProfilerTests(unittest.TestCase):
+    """Profiles handlers and reads the pstats files back"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        logging.disable(logging.INFO)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(self.temp_dir)
+
+    def functions(self, file_name):
+        return dict((func[2], value) for func, value in pstats.Stats(file_name).stats.items())
+
+    def test_cprofile(self):
+        profiler = Profiler(self.temp_dir)
+        actions.PROFILER = profiler
+        try:
+            handler = actions.get_callable_for_event("NSWorkspaceDidWakeNotification", { 'function': '%s.busy_handler' % __name__ }, context="NSWorkspace: wake")
+        finally:
+            actions.PROFILER = None
+
+        for i in range(3):
+            handler()
+        nested = profiler.wrap(lambda: handler(), "outer")
+        nested()
+
+        files = profiler.dump()
+        self.assertEquals([ os.path.basename(f) for f in files ], [ "NSWorkspace_wake.pstats", "outer.pstats" ])
+
+        # The nested call is only counted by the outer handler:
+        self.assertEquals(self.functions(files[0])['busy_handler'][1], 3)
+        self.assertEquals(self.functions(files[1])['busy_handler'][1], 1)
+
+    def test_sampling(self):
+        profiler = SamplingProfiler(self.temp_dir, interval=0.002)
+        handler  = profiler.wrap(busy_handler, "busy")
+        try:
+            handler(seconds=0.3)
+        finally:
+            profiler.stop()
+
+        self.failIf(profiler.active)
+        functions = self.functions(profiler.dump()[0])
+
+        # Nothing outside the handler is sampled and most samples land in it:
+        self.assertEquals(set(functions), set([ 'busy_handler' ]))
+        self.failUnless(profiler.sampled > 10, profiler.sampled)
+        self.failUnless(0.1 < functions['busy_handler'][3] < 0.5, functions['busy_handler'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from PyMacAdmin.crankd.config import configure_sources
+from PyMacAdmin.crankd.events import Dispatcher, Event, EventSource
+from PyMacAdmin.crankd.loop import SelectEventLoop
+from PyMacAdmin.crankd.metrics import MetricsRegistry
+from PyMacAdmin.crankd.queues import EventQueue, get_queue_settings
+from PyMacAdmin.crankd.sources import FileSystemSource
+
+class FakeTimer(object):
+    def __init__(self, callback):
+        self.callback  = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class EventQueueTests(unittest.TestCase):
+    """Unit test for the overflow policies"""
+
+    def setUp(self):
+        self.delivered = []
+        self.timers    = []
+        logging.disable(logging.WARNING)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def call_later(self, delay, callback):
+        timer = FakeTimer(callback)
+        self.timers.append(timer)
+        return timer
+
+    def run_timers(self):
+        while self.timers:
+            timer = self.timers.pop(0)
+            if not timer.cancelled:
+                timer.callback()
+
+    def queue(self, **kwargs):
+        return EventQueue("test", self.delivered.append, self.call_later, **kwargs)
+
+    def put(self, queue, *keys):
+        for key in keys:
+            queue.put(Event("test", key, { 'key': key }))
+
+    def keys(self):
+        return [ e.key for e in self.delivered ]
+
+    def test_batches(self):
+        q = self.queue(batch_size=2)
+        self.put(q, "a", "b", "c")
+        self.assertEquals(len(self.timers), 1)
+
+        self.timers.pop(0).callback()
+        self.assertEquals(self.keys(), [ "a", "b" ])
+        self.run_timers()
+        self.assertEquals(self.keys(), [ "a", "b", "c" ])
+        self.assertEquals((len(q), q.high_water, q.dropped), (0, 3, 0))
+
+    def test_drop_oldest(self):
+        q = self.queue(max_size=2, overflow='drop-oldest')
+        self.put(q, "a", "b", "c")
+        self.run_timers()
+        self.assertEquals((self.keys(), q.dropped, q.high_water), ([ "b", "c" ], 1, 2))
+
+    def test_drop_newest(self):
+        q = self.queue(max_size=2, overflow='drop-newest')
+        self.put(q, "a", "b", "c")
+        self.run_timers()
+        self.assertEquals((self.keys(), q.dropped), ([ "a", "b" ], 1))
+
+    def test_block(self):
+        q = self.queue(max_size=2, overflow='block')
+        self.put(q, "a", "b", "c")
+        self.assertEquals(self.keys(), [ "a" ])
+        self.run_timers()
+        self.assertEquals((self.keys(), q.dropped, q.blocked), ([ "a", "b", "c" ], 0, 1))
+
+    def test_coalesce(self):
+        q = self.queue(max_size=2, overflow='coalesce', rescan=lambda e: Event("test", "root", { 'rescan': True }))
+        q.put(Event("test", "a", { 'n': 1, 'recursive': True }))
+        q.put(Event("test", "b", { 'n': 2 }))
+        q.put(Event("test", "a", { 'n': 3, 'recursive': False }))
+        self.assertEquals((len(q), q.coalesced), (2, 1))
+
+        # Both dropped events are replaced by a single rescan of their root:
+        self.put(q, "c", "d")
+        self.run_timers()
+        self.assertEquals(self.keys(), [ "root", "c", "d" ])
+        self.assertEquals((q.dropped, q.rescanned, q.enqueued), (2, 1, 5))
+
+        del self.delivered[:]
+        q.put(Event("test", "a", { 'n': 4 }))
+        self.run_timers()
+        self.assertEquals([ e.payload for e in self.delivered ], [ { 'n': 4 } ])
+
+    def test_coalesced_flags(self):
+        q = self.queue(overflow='coalesce')
+        q.put(Event("test", "a", { 'n': 1, 'recursive': True }))
+        q.put(Event("test", "a", { 'n': 2, 'recursive': False }))
+        q.flush()
+        self.assertEquals([ e.payload for e in self.delivered ], [ { 'n': 2, 'recursive': True } ])
+
+    def test_coalesced_values(self):
+        q = self.queue(overflow='coalesce')
+        q.put(Event("test", "a", { 'old_value': 1, 'new_value': 2 }))
+        q.put(Event("test", "a", { 'old_value': 2, 'new_value': 3 }))
+        q.put(Event("test", "b", { 'event_id': 4 }))
+        q.put(Event("test", "b", { 'event_id': 5 }))
+        q.flush()
+        self.assertEquals([ e.payload for e in self.delivered ], [ { 'old_value': 1, 'new_value': 3 }, { 'event_id': 4 } ])
+
+    def test_settings(self):
+        self.assertEquals(get_queue_settings("FSEvents", { 'max_size': 10, 'overflow': 'block' }), { 'max_size': 10, 'overflow': 'block' })
+        for settings in ({ 'max_size': 0 }, { 'max_size': "10" }, { 'overflow': 'drop-all' }, { 'size': 10 }, [ 10 ]):
+            self.assertRaises(AttributeError, get_queue_settings, "FSEvents", settings)
+
+class SourceQueueTests(unittest.TestCase):
+    """Runs source events through their queues"""
+
+    def setUp(self):
+        self.temp_dir   = os.path.realpath(tempfile.mkdtemp())
+        self.loop       = SelectEventLoop()
+        self.dispatcher = Dispatcher()
+        self.calls      = []
+        logging.disable(logging.WARNING)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(self.temp_dir)
+
+    def record(self, *args, **kwargs):
+        self.calls.append((args, kwargs))
+
+    def test_dispatch_after_start(self):
+        source = self.dispatcher.add_source(EventSource("NSWorkspace"))
+        source.subscribe("NSWorkspaceDidWakeNotification", self.record)
+
+        source.emit("NSWorkspaceDidWakeNotification")
+        self.assertEquals(len(self.calls), 1)
+
+        self.dispatcher.start(self.loop)
+        source.emit("NSWorkspaceDidWakeNotification")
+        self.assertEquals(len(self.calls), 1)
+        self.loop.run_once(timeout=0)
+        self.assertEquals(len(self.calls), 2)
+
+    def test_fsevents_rescan(self):
+        source = self.dispatcher.add_source(FileSystemSource())
+        os.makedirs(os.path.join(self.temp_dir, "a", "b"))
+        source.subscribe(self.temp_dir, self.record)
+        source.subscribe(os.path.join(self.temp_dir, "a"), self.record)
+        source.configure_queue({ 'max_size': 1 })
+        self.dispatcher.start(self.loop)
+
+        for path in ("a", "a/b", "a"):
+            path = os.path.join(self.temp_dir, path)
+            source.emit(path, path=path, recursive=False)
+        self.loop.run_once(timeout=0)
+
+        # a was dropped: its outermost watch is rescanned, then a/b is delivered once
+        self.assertEquals([ (args[0], kwargs['path'], kwargs['recursive'], kwargs.get('rescan')) for args, kwargs in self.calls ], [
+            (self.temp_dir, self.temp_dir, True, True),
+            (self.temp_dir, os.path.join(self.temp_dir, "a"), False, None),
+            (os.path.join(self.temp_dir, "a"), os.path.join(self.temp_dir, "a"), False, None),
+        ])
+
+    def test_configured_queues(self):
+        configure_sources(self.dispatcher, {
+            'NSWorkspace': {},
+            'Queues': { 'NSWorkspace': { 'max_size': 5, 'overflow': 'drop-newest' } },
+        }, { 'NSWorkspace': EventSource })
+        self.dispatcher.start(self.loop)
+
+        source = self.dispatcher.sources['NSWorkspace']
+        for i in range(10):
+            source.emit("NSWorkspaceDidWakeNotification")
+        self.assertEquals((source.queue.max_size, source.queue.overflow, source.queue.dropped), (5, 'drop-newest', 5))
+
+        metrics = MetricsRegistry()
+        metrics.dispatcher = self.dispatcher
+        rendered = metrics.render()
+        self.failUnless('crankd_queue_depth{source="NSWorkspace"} 5' in rendered)
+        self.failUnless('crankd_queue_dropped_total{source="NSWorkspace"} 5' in rendered)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import logging
+import unittest
+
+from PyMacAdmin.crankd import actions
+from PyMacAdmin.crankd.config import configure_sources
+from PyMacAdmin.crankd.events import Dispatcher, EventSource
+from PyMacAdmin.crankd.ratelimit import RateLimiter, get_rate_limit_settings
+
+class FakeClock(object):
+    """Timers and time which only advance when the test says so"""
+
+    def __init__(self):
+        self.now    = 1000.0
+        self.timers = []
+
+    def __call__(self):
+        return self.now
+
+    time = __call__
+
+    def call_later(self, delay, callback):
+        timer = FakeTimer(self.now + delay, callback)
+        self.timers.append(timer)
+        return timer
+
+    def advance(self, seconds):
+        self.now += seconds
+        for timer in sorted(self.timers, key=lambda t: t.when):
+            if timer.when <= self.now and not timer.cancelled:
+                self.timers.remove(timer)
+                timer.callback()
+
+class FakeTimer(object):
+    def __init__(self, when, callback):
+        self.when      = when
+        self.callback  = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class RateLimiterTests(unittest.TestCase):
+    """Unit test for the token bucket and the three policies"""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.calls = []
+        logging.disable(logging.WARNING)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def record(self, *args, **kwargs):
+        self.calls.append(kwargs.get('n'))
+
+    def limiter(self, **kwargs):
+        return RateLimiter(self.record, self.clock.call_later, clock=self.clock, name="test", **kwargs)
+
+    def test_drop(self):
+        limiter = self.limiter(rate=2, burst=3)
+        for n in range(10):
+            limiter(n=n)
+        self.assertEquals(self.calls, [ 0, 1, 2 ])
+
+        # Two tokens per second:
+        self.clock.advance(1.0)
+        for n in range(10, 15):
+            limiter(n=n)
+        self.assertEquals(self.calls, [ 0, 1, 2, 10, 11 ])
+        self.assertEquals((limiter.allowed, limiter.throttled, limiter.dropped), (5, 10, 10))
+        self.assertEquals(self.clock.timers, [])
+
+    def test_defer(self):
+        limiter = self.limiter(rate=10, policy='defer', max_pending=3)
+        for n in range(5):
+            limiter(n=n)
+        self.assertEquals(self.calls, [ 0 ])
+
+        self.clock.advance(0.1)
+        self.assertEquals(self.calls, [ 0, 2 ])
+        limiter(n=5)
+        self.clock.advance(0.1)
+        self.clock.advance(0.1)
+        self.clock.advance(0.1)
+        self.assertEquals(self.calls, [ 0, 2, 3, 4, 5 ])
+        self.assertEquals((limiter.throttled, limiter.dropped), (5, 1))
+
+    def test_latest(self):
+        limiter = self.limiter(rate=1, policy='latest')
+        limiter(key="State:/Network/Interface/en0/Link", n=1)
+        limiter(key="State:/Network/Interface/en0/Link", n=2)
+        limiter(key="State:/Network/Interface/en1/Link", n=3)
+        limiter(key="State:/Network/Interface/en0/Link", n=4)
+
+        self.clock.advance(1.0)
+        self.assertEquals(self.calls, [ 1, 4 ])
+        limiter.flush()
+        self.assertEquals(self.calls, [ 1, 4, 3 ])
+        self.assertEquals((limiter.throttled, limiter.replaced, limiter.dropped), (3, 1, 0))
+
+    def test_settings(self):
+        self.assertEquals(get_rate_limit_settings("test", { 'rate': 5, 'burst': 10, 'policy': 'latest' }), { 'rate': 5.0, 'burst': 10, 'policy': 'latest' })
+        for settings in ({}, { 'rate': 0 }, { 'rate': 'fast' }, { 'rate': 1, 'burst': 0 }, { 'rate': 1, 'policy': 'queue' }, { 'rate': 1, 'per': 'second' }, 5):
+            self.assertRaises(AttributeError, get_rate_limit_settings, "test", settings)
+
+class ConfiguredRateLimitTests(unittest.TestCase):
+    """Rate limits from a configuration"""
+
+    def setUp(self):
+        self.clock      = FakeClock()
+        self.dispatcher = Dispatcher()
+        self.calls      = []
+        actions.EVENT_LOOP = self.clock
+        logging.disable(logging.WARNING)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        actions.EVENT_LOOP = None
+
+    def test_handler_and_source_limits(self):
+        configure_sources(self.dispatcher, {
+            'NSDistributed': {
+                'com.apple.iTunes.playerInfo': { 'command': 'true', 'rate_limit': { 'rate': 1, 'policy': 'latest' } },
+            },
+            'Queues': { 'NSDistributed': { 'rate_limit': { 'rate': 100, 'burst': 2 } } },
+        }, { 'NSDistributed': EventSource })
+
+        source  = self.dispatcher.sources['NSDistributed']
+        handler = source.configured['com.apple.iTunes.playerInfo'][1]
+        self.assertEquals(source.limiter.bucket.burst, 2)
+
+        # The source drops the third event before the dispatcher sees it; the
+        # handler's limit holds the second:
+        handler.callback = lambda *args, **kwargs: self.calls.append(kwargs.get('user_info'))
+        for n in range(3):
+            source.emit('com.apple.iTunes.playerInfo', user_info=n)
+        self.assertEquals((self.dispatcher.dispatched, source.limiter.dropped, self.calls), (2, 1, [ 0 ]))
+
+        self.clock.advance(1.0)
+        self.assertEquals(self.calls, [ 0, 1 ])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import shutil
+import signal
+import tempfile
+import unittest
+
+from PyMacAdmin.crankd import actions
+from PyMacAdmin.crankd.events import Dispatcher, EventSource
+from PyMacAdmin.crankd.replay import EventRecorder, normalize, percentile, read_events, replay
+
+CALLS = []
+
+def record_call(*args, **kwargs):
+    """Handler used by the test configuration"""
+    CALLS.append(kwargs)
+
+class FakeNotification(object):
+    def name(self):
+        return "NSWorkspaceDidMountNotification"
+
+    def userInfo(self):
+        return None
+
+class ReplayTests(unittest.TestCase):
+    """Unit test for event recording and replay"""
+
+    def setUp(self):
+        del CALLS[:]
+        self.temp_dir  = tempfile.mkdtemp()
+        self.recording = os.path.join(self.temp_dir, "events.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.set_wakeup_fd(-1)
+        actions.EVENT_LOOP = actions.COMMAND_EXECUTOR = None
+
+    def record(self, events):
+        dispatcher = Dispatcher()
+        source     = dispatcher.add_source(EventSource("NSWorkspace"))
+        sc         = dispatcher.add_source(EventSource("SystemConfiguration"))
+        source.subscribe("NSWorkspaceDidMountNotification", lambda **kwargs: None)
+
+        recorder = EventRecorder(self.recording)
+        dispatcher.event_hooks.append(recorder)
+        for source_name, key, payload in events:
+            dispatcher.sources[source_name].emit(key, **payload)
+        recorder.close()
+        return recorder
+
+    def test_normalize(self):
+        self.assertEquals(normalize({'a': (1, 2), 'b': set(["x"])}), {u'a': [1, 2], u'b': [u'x']})
+        self.assertEquals(normalize(FakeNotification()), u"NSWorkspaceDidMountNotification")
+        self.assertEquals(normalize("caf\xc3\xa9"), u"caf\xe9")
+        self.assertEquals(normalize(object).startswith(u"<type"), True)
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEquals((percentile(values, 0.5), percentile(values, 0.99), percentile(values, 1)), (50, 99, 100))
+        self.assertEquals(percentile([], 0.5), 0)
+
+    def test_round_trip(self):
+        recorder = self.record([
+            ("NSWorkspace", "NSWorkspaceDidMountNotification", { 'event': FakeNotification(), 'user_info': {'NSDevicePath': '/Volumes/Test'} }),
+            ("SystemConfiguration", "State:/Network/Global/IPv4", { 'key': "State:/Network/Global/IPv4", 'info': None }),
+        ])
+        self.assertEquals(recorder.recorded, 2)
+
+        events = list(read_events(self.recording))
+        self.assertEquals([ (e.source, e.key) for e in events ], [
+            ("NSWorkspace", "NSWorkspaceDidMountNotification"),
+            ("SystemConfiguration", "State:/Network/Global/IPv4"),
+        ])
+        self.assertEquals(events[0].payload, { 'event': "NSWorkspaceDidMountNotification", 'user_info': {'NSDevicePath': '/Volumes/Test'} })
+        self.failUnless(events[0].timestamp <= events[1].timestamp)
+
+    def test_replay(self):
+        self.record([
+            ("SystemConfiguration", "State:/Network/Interface/en%d/Link" % (i % 3), { 'key': "State:/Network/Interface/en%d/Link" % (i % 3), 'info': None })
+            for i in range(30)
+        ] + [
+            ("NSWorkspace", "NSWorkspaceDidMountNotification", { 'user_info': None }),
+        ])
+
+        config = {
+            'SystemConfiguration': {
+                'regexp:State:/Network/Interface/en[01]/Link': { 'function': '%s.record_call' % __name__ },
+            }
+        }
+        report = replay(config, self.recording, rate=0)
+
+        self.assertEquals(len(CALLS), 20)
+        self.failUnless(report[0].startswith("Replayed 31 events"))
+        self.failUnless([ l for l in report if l.endswith("  SystemConfiguration: regexp:State:/Network/Interface/en[01]/Link") and l.split()[0] == "20" ])
+        self.assertEquals(report[-1], "Unhandled events: 11, handler failures: 0")
+
+
+if __name__ == '__main__':
+    unittest.main()
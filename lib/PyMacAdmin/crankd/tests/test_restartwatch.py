@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from PyMacAdmin.crankd.events import Dispatcher
+from PyMacAdmin.crankd.restartwatch import RestartWatch, source_file
+from PyMacAdmin.crankd.sources import FileSystemSource
+
+class FakeModule(object):
+    def __init__(self, name, file_name):
+        self.__name__ = name
+        self.__file__ = file_name
+
+class RestartWatchTests(unittest.TestCase):
+    """Unit test for manifest-based restart detection"""
+
+    def setUp(self):
+        self.temp_dir = os.path.realpath(tempfile.mkdtemp())
+        self.reasons  = []
+        self.watch    = RestartWatch(self.reasons.append, exclude=[ os.path.join(self.temp_dir, "stdlib", "") ])
+
+        self.source = FileSystemSource()
+        Dispatcher().add_source(self.source)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def create(self, *components):
+        file_name = os.path.join(self.temp_dir, *components)
+        if not os.path.isdir(os.path.dirname(file_name)):
+            os.makedirs(os.path.dirname(file_name))
+        open(file_name, "w").write("pass\n")
+        return file_name
+
+    def modify(self, file_name):
+        open(file_name, "a").write("# updated\n")
+
+    def test_excludes(self):
+        modules = [
+            FakeModule("os", self.create("stdlib", "os.py")),
+            FakeModule("objc", self.create("stdlib", "site-packages", "objc", "__init__.py")),
+            FakeModule("handlers", self.create("handlers", "handlers.py")),
+            FakeModule("sys", None),
+        ]
+        self.assertEquals(self.watch.add_modules(modules), 2)
+        self.assertEquals(sorted(self.watch.manifest), [
+            os.path.join(self.temp_dir, "handlers"),
+            os.path.join(self.temp_dir, "stdlib", "site-packages", "objc"),
+        ])
+
+    def test_source_file(self):
+        py = self.create("handlers", "handlers.py")
+        self.assertEquals(source_file(py + "c"), py)
+        self.assertEquals(source_file(os.path.join(self.temp_dir, "egg.pyc")), os.path.join(self.temp_dir, "egg.pyc"))
+
+    def test_minimal_directories(self):
+        self.watch.add(self.create("a", "one.py"), "one")
+        self.watch.add(self.create("a", "b", "two.py"), "two")
+        self.watch.add(self.create("a-b", "three.py"), "three")
+        self.assertEquals(self.watch.directories(), [ os.path.join(self.temp_dir, "a"), os.path.join(self.temp_dir, "a-b") ])
+
+        self.watch.subscribe(self.source)
+        self.assertEquals(sorted(self.source.paths()), self.watch.directories())
+
+    def test_only_changed_directory_is_checked(self):
+        one = self.create("a", "one.py")
+        two = self.create("a", "b", "two.py")
+        self.watch.add(one, "one changed")
+        self.watch.add(two, "two changed")
+        self.watch.subscribe(self.source)
+
+        self.modify(two)
+        self.source.emit(os.path.join(self.temp_dir, "a"), path=os.path.join(self.temp_dir, "a"), recursive=False)
+        self.assertEquals(self.reasons, [])
+
+        self.source.emit(os.path.join(self.temp_dir, "a", "b"), path=os.path.join(self.temp_dir, "a", "b"), recursive=False)
+        self.assertEquals(self.reasons, [ "two changed" ])
+
+    def test_recursive_and_missing(self):
+        one     = self.create("a", "one.py")
+        missing = os.path.join(self.temp_dir, "a", "b", "later.py")
+        self.create("a", "b", "placeholder")
+        self.watch.add(one, "one changed")
+        self.watch.add(missing, "later created")
+        self.watch.subscribe(self.source)
+
+        # A dropped-events rescan of the root checks every directory below it:
+        self.source.emit(os.path.join(self.temp_dir, "a"), path=os.path.join(self.temp_dir, "a"), recursive=True)
+        self.assertEquals(self.reasons, [])
+
+        self.create("a", "b", "later.py")
+        self.source.emit(os.path.join(self.temp_dir, "a"), path=os.path.join(self.temp_dir, "a"), recursive=True)
+        self.assertEquals(self.reasons, [ "later created" ])
+
+    def test_callback(self):
+        config   = self.create("config.plist")
+        reloaded = []
+        self.watch.add(config, "config changed", reloaded.append)
+        self.watch.subscribe(self.source)
+
+        self.modify(config)
+        self.source.emit(self.temp_dir, path=self.temp_dir, recursive=False)
+        self.source.emit(self.temp_dir, path=self.temp_dir, recursive=False)
+        self.assertEquals(reloaded, [ "config changed" ])
+        self.assertEquals(self.reasons, [])
+
+    def test_incremental_subscribe(self):
+        self.watch.add_modules([ FakeModule("one", self.create("a", "one.py")) ])
+        self.failUnless(self.watch.subscribe(self.source))
+
+        modules = [ FakeModule("one", self.create("a", "one.py")), FakeModule("two", self.create("a", "b", "two.py")) ]
+        self.assertEquals(self.watch.add_modules(modules), 1)
+        self.failIf(self.watch.subscribe(self.source))
+
+        self.watch.add_modules([ FakeModule("three", self.create("c", "three.py")) ])
+        self.failUnless(self.watch.subscribe(self.source))
+        self.assertEquals(sorted(self.source.paths()), [ os.path.join(self.temp_dir, "a"), os.path.join(self.temp_dir, "c") ])
+
+    def test_real_modules(self):
+        watch = RestartWatch(self.reasons.append)
+        watch.add_modules(filter(None, sys.modules.values()))
+        self.failIf(watch.is_excluded(source_file(os.path.realpath(sys.modules['PyMacAdmin.crankd.restartwatch'].__file__))))
+        self.failUnless(watch.is_excluded(source_file(os.path.realpath(os.__file__))))
+
+if __name__ == '__main__':
+    unittest.main()
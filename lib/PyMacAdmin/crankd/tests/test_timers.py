@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import logging
+import random
+import time
+import unittest
+from datetime import datetime
+
+from PyMacAdmin.crankd.config import configure_sources, compile_config
+from PyMacAdmin.crankd.events import Dispatcher
+from PyMacAdmin.crankd.timers import TimerWheel, TimerSource, CronSchedule, get_timer_schedule
+
+class FakeLoop(object):
+    """Timers and time which only advance when the test says so"""
+
+    def __init__(self):
+        self.now    = 1000000.0
+        self.timers = []
+
+    def time(self):
+        return self.now
+
+    def call_later(self, delay, callback):
+        timer = FakeTimer(self.now + delay, callback)
+        self.timers.append(timer)
+        return timer
+
+    def run_until(self, when):
+        """Runs every timer due by when, including those they schedule, at the time it was due"""
+        while True:
+            self.timers = [ t for t in self.timers if not t.cancelled ]
+            due = [ t for t in self.timers if t.when <= when ]
+            if not due:
+                break
+            timer = min(due, key=lambda t: t.when)
+            self.timers.remove(timer)
+            self.now = max(self.now, timer.when)
+            timer.callback()
+        self.now = max(self.now, when)
+
+    def sleep(self, seconds):
+        """Jumps forward without running anything, like a machine waking from sleep"""
+        self.now += seconds
+
+class FakeTimer(object):
+    def __init__(self, when, callback):
+        self.when      = when
+        self.callback  = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class TimerWheelTests(unittest.TestCase):
+    """Unit test for the hierarchical timing wheel"""
+
+    def setUp(self):
+        self.loop  = FakeLoop()
+        self.wheel = TimerWheel(self.loop.call_later, self.loop.time)
+        self.fired = []
+
+    def add(self, delay):
+        when = self.loop.now + delay
+        return self.wheel.add(when, lambda: self.fired.append((when, self.loop.now)))
+
+    def test_fires_in_order(self):
+        rng    = random.Random(42)
+        delays = [ rng.uniform(0, 10 ** rng.randint(1, 7)) for i in range(5000) ]
+        for delay in delays:
+            self.add(delay)
+        self.assertEquals(len(self.wheel), 5000)
+
+        self.loop.run_until(self.loop.now + 10 ** 7 + 1)
+        self.assertEquals(len(self.fired), 5000)
+        self.assertEquals([ f[0] for f in self.fired ], sorted(self.loop.now - 10 ** 7 - 1 + d for d in delays))
+        for when, fired in self.fired:
+            self.failUnless(when <= fired < when + 1, (when, fired))
+
+        # One loop timer at a time, woken only to fire or cascade rather than
+        # every second for 115 days:
+        self.assertEquals(len(self.wheel), 0)
+        self.assertEquals(self.loop.timers, [])
+        self.failUnless(self.wheel.wakeups < 10000, self.wheel.wakeups)
+
+    def test_sparse_timers_wake_rarely(self):
+        self.add(86400)
+        self.loop.run_until(self.loop.now + 86401)
+        self.assertEquals(len(self.fired), 1)
+        self.failUnless(self.wheel.wakeups <= 4, self.wheel.wakeups)
+
+    def test_cancel(self):
+        first  = self.add(10)
+        second = self.add(20)
+        first.cancel()
+        self.assertEquals(len(self.wheel), 1)
+
+        # The wheel wakes for the cancelled timer, finds nothing to do and sets
+        # the loop timer for the next one:
+        self.loop.run_until(self.loop.now + 10)
+        self.assertEquals([ t.when for t in self.loop.timers ], [ self.wheel.epoch + 20 ])
+
+        second.cancel()
+        self.loop.run_until(self.loop.now + 100)
+        self.assertEquals((self.fired, len(self.wheel)), ([], 0))
+
+    def test_past_deadlines_fire_on_the_next_tick(self):
+        self.add(-5)
+        self.loop.run_until(self.loop.now + 1)
+        self.assertEquals(len(self.fired), 1)
+
+class ScheduleTests(unittest.TestCase):
+    """Cron expressions and Timers validation"""
+
+    def next_after(self, expression, *after):
+        when = CronSchedule(expression).next_after(time.mktime(datetime(*after).timetuple()))
+        return datetime.fromtimestamp(when).timetuple()[:5]
+
+    def test_cron(self):
+        self.assertEquals(self.next_after("*/15 * * * *", 2024, 1, 1, 10, 7), (2024, 1, 1, 10, 15))
+        self.assertEquals(self.next_after("30 2 * * 1-5", 2024, 1, 5, 3, 0), (2024, 1, 8, 2, 30))     # Friday to Monday
+        self.assertEquals(self.next_after("0 0 29 2 *", 2023, 3, 1, 0, 0), (2024, 2, 29, 0, 0))
+        self.assertEquals(self.next_after("0 12 1 * 0", 2024, 1, 2, 0, 0), (2024, 1, 7, 12, 0))       # Either day field matches
+        self.assertEquals(self.next_after("0,30 9-10 * * 7", 2024, 1, 7, 10, 30), (2024, 1, 14, 9, 0))
+
+    def test_invalid(self):
+        for event_config in ({}, { 'interval': 5, 'schedule': '* * * * *' }, { 'interval': 0 }, { 'interval': 'often' },
+                             { 'schedule': '* * * *' }, { 'schedule': '61 * * * *' }, { 'schedule': '0 0 31 2 *' },
+                             { 'interval': 60, 'jitter': -1 }):
+            self.assertRaises(AttributeError, get_timer_schedule, "test", event_config)
+
+        self.assertRaises(AttributeError, compile_config, { 'Timers': { 'hourly': { 'command': 'true' } } })
+        compile_config({ 'Timers': { 'hourly': { 'command': 'true', 'schedule': '0 * * * *', 'jitter': 60 } } })
+
+class TimerSourceTests(unittest.TestCase):
+    """Timers configured as an event source"""
+
+    def setUp(self):
+        self.loop       = FakeLoop()
+        self.dispatcher = Dispatcher()
+        self.calls      = []
+        logging.disable(logging.WARNING)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def configure(self, timers):
+        configure_sources(self.dispatcher, { 'Timers': timers }, { 'Timers': TimerSource })
+        source = self.dispatcher.sources['Timers']
+        for key in source.handlers:
+            source.handlers[key] = [ lambda key=None, **kwargs: self.calls.append((key, kwargs['scheduled'], kwargs['missed'], self.loop.now)) ]
+        self.dispatcher.start(self.loop)
+        return source
+
+    def test_interval(self):
+        start = self.loop.now
+        self.configure({ 'often': { 'command': 'true', 'interval': 10 }, 'rarely': { 'command': 'true', 'interval': 25 } })
+        self.loop.run_until(start + 50)
+        self.assertEquals([ c[:3] for c in self.calls ], [
+            ('often', start + 10, 0), ('often', start + 20, 0), ('rarely', start + 25, 0),
+            ('often', start + 30, 0), ('often', start + 40, 0), ('rarely', start + 50, 0), ('often', start + 50, 0),
+        ])
+
+    def test_missed_runs_are_skipped(self):
+        start  = self.loop.now
+        source = self.configure({ 'often': { 'command': 'true', 'interval': 60 } })
+        self.loop.sleep(3600 + 30)
+        self.loop.run_until(self.loop.now)
+
+        # One run for the hour asleep, then the timer keeps its phase:
+        self.assertEquals(self.calls, [ ('often', start + 60, 59, start + 3630) ])
+        self.assertEquals(source.timers['often'].when, start + 3660)
+
+    def test_jitter(self):
+        start  = self.loop.now
+        source = self.configure({ 'spread': { 'command': 'true', 'interval': 100, 'jitter': 30 } })
+        self.failUnless(start + 100 <= source.timers['spread'].when <= start + 130)
+        self.loop.run_until(start + 131)
+        self.assertEquals(self.calls[0][:3], ('spread', start + 100, 0))
+
+    def test_stop(self):
+        source = self.configure({ 'often': { 'command': 'true', 'interval': 10 } })
+        self.dispatcher.stop()
+        self.loop.run_until(self.loop.now + 100)
+        self.assertEquals((self.calls, source.timers, self.loop.timers), ([], {}, []))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import logging
+import threading
+import time
+import unittest
+
+from PyMacAdmin.crankd import actions
+from PyMacAdmin.crankd.loop import SelectEventLoop
+from PyMacAdmin.crankd.workers import WorkerPool
+
+CALLS = []
+
+def record_call(*args, **kwargs):
+    """Handler used by the test configurations"""
+    CALLS.append((threading.currentThread().getName(), kwargs['key']))
+
+class WorkerPoolTests(unittest.TestCase):
+    """Unit test for the threaded handler pool"""
+
+    def setUp(self):
+        self.pool  = WorkerPool(max_workers=4)
+        self.calls = []
+
+    def tearDown(self):
+        self.pool.shutdown(timeout=5.0)
+
+    def test_per_key_order(self):
+        def slow(key, i):
+            time.sleep(0.001 * (i % 3))
+            self.calls.append((key, i))
+
+        for i in range(30):
+            for key in ("en0", "en1", "en2"):
+                self.pool.submit(key, lambda key=key, i=i: slow(key, i))
+
+        self.failUnless(self.pool.join(5.0))
+        for key in ("en0", "en1", "en2"):
+            self.assertEquals([ i for k, i in self.calls if k == key ], range(30))
+        self.assertEquals((self.pool.completed, self.pool.queued, self.pool.busy), (90, 0, 0))
+
+    def test_keys_run_in_parallel(self):
+        blocked = threading.Event()
+
+        # A slow handler for one key mustn't hold up another:
+        self.pool.submit("slow", blocked.wait)
+        self.pool.submit("slow", lambda: self.calls.append("slow"))
+        self.pool.submit("fast", lambda: self.calls.append("fast"))
+
+        self.failIf(self.pool.join(0.5))
+        self.assertEquals(self.calls, [ "fast" ])
+
+        blocked.set()
+        self.failUnless(self.pool.join(5.0))
+        self.assertEquals(self.calls, [ "fast", "slow" ])
+
+    def test_threads_are_started_on_demand(self):
+        self.assertEquals(self.pool.threads, [])
+
+        for i in range(10):
+            self.pool.submit("same key", lambda: time.sleep(0.001))
+        self.pool.join(5.0)
+        self.assertEquals(len(self.pool.threads), 1)
+
+        blocked = threading.Event()
+        for i in range(10):
+            self.pool.submit(i, blocked.wait)
+        self.assertEquals(len(self.pool.threads), 4)
+        blocked.set()
+
+    def test_failures(self):
+        logging.disable(logging.CRITICAL)
+        try:
+            self.pool.submit("key", lambda: 1 / 0, name="broken")
+            self.pool.submit("key", lambda: self.calls.append("after"))
+            self.failUnless(self.pool.join(5.0))
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEquals((self.pool.failures, self.calls), (1, [ "after" ]))
+
+    def test_shutdown(self):
+        self.pool.submit("key", lambda: time.sleep(0.05))
+        self.pool.submit("key", lambda: self.calls.append("queued"))
+        self.failUnless(self.pool.shutdown(timeout=5.0))
+        self.assertEquals(self.calls, [ "queued" ])
+        self.failIf(any(t.isAlive() for t in self.pool.threads))
+        self.assertRaises(RuntimeError, self.pool.submit, "key", lambda: None)
+
+class ThreadedHandlerTests(unittest.TestCase):
+    """Runs configured handlers on the worker pool"""
+
+    def setUp(self):
+        del CALLS[:]
+        actions.EVENT_LOOP  = SelectEventLoop()
+        actions.WORKER_POOL = WorkerPool(max_workers=2)
+
+    def tearDown(self):
+        actions.WORKER_POOL.shutdown(timeout=5.0)
+        actions.EVENT_LOOP = actions.WORKER_POOL = None
+        actions.THREADED_DEFAULT = False
+
+    def test_threaded(self):
+        handler = actions.get_callable_for_event("k", { 'function': '%s.record_call' % __name__, 'threaded': True })
+        for key in ("a", "b", "a"):
+            handler(key=key)
+        actions.WORKER_POOL.join(5.0)
+
+        self.assertEquals(sorted(k for t, k in CALLS), [ "a", "a", "b" ])
+        self.failIf(any(t == threading.currentThread().getName() for t, k in CALLS))
+
+    def test_main_thread(self):
+        actions.THREADED_DEFAULT = True
+        threaded    = actions.get_callable_for_event("k", { 'function': '%s.record_call' % __name__ })
+        main_thread = actions.get_callable_for_event("k", { 'function': '%s.record_call' % __name__, 'main_thread': True })
+        command     = actions.get_callable_for_event("k", { 'command': 'true' })
+
+        main_thread(key="main")
+        self.assertEquals(CALLS, [ (threading.currentThread().getName(), "main") ])
+
+        threaded(key="worker")
+        actions.WORKER_POOL.join(5.0)
+        self.assertNotEquals(CALLS[1][0], threading.currentThread().getName())
+        self.failIf(isinstance(command, actions.ThreadedHandler))
+
+    def test_call_soon_threadsafe(self):
+        loop = actions.EVENT_LOOP
+        loop.enable_wakeup()
+        called = []
+
+        thread = threading.Thread(target=lambda: loop.call_soon_threadsafe(lambda: called.append(threading.currentThread().getName())))
+        thread.start()
+        thread.join()
+
+        loop.run_once(timeout=1.0)
+        self.assertEquals(called, [ threading.currentThread().getName() ])
+
+if __name__ == '__main__':
+    unittest.main()
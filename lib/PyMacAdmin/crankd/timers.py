@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Scheduled and periodic events
+
+The Timers section of the configuration runs handlers on a schedule instead
+of in response to the operating system, replacing a launchd job (and a
+process launch) for each periodic maintenance task:
+
+    <key>Timers</key>
+    <dict>
+        <key>flush-caches</key>
+        <dict>
+            <key>interval</key>     <integer>300</integer>
+            <key>jitter</key>       <integer>30</integer>
+            <key>command</key>      <string>/usr/local/bin/flush-caches</string>
+        </dict>
+        <key>nightly-inventory</key>
+        <dict>
+            <key>schedule</key>     <string>30 2 * * 1-5</string>
+            <key>function</key>     <string>handlers.inventory.run</string>
+        </dict>
+    </dict>
+
+interval:     run every this many seconds, starting one interval after crankd
+schedule:     a cron expression in local time: minute, hour, day of month,
+              month and day of week (0 or 7 is Sunday), each "*", a number, a
+              range ("1-5"), a step ("*/15", "0-30/10") or a comma-separated
+              list of those
+jitter:       delay each run by a random 0-jitter seconds so machines sharing
+              a configuration don't all run at once
+
+Handlers receive the timer's name as key, the un-jittered time the run was
+scheduled for as scheduled and, as missed, the number of runs which were
+skipped because crankd wasn't running them - typically because the machine
+was asleep. Missed runs are never made up: the timer runs once and carries on
+with its next future run.
+
+Every timer is kept in a single hierarchical timing wheel so thousands of
+timers cost no more than one event loop timer, set for the next deadline.
+"""
+
+import calendar
+import logging
+import random
+import time
+from datetime import datetime, timedelta
+from functools import partial
+
+from .events import EventSource
+
+WHEEL_BITS   = 6
+WHEEL_SLOTS  = 1 << WHEEL_BITS      # Slots per level
+WHEEL_LEVELS = 4                    # 64 ** 4 ticks: about 194 days with one-second ticks
+WHEEL_SPAN   = WHEEL_SLOTS ** WHEEL_LEVELS
+
+MAX_MISSED   = 10000                # Missed cron runs are counted up to this many
+
+
+class WheelTimer(object):
+    """A callback scheduled on a TimerWheel"""
+
+    __slots__ = ('wheel', 'when', 'expires', 'callback', 'slot', 'sequence')
+
+    def __init__(self, wheel, when, expires, callback, sequence):
+        self.wheel    = wheel
+        self.when     = when
+        self.expires  = expires         # The tick after which the timer fires
+        self.callback = callback
+        self.slot     = None            # The set which currently holds the timer
+        self.sequence = sequence
+
+    def cancel(self):
+        if self.slot is not None:
+            self.slot.discard(self)
+            self.slot = None
+            self.wheel.count -= 1
+
+
+class TimerWheel(object):
+    """
+    A hierarchical timing wheel
+
+    Time is divided into ticks of resolution seconds. Level 0 has a slot for
+    each of the next 64 ticks, level 1 a slot for each of the next 64 spans of
+    64 ticks and so on; a timer goes in the lowest level which covers its
+    deadline and moves down a level ("cascades") when its slot comes round.
+    Adding or cancelling a timer is O(1) and the wheel only asks the event
+    loop to wake it at the next tick which fires a timer or cascades a slot
+    which holds one.
+
+    call_later(delay, callback) must schedule callback on the event loop and
+    return an object with a cancel() method; clock() returns the current time.
+    """
+
+    def __init__(self, call_later, clock=time.time, resolution=1.0):
+        self.call_later = call_later
+        self.clock      = clock
+        self.resolution = resolution
+        self.epoch      = clock()
+        self.now        = 0             # The last tick processed
+        self.levels     = [ [ set() for i in range(WHEEL_SLOTS) ] for l in range(WHEEL_LEVELS) ]
+        self.wakeup     = None          # (tick, loop timer)
+        self.sequence   = 0
+        self.count      = 0
+
+        # Counters:
+        self.fired      = 0
+        self.cascaded   = 0
+        self.wakeups    = 0
+
+    def __len__(self):
+        return self.count
+
+    def tick(self, when):
+        """Returns the first tick at or after the time when"""
+        return int(-((self.epoch - when) // self.resolution))
+
+    def add(self, when, callback):
+        """Calls callback() at the time when (or as soon as possible if it has passed); returns a WheelTimer"""
+        self.sequence += 1
+        timer = WheelTimer(self, when, max(self.tick(when), self.now + 1), callback, self.sequence)
+        self.count += 1
+        self.place(timer)
+        self.schedule()
+        return timer
+
+    def place(self, timer):
+        """Puts timer in the slot which covers its deadline"""
+        expires = min(timer.expires, self.now + WHEEL_SPAN - 1)     # Far timers wait in the top level
+        delta   = expires - self.now
+        level   = 0
+        while delta >= WHEEL_SLOTS ** (level + 1):
+            level += 1
+
+        timer.slot = self.levels[level][(expires >> (WHEEL_BITS * level)) & (WHEEL_SLOTS - 1)]
+        timer.slot.add(timer)
+
+    def next_tick(self):
+        """Returns the next tick which fires or cascades a timer, or None if the wheel is empty"""
+        if not self.count:
+            return None
+
+        best = None
+        for level, slots in enumerate(self.levels):
+            shift = WHEEL_BITS * level
+            base  = self.now >> shift
+            for i in range(1, WHEEL_SLOTS + 1):
+                if slots[(base + i) & (WHEEL_SLOTS - 1)]:
+                    tick = (base + i) << shift
+                    if best is None or tick < best:
+                        best = tick
+                    break
+            if best is not None and best <= (base + 1) << shift:
+                break   # Nothing in a higher level can come sooner
+        return best
+
+    def schedule(self):
+        """Asks the event loop to wake us for the next tick which has work to do"""
+        tick = self.next_tick()
+        if self.wakeup is not None:
+            if self.wakeup[0] == tick:
+                return
+            self.wakeup[1].cancel()
+            self.wakeup = None
+
+        if tick is not None:
+            delay       = self.epoch + tick * self.resolution - self.clock()
+            self.wakeup = (tick, self.call_later(max(0, delay), self.run))
+
+    def run(self):
+        """Called by the event loop timer"""
+        self.wakeup   = None
+        self.wakeups += 1
+        self.advance(int((self.clock() - self.epoch) // self.resolution))
+        self.schedule()
+
+    def advance(self, target):
+        """Processes every tick up to target, skipping straight over ticks with nothing to do"""
+        while self.now < target:
+            tick = self.next_tick()
+            if tick is None or tick > target:
+                self.now = target
+                break
+
+            self.now = tick
+
+            # Higher levels first, so their timers can land in lower slots
+            # which are cascaded or fired in the same tick:
+            for level in range(WHEEL_LEVELS - 1, 0, -1):
+                shift = WHEEL_BITS * level
+                if tick & ((1 << shift) - 1) == 0:
+                    slot    = self.levels[level][(tick >> shift) & (WHEEL_SLOTS - 1)]
+                    pending = list(slot)
+                    slot.clear()
+                    for timer in pending:
+                        self.cascaded += 1
+                        self.place(timer)
+
+            slot = self.levels[0][tick & (WHEEL_SLOTS - 1)]
+            due  = sorted(slot, key=lambda t: (t.when, t.sequence))
+            slot.clear()
+            for timer in due:
+                timer.slot   = None
+                self.count  -= 1
+                self.fired  += 1
+                try:
+                    timer.callback()
+                except Exception:
+                    logging.exception("Timer callback %r failed" % timer.callback)
+
+    def close(self):
+        """Cancels the event loop timer; timers which haven't fired never will"""
+        if self.wakeup is not None:
+            self.wakeup[1].cancel()
+            self.wakeup = None
+
+
+def parse_cron_field(field, low, high):
+    """Returns the set of values matched by one field of a cron expression"""
+    values = set()
+    for part in field.split(","):
+        step = 1
+        if "/" in part:
+            part, step = part.split("/", 1)
+            step = int(step)
+            if step < 1:
+                raise ValueError("a step must be positive")
+
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start, end = [ int(p) for p in part.split("-", 1) ]
+        else:
+            start = end = int(part)
+
+        if start < low or end > high or start > end:
+            raise ValueError("%s is outside %d-%d" % (part, low, high))
+
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronSchedule(object):
+    """A five-field cron expression, evaluated in local time"""
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError("a cron schedule has five fields: minute hour day-of-month month day-of-week")
+
+        self.expression = expression
+        self.minutes    = parse_cron_field(fields[0], 0, 59)
+        self.hours      = parse_cron_field(fields[1], 0, 23)
+        self.days       = parse_cron_field(fields[2], 1, 31)
+        self.months     = parse_cron_field(fields[3], 1, 12)
+        self.weekdays   = set(d % 7 for d in parse_cron_field(fields[4], 0, 7))   # 0 = Sunday
+
+        # As in cron, a day matches either field if both are restricted:
+        self.any_day     = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    def day_matches(self, dt):
+        in_days     = dt.day in self.days
+        in_weekdays = (dt.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return in_days and in_weekdays
+        return in_days or in_weekdays
+
+    def next_after(self, when):
+        """Returns the first scheduled time after when (seconds since the epoch)"""
+        dt = datetime.fromtimestamp(when).replace(second=0, microsecond=0) + timedelta(minutes=1)
+
+        # Each step moves to the start of the next candidate month, day, hour
+        # or minute, so this takes at most a few hundred iterations:
+        for i in range(100000):
+            if dt.month not in self.months:
+                dt = (dt.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self.day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + timedelta(hours=1)
+            elif dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+            else:
+                return time.mktime(dt.timetuple())
+
+        raise ValueError("%s never matches" % self.expression)
+
+    def missed(self, scheduled, now):
+        """Returns the number of runs after scheduled which are already in the past at now"""
+        count = 0
+        when  = self.next_after(scheduled)
+        while when <= now and count < MAX_MISSED:
+            count += 1
+            when   = self.next_after(when)
+        return count
+
+
+class IntervalSchedule(object):
+    """Runs every interval seconds"""
+
+    def __init__(self, interval):
+        self.interval = interval
+
+    def next_after(self, when):
+        return when + self.interval
+
+    def missed(self, scheduled, now):
+        return max(0, int((now - scheduled) // self.interval))
+
+
+def get_timer_schedule(name, event_config):
+    """Returns the schedule described by a Timers entry; raises AttributeError if it's invalid"""
+    if ('interval' in event_config) == ('schedule' in event_config):
+        raise AttributeError("%s must have either an interval or a schedule" % name)
+
+    if 'interval' in event_config:
+        try:
+            interval = float(event_config['interval'])
+        except (TypeError, ValueError):
+            raise AttributeError("%s: interval must be a number of seconds, not %r" % (name, event_config['interval']))
+        if interval <= 0:
+            raise AttributeError("%s: interval must be positive" % name)
+        schedule = IntervalSchedule(interval)
+    else:
+        try:
+            schedule = CronSchedule(str(event_config['schedule']))
+            schedule.next_after(time.time())
+        except ValueError, exc:
+            raise AttributeError("%s: invalid schedule %r: %s" % (name, event_config['schedule'], exc))
+
+    try:
+        schedule.jitter = float(event_config.get('jitter', 0))
+    except (TypeError, ValueError):
+        raise AttributeError("%s: jitter must be a number of seconds, not %r" % (name, event_config['jitter']))
+    if schedule.jitter < 0:
+        raise AttributeError("%s: jitter must not be negative" % name)
+
+    return schedule
+
+
+class TimerSource(EventSource):
+    """Emits an event, keyed by the timer's name, each time a configured timer is due"""
+    name = "Timers"
+
+    def __init__(self, name=None, resolution=1.0):
+        super(TimerSource, self).__init__(name)
+        self.resolution = resolution
+        self.schedules  = dict()    # key -> schedule
+        self.timers     = dict()    # key -> WheelTimer for the next run
+        self.wheel      = None
+
+    def context(self, key):
+        return "Timer: %s" % key
+
+    def add_handler(self, key, event_config):
+        handler = super(TimerSource, self).add_handler(key, event_config)
+        if handler is not None:
+            self.schedules[key] = get_timer_schedule("Timers %s" % key, event_config)
+            if self.wheel is not None:
+                self.arm(key, self.wheel.clock())
+        return handler
+
+    def remove_handler(self, key):
+        super(TimerSource, self).remove_handler(key)
+        self.schedules.pop(key, None)
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+
+    def start(self, loop):
+        self.wheel = TimerWheel(loop.call_later, loop.time, self.resolution)
+        now = self.wheel.clock()
+        for key in sorted(self.schedules):
+            self.arm(key, now)
+        logging.debug("Started %d timer(s)" % len(self.timers))
+
+    def stop(self):
+        for timer in self.timers.values():
+            timer.cancel()
+        self.timers.clear()
+        if self.wheel is not None:
+            self.wheel.close()
+            self.wheel = None
+
+    def arm(self, key, after):
+        """Schedules the next run of key after the time after"""
+        schedule  = self.schedules[key]
+        scheduled = schedule.next_after(after)
+        delay     = random.uniform(0, schedule.jitter) if schedule.jitter else 0
+        self.timers[key] = self.wheel.add(scheduled + delay, partial(self.fire, key, scheduled))
+
+    def fire(self, key, scheduled):
+        """Emits the event for a timer and schedules its next run, skipping any which were missed"""
+        schedule = self.schedules.get(key)
+        if schedule is None:
+            return
+
+        now    = self.wheel.clock()
+        missed = schedule.missed(scheduled, now)
+        if missed:
+            logging.info("%s: skipped %d run(s) which were due while crankd wasn't running them" % (self.context(key), missed))
+
+        # Intervals keep their phase; cron schedules simply find their next run:
+        if isinstance(schedule, IntervalSchedule):
+            self.arm(key, scheduled + missed * schedule.interval)
+        else:
+            self.arm(key, now)
+
+        self.emit(key, key=key, scheduled=scheduled, missed=missed)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Runs Python handlers on worker threads
+
+Python handlers normally run on the event loop, so one handler waiting for a
+DNS lookup or a slow server delays every other event. A function or method
+handler whose configuration sets threaded to true (or every such handler, if
+crankd is started with --threaded) is run by a WorkerPool instead:
+
+    - calls for the same handler and event key run one at a time, in the
+      order the events arrived, so a handler never sees a stale event after
+      a newer one
+    - calls for different keys or handlers run in parallel on up to
+      max_workers threads, which are started as they are needed
+
+Handlers which use Cocoa objects owned by the main thread should set
+main_thread to true to stay on the event loop. "class" handlers and shell
+commands, which are already asynchronous, are never threaded.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from Queue import Queue
+
+# Placed on the ready queue to stop a worker thread:
+STOP = object()
+
+
+class WorkerPool(object):
+    """
+    A bounded pool of threads which runs tasks in order for each key
+
+    Each key with outstanding tasks appears on the ready queue at most once,
+    so a key's tasks can never run on two threads at once; a worker runs the
+    oldest task for the key it takes and puts the key back at the end of the
+    ready queue if more have arrived, which keeps one busy key from starving
+    the others.
+    """
+
+    def __init__(self, max_workers=4, name="crankd worker"):
+        if max_workers < 1:
+            raise ValueError("A WorkerPool needs at least one thread")
+
+        self.max_workers = max_workers
+        self.name        = name
+        self.lock        = threading.Lock()
+        self.idle        = threading.Condition(self.lock)   # Notified when the last task finishes
+        self.ready       = Queue()         # Keys with a task which can be run now
+        self.tasks       = dict()          # key -> deque of (name, task); the head is running or ready
+        self.threads     = list()
+        self.closed      = False
+
+        # Counters:
+        self.queued      = 0               # Tasks waiting for a thread
+        self.busy        = 0               # Tasks running now
+        self.completed   = 0
+        self.failures    = 0
+
+    def submit(self, key, task, name=None):
+        """Queues task() to run after every task previously submitted for key"""
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("%s: the worker pool has been shut down" % name)
+
+            self.queued += 1
+            tasks = self.tasks.get(key)
+            if tasks is not None:
+                tasks.append((name, task))
+                return
+
+            self.tasks[key] = deque([ (name, task) ])
+
+            # Only keys with outstanding tasks can use a thread:
+            if len(self.threads) < min(len(self.tasks), self.max_workers):
+                thread = threading.Thread(target=self.run, name="%s %d" % (self.name, len(self.threads) + 1))
+                thread.setDaemon(True)
+                thread.start()
+                self.threads.append(thread)
+
+        self.ready.put(key)
+
+    def run(self):
+        """Worker thread: runs the next task for each ready key until it receives STOP"""
+        while True:
+            key = self.ready.get()
+            if key is STOP:
+                return
+
+            with self.lock:
+                name, task = self.tasks[key][0]
+                self.queued -= 1
+                self.busy   += 1
+
+            failed = False
+            try:
+                task()
+            except Exception:
+                failed = True
+                logging.exception("%s: threaded handler failed" % name)
+
+            with self.lock:
+                self.busy      -= 1
+                self.completed += 1
+                self.failures  += failed
+
+                tasks = self.tasks[key]
+                tasks.popleft()
+                if not tasks:
+                    del self.tasks[key]
+                    if not self.tasks:
+                        self.idle.notifyAll()
+
+            if tasks:
+                self.ready.put(key)
+
+    def join(self, timeout=None):
+        """Waits until every submitted task has finished; returns False if timeout expired first"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.lock:
+            while self.tasks:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.idle.wait(remaining)
+            return not self.tasks
+
+    def shutdown(self, timeout=None):
+        """Stops accepting tasks, waits up to timeout seconds for queued tasks and stops the threads"""
+        with self.lock:
+            self.closed = True
+
+        finished = self.join(timeout)
+        if not finished:
+            logging.warning("%s: %d task(s) had not finished after %ss" % (self.name, self.queued + self.busy, timeout))
+
+        for thread in self.threads:
+            self.ready.put(STOP)
+        if finished:
+            for thread in self.threads:
+                thread.join()
+
+        return finished
+
+
+class ThreadedHandler(object):
+    """Wraps a handler so each call is run by a WorkerPool, ordered by handler and event key"""
+
+    def __init__(self, handler, pool, name):
+        self.handler = handler
+        self.pool    = pool
+        self.name    = name
+
+    def __call__(self, *args, **kwargs):
+        # SystemConfiguration events have a key and FSEvents a path; anything
+        # else is ordered by the handler alone:
+        key = kwargs.get('key') or kwargs.get('path')
+        self.pool.submit((self.name, key), lambda: self.handler(*args, **kwargs), name=self.name)